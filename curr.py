@@ -18,6 +18,7 @@ import random
 from datetime import datetime
 import pickle
 from tqdm import tqdm
+from StandardHC import likelihood_invM as likelihood
 # import warnings
 # warnings.filterwarnings('error', category=RuntimeWarning)
 
@@ -141,107 +142,17 @@ class VCSMC:
 
     def llh_bc(self, l_data_Kx1x4, r_data_Kx1x4, t_cut, decay_factor_Kx1, l_llh, r_llh):
 
-        # grab left invariant mass
-        tL_Kx1 = l_data_Kx1x4[:, :,0] ** 2 - tf.norm(l_data_Kx1x4[:, :,1:], axis = -1) ** 2
-        # grab right invariant mass
-        tR_Kx1 = r_data_Kx1x4[:, :,0] ** 2 - tf.norm(r_data_Kx1x4[:, :,1:], axis = -1) ** 2
-
-        p_data_Kx1x4 = l_data_Kx1x4 + r_data_Kx1x4
-
-        tp_Kx1 = p_data_Kx1x4[:, :,0] ** 2 - tf.norm(p_data_Kx1x4[:, :,1:], axis = -1) ** 2
-
-        is_negative_Kx1 = tf.logical_or(tf.logical_or(tf.less(tL_Kx1, 0), tf.less(tR_Kx1, 0)), tf.less_equal(tp_Kx1, 0))
-
-        is_invalid_Kx1 = tf.logical_or(
-                            tf.less_equal(tp_Kx1, t_cut),
-                            tf.logical_or(
-                               tf.logical_or(
-                                   tf.greater_equal(tL_Kx1, (1 - 1e-3) * tp_Kx1),
-                                   tf.greater_equal(tR_Kx1, (1 - 1e-3) * tp_Kx1)
-                               ),
-                               tf.greater(
-                                   tf.sqrt(tL_Kx1) + tf.sqrt(tR_Kx1),
-                                   tf.sqrt(tp_Kx1)
-                               )
-                            )
-                         )
-
-
-        def valid_calc(tp_Xx1, tL_Xx1, tR_Xx1, decay_factor_Xx1):
-
-            def get_logp(tP_local_Xx1, t_Xx1, t_cut, decay_factor_Xx1):
-                """ Here we call the actual PDFs and CDFs defined in Eq (7) of the paper"""
-
-                def prob_is_leaf(tP_local_Yx1, t_Yx1, t_cut, decay_factor_Yx1):
-                    """ The CDF defined in Eq (7) of the paper """
-                    # Probability of the shower to stop F_s
-                    one_minus_cdf = 1 - tf.math.exp(- (1 - 1e-3)*decay_factor_Yx1)
-                    prob = - tf.math.log(one_minus_cdf)\
-                           + tf.math.log(decay_factor_Yx1) - tf.math.log(tP_local_Yx1) - decay_factor_Yx1 * t_Yx1 / tP_local_Yx1
-                    return prob
-
-                def prob_is_not_leaf(tP_local_Xx1, t_Xx1, t_cut, decay_factor_Xx1):
-                    """ The PDF defined in Eq (7) of the paper """
-                    t_upper_Xx1 = tf.minimum(tP_local_Xx1, t_cut) #There are cases where tp2 < t_cut
-                    one_minus_cdf = 1 - tf.math.exp(- (1 - 1e-3) * decay_factor_Xx1)
-                    prob = -tf.math.log(one_minus_cdf) + \
-                            tf.math.log(1 - tf.math.exp(- decay_factor_Xx1 * t_upper_Xx1 / tP_local_Xx1))
-                    return prob
-
-                results_Xx1 = prob_is_not_leaf(tP_local_Xx1, t_Xx1, t_cut, decay_factor_Xx1)
-
-                indices_Yx1 = tf.where(tf.greater(tf.reshape(t_Xx1, (-1,)), t_cut))
-
-                tP_local_new_Yx1 = tf.gather(tf.reshape(tP_local_Xx1, (-1,)), indices_Yx1)
-                t_new_Yx1 = tf.gather(tf.reshape(t_Xx1, (-1,)), indices_Yx1)
-                decay_factor_Yx1 = tf.gather(tf.reshape(decay_factor_Xx1, (-1,)), indices_Yx1)
-
-                updates_Yx1 = prob_is_leaf(tP_local_new_Yx1, t_new_Yx1, t_cut, decay_factor_Yx1)
-
-                results_Xx1 = tf.tensor_scatter_nd_update(results_Xx1, indices_Yx1, updates_Yx1)
-
-                return results_Xx1
-
-            # We always assign the left node as the node with the greater invariant mass for consistency
-            # To do this, we find the invariant mass squared for each node as a function of the parent
-            # by defining tpLR and tpRL using Eq (6) of the paper
-            # this is something akin to the parent invarinat mass in case left is bigger than right and the
-            # parent invariant mass in case right is bigger than left
-            tpLR_Xx1 = (tf.sqrt(tp_Xx1) - tf.sqrt(tL_Xx1)) ** 2
-            tpRL_Xx1 = (tf.sqrt(tp_Xx1) - tf.sqrt(tR_Xx1)) ** 2
-
-            # Calculate the log propobability using the CDFs and PDFs
-            # for each of the two cases where the left/right node is ultimately greater
-            logpLR_Xx1 = tf.cast(tf.math.log(1/2), dtype = tf.float64) + get_logp(tp_Xx1, tL_Xx1, t_cut,decay_factor_Xx1) + get_logp(tpLR_Xx1, tR_Xx1, t_cut, decay_factor_Xx1) 
-
-            logpRL_Xx1 = tf.cast(tf.math.log(1/2), dtype = tf.float64) + get_logp(tp_Xx1, tR_Xx1, t_cut, decay_factor_Xx1) + get_logp(tpRL_Xx1, tL_Xx1, t_cut, decay_factor_Xx1)
-
-            # take the product of the two rightmost terms in Eq (8) where the one_minus_cdf term is distributed
-            logp_split_Xx1 = tf.reduce_logsumexp(tf.stack([logpLR_Xx1, logpRL_Xx1]), axis = 0)
-
-            # Add the term for the likelihood for sampling uniformly over a 2-sphere
-            logLH_Xx1 = logp_split_Xx1 + tf.math.log(1 / (4 * tf.constant(np.pi, dtype = tf.float64)))
-
-            return tf.cast(logLH_Xx1, dtype = tf.float64)
-
-
-        results_Kx1 = -tf.float64.max * tf.cast(tf.ones_like(is_negative_Kx1), dtype=tf.float64)
-
-        indices_Xx1 = tf.where(
-                        tf.logical_and(
-                            tf.logical_not(tf.reshape(is_negative_Kx1, (-1,))),
-                            tf.logical_not(tf.reshape(is_invalid_Kx1, (-1,)))
-                        )
+        # splitting log likelihood of the Ginkgo model (Eq (8) of the paper), shared with the likelihood backends of StandardHC.
+        # Pairings that are not allowed get -tf.float64.max instead of -inf
+        results_Kx1 = likelihood.tf_split_logLH_with_stop_nonstop_prob(
+                        tf,
+                        l_data_Kx1x4,
+                        r_data_Kx1x4,
+                        t_cut,
+                        decay_factor_Kx1,
+                        notAllowedLogLH = -tf.float64.max
                       )
 
-        tp_new_Xx1 = tf.gather(tf.reshape(tp_Kx1, (-1,)), indices_Xx1)
-        tL_new_Xx1 = tf.gather(tf.reshape(tL_Kx1, (-1,)), indices_Xx1)
-        tR_new_Xx1 = tf.gather(tf.reshape(tR_Kx1, (-1,)), indices_Xx1)
-        decay_factor_Xx1 = tf.gather(tf.reshape(decay_factor_Kx1, (-1,)), indices_Xx1)
-
-        updates_Xx1 = valid_calc(tp_new_Xx1, tL_new_Xx1, tR_new_Xx1, decay_factor_Xx1)
-
-        results_Kx1 = tf.tensor_scatter_nd_update(results_Kx1, indices_Xx1, updates_Xx1)
         rec_results_Kx1 = results_Kx1 + l_llh + r_llh
 
         parent_vec4_Kx1x4 = tf.squeeze(l_data_Kx1x4 + r_data_Kx1x4)
@@ -5,9 +5,11 @@ import pickle
 import itertools
 import time
 import copy
+import heapq
 
 from . import likelihood_invM as likelihood
 from . import auxFunctions_invM as auxFunctions
+from . import treeKernels
 
 from .utils import get_logger
 
@@ -25,6 +27,7 @@ def recluster(
 		delta_min = None,
 		lam = None,
 		visualize = False,
+		backend = None,
 ):
 	"""
 	Get the leaves of an  input jet,
@@ -57,43 +60,18 @@ def recluster(
 
 		- visualize: if true, calculate extra features needed for the visualizations and add them to the tree dictionary.
 
+		- backend: likelihood backend used to score the pairings (see likelihood_invM.getBackend). Default: stop / non-stop model (fast backend).
+
 	Returns:
 		- jet dictionary
 	"""
 
 
-	def _rec(jet, parent, node_id, outers_list):
-		"""
-        Recursive function to get a list of the tree leaves
-        """
-		if jet["tree"][node_id, 0] == -1:
-
-			outers_list.append(jet["content"][node_id])
-
-		else:
-			_rec(
-		    jet,
-		    node_id,
-		    jet["tree"][node_id, 0],
-		    outers_list,
-		    )
-
-			_rec(
-		    jet,
-		    node_id,
-		    jet["tree"][node_id, 1],
-		    outers_list,
-		    )
-
-		return outers_list
-
-
 	outers = []
 
 	# Get constituents list (leaves)
-	jet_const =_rec(
+	jet_const = getConstituents(
 	input_jet,
-	-1,
 	input_jet["root_id"],
 	outers,
 	)
@@ -114,6 +92,7 @@ def recluster(
 		delta_min = delta_min,
 		lam = lam,
 		lamRoot = float(input_jet["LambdaRoot"]),
+		backend = backend,
 	)
 
 	jet = {}
@@ -185,32 +164,23 @@ def recluster(
 
 def getConstituents(jet, node_id, outers_list):
 	"""
-	Recursive function to get a list of the tree leaves
+	Get a list of the leaves of the subtree of node_id, in the order they are visited (see treeKernels.leaves)
 	"""
-	if jet["tree"][node_id, 0] == -1:
-
-		outers_list.append(jet["content"][node_id])
-
-	else:
-		getConstituents(
-	    jet,
-	    jet["tree"][node_id, 0],
-	    outers_list,
-	    )
-
-		getConstituents(
-	    jet,
-	    jet["tree"][node_id, 1],
-	    outers_list,
-	    )
+	for leaf in treeKernels.leaves(jet["tree"], node_id).tolist():
+		outers_list.append(jet["content"][leaf])
 
 	return outers_list
 
 
-def greedyLH(levelContent, delta_min= None, lam=None, lamRoot = None):
+def greedyLH(levelContent, delta_min= None, lam=None, lamRoot = None, backend = None):
 	"""
 	Runs the logLHMaxLevel function level by level starting from the list of constituents (leaves) until we reach the root of the tree.
 
+	The log likelihood of every pairing is stored in a preallocated (2N-1) x (2N-1) matrix (one row/column per node of the tree), together with a per-node cache of the nearest neighbor (NN) and its log likelihood.
+	After each merge only the row/column of the new node is filled and only the nodes whose NN was merged get their NN refreshed.
+	The max logLH pairing at each level is taken from a binary heap of (node, NN) candidates with lazy deletion: each node has a version stamp that is increased
+	every time its NN changes or it gets merged, and heap entries with an old version are skipped when they reach the top. This is O(log N) per level.
+
 	Note: levelContent is a list of the nodes after deleting the constituents that are merged and adding the new node in each level.
 	      So this should only have the root of the tree at the end.
 
@@ -218,6 +188,8 @@ def greedyLH(levelContent, delta_min= None, lam=None, lamRoot = None):
 		- levelContent: jet constituents (i.e. the leaves of the tree)
 		- delta_min: pT cut scale for the showering process to stop.
 		- lam: decaying rate value for the exponential distribution.
+		- lamRoot: decaying rate value for the root splitting.
+		- backend: likelihood backend used to score the pairings (name or likelihood_invM.likelihoodBackend object). Default: stop / non-stop model (fast backend).
 
 
 	Returns:
@@ -237,6 +209,8 @@ def greedyLH(levelContent, delta_min= None, lam=None, lamRoot = None):
 
 	Nconst = len(levelContent)
 
+	backend = likelihood.getBackend(backend)
+
 	jetTree = [[-1,-1]]*Nconst
 	idx = [i for i in range(Nconst)]
 	jetContent = copy.deepcopy(levelContent)
@@ -244,18 +218,33 @@ def greedyLH(levelContent, delta_min= None, lam=None, lamRoot = None):
 	N_leaves_list = [1.] * Nconst
 	linkage_list = []
 	logLH=[]
-	levelDeltas = [0.] * Nconst
 
 
-	""" Calculate the nearest neighbor (NN) based on max log likelihood (logLH) for each leaf of the tree."""
-	NNpairs = NNeighbors(
-			levelContent,
-			levelDeltas,
+	""" Momentum and delta of every node of the tree (leaves first, then the inner nodes in the order they are clustered) """
+	nodeContent = np.zeros((2 * Nconst - 1, 4))
+	nodeContent[0:Nconst] = np.asarray(levelContent).reshape(-1, 4)
+	nodeDeltas = np.zeros(2 * Nconst - 1)
+
+	""" Nodes in the current level """
+	active = np.zeros(2 * Nconst - 1, dtype=bool)
+	active[0:Nconst] = True
+
+
+	""" Calculate the log likelihood of all the pairings of the leaves and the nearest neighbor (NN) of each leaf."""
+	pairLogLH, NNidx, NNlogLH = NNeighbors(
+			nodeContent,
+			nodeDeltas,
 			Nconst = Nconst,
 			delta_min = delta_min,
 			lam = lam,
+			backend = backend,
 	)
 
+	""" Max heap (we store -logLH) of the (node, NN) pairings, with the version stamp of the node when it was pushed """
+	NNversion = np.zeros(2 * Nconst - 1, dtype=int)
+	NNheap = [(- NNlogLH[k], k, 0) for k in range(1, Nconst)]
+	heapq.heapify(NNheap)
+
 
 	""" Cluster constituents. This is O(N) at each level x N levels => O(N^2) """
 	for j in range(Nconst - 1):
@@ -269,9 +258,14 @@ def greedyLH(levelContent, delta_min= None, lam=None, lamRoot = None):
 
 
 		logLHMaxLevel(
-			NNpairs,
-			levelContent,
-			levelDeltas,
+			pairLogLH,
+			NNidx,
+			NNlogLH,
+			NNheap,
+			NNversion,
+			active,
+			nodeContent,
+			nodeDeltas,
 			logLH,
 			jetTree,
 			jetContent,
@@ -281,6 +275,7 @@ def greedyLH(levelContent, delta_min= None, lam=None, lamRoot = None):
 			linkage_list = linkage_list,
 			delta_min = delta_min,
 			lam = lam,
+			backend = backend,
 		)
 
 
@@ -293,56 +288,77 @@ def greedyLH(levelContent, delta_min= None, lam=None, lamRoot = None):
 
 
 def NNeighbors(
-    levelContent,
-	levelDeltas,
+    nodeContent,
+	nodeDeltas,
     Nconst=None,
 	delta_min = None,
-	lam = None
+	lam = None,
+	backend = None,
 ):
 	"""
-	-For each leaf i of the tree, calculate its nearest neighbor (NN) j and the log likelihood for that pairing. This is O(N^2)
-	Format: NNpairs = [ (logLH,[leaf i,leaf j]) for i in leaves]
-
-	Calculate the log likelihood between all possible pairings of the leaves at a certain level and get the maximum. Each entry in NN[airs corresponds to a node and contains that node and its nearest neighbor node. Format: [(logLH,[node,node NN])..]
-	For efficiency, we only loop over the nodes to the left of each node. So, if the max logLH pairing is with a node to the right, that will be considered when the "neighbor node" becomes the "node".
-	We also have a list that keeps track of the index of each node (in the "idx" list), thus we want 1 pairing per node. For the 1st node, we add an entry (-np.inf, [0, -999])] so that this will have the lowest priority. All the pairings of the 1st node are considered by the nodes to the right.
+	-Calculate the log likelihood between all possible pairings of the leaves with the batched likelihood kernel and store them in a (2N-1) x (2N-1) matrix. This is O(N^2)
+	-For each leaf k of the tree, get its nearest neighbor (NN), i.e. the leaf j<k that gives the max logLH pairing.
+	For efficiency, we only consider the nodes to the left of each node. So, if the max logLH pairing is with a node to the right, that will be considered when the "neighbor node" becomes the "node".
+	The 1st leaf has no NN (idx = -1 and logLH = - Infinity). All the pairings of the 1st node are considered by the nodes to the right.
+	(The same holds at every level: the 1st node of the level has no nodes to its left, so it has no NN)
 
 	Args:
-	    - levelContent: array with the constituents momentum list for the current level (i.e. after deleting the constituents that are merged and
-	      adding the new node from merging them in all previous levels)
-	    - levelDeltas: array with the delta values (for the splitting of a node in the Toy Jets Shower Model) for the current level.
+	    - nodeContent: array of shape (2N-1, 4) with the momentum of all the nodes of the tree. Only the leaves are filled.
+	    - nodeDeltas: array of shape (2N-1,) with the delta values (for the splitting of a node in the Toy Jets Shower Model).
 	    - Nconst: Number of leaves
 	    - delta_min: pT cut scale for the showering process to stop.
 		- lam: decaying rate value for the exponential distribution.
+		- backend: likelihood backend used to score the pairings (see likelihood_invM.getBackend).
 
 	Returns:
-		- NNpairs
+		- pairLogLH: (2N-1) x (2N-1) matrix with the log likelihood of each pairing (- Infinity if not computed)
+		- NNidx: array with the node id of the NN of each node
+		- NNlogLH: array with the log likelihood of the pairing of each node with its NN
 
 	"""
 
-	NNpairs =  [(-np.inf, [0, -999])] + \
-	           [
-		           max(
-			           [
-				           (
-					           likelihood.split_logLH(
-						           levelContent[k],
-						           levelDeltas[k],
-						           levelContent[k - j],
-						           levelDeltas[k - j],
-						           delta_min,
-						           lam,
-					           ),
-					           [k, k - j]
-				           )
-				           for j in range(k, 0, -1)
-			           ], key=lambda x: x[0]
-		           )
-		           for k in range(1, Nconst, 1)
-	           ]
+	Nnodes = 2 * Nconst - 1
+
+	pairLogLH = np.full((Nnodes, Nnodes), - np.inf)
+	NNidx = np.full(Nnodes, -1, dtype=int)
+	NNlogLH = np.full(Nnodes, - np.inf)
+
+	backend = likelihood.getBackend(backend)
+
+	right, left = np.tril_indices(Nconst, -1)
 
+	if len(right) > 0:
+		pairs = backend.split_logLH_batch(
+			nodeContent[right],
+			nodeDeltas[right],
+			nodeContent[left],
+			nodeDeltas[left],
+			delta_min,
+			lam,
+		)
+		pairLogLH[right, left] = pairs
+		pairLogLH[left, right] = pairs
+
+	leaves = np.arange(Nconst)
+	for k in range(1, Nconst):
+		NNidx[k], NNlogLH[k] = _leftNN(pairLogLH, k, leaves[0:k])
+
+	return pairLogLH, NNidx, NNlogLH
 
-	return NNpairs
+
+
+
+def _leftNN(pairLogLH, node, candidates):
+	"""
+	Get the NN of node among the candidates (nodes to its left) from the pairings log likelihood matrix.
+	If there is a tie, keep the 1st node (smallest id). If there are no candidates, return idx = -1 and logLH = - Infinity.
+	"""
+	if len(candidates) == 0:
+		return -1, - np.inf
+
+	best = np.argmax(pairLogLH[node, candidates])
+
+	return candidates[best], pairLogLH[node, candidates[best]]
 
 
 
@@ -351,9 +367,14 @@ def NNeighbors(
 
 
 def logLHMaxLevel(
-	NNpairs,
-    levelContent,
-	levelDeltas,
+	pairLogLH,
+	NNidx,
+	NNlogLH,
+	NNheap,
+	NNversion,
+	active,
+	nodeContent,
+	nodeDeltas,
     logLH,
     jetTree,
     jetContent,
@@ -363,24 +384,30 @@ def logLHMaxLevel(
 	linkage_list=None,
 	delta_min = None,
 	lam = None,
+	backend = None,
 ):
 	"""
 	- Update the jet dictionary information by deleting the nodes that are merged and adding the new node at each level.
-	- Update the nearest neighbors (NN) list of the nodes whose NN was deleted.
+	- Update the nearest neighbors (NN) of the nodes whose NN was deleted.
 
 	Args:
 
-		- levelContent: array with the constituents momentum list for the current level (i.e. after deleting the constituents that are merged and
+		- pairLogLH: (2N-1) x (2N-1) matrix with the log likelihood of each pairing.
+		- NNidx: array with the node id of the NN of each node.
+		- NNlogLH: array with the log likelihood of the pairing of each node with its NN.
+		- NNheap: heap with entries (-logLH, node, version) for the pairing of each node with its NN. Entries whose version does not match NNversion are stale.
+		- NNversion: array with the version stamp of each node.
+		- active: boolean array that is True for the nodes in the current level (i.e. after deleting the constituents that are merged and
 	      adding the new node from merging them in all previous levels)
-	    - levelDeltas: array with the delta values (for the splitting of a node in the Toy Jets Shower Model) for the current level.
+		- nodeContent: array with the momentum of all the nodes of the tree.
+	    - nodeDeltas: array with the delta values (for the splitting of a node in the Toy Jets Shower Model) of all the nodes of the tree.
 	    - logLH: list with all the previous max log likelihood pairings.
 	    - jetTree: jet tree structure list
 	    - jetContent: array with the momentum of all the nodes of the jet tree (both leaves and inners) after adding one
 	      more level in the clustering.
 	      (We add a new node each time we cluster 2 pseudojets)
 	    - idx: array that stores the node id (the node id determines the location of the momentum of a node in the jetContent array)
-	      of the nodes that are in the current levelContent array. It has the same number of elements as levelContent (they get updated
-	      level by level).
+	      of the nodes that are in the current level. They get updated level by level.
 	    - Nparent: index of each parent added to the tree.
 		- N_leaves_list: List that given a node idx, stores for that idx, the number of leaves for the branch below that node. It is initialized only with the tree leaves
 	    - linkage_list: linkage list to build heat clustermap visualizations.
@@ -388,55 +415,48 @@ def logLHMaxLevel(
 	      Linkage list format: A  (n - 1) by 4 matrix Z is returned. At the i-th iteration, clusters with indices Z[i, 0] and Z[i, 1] are combined to form cluster (n + 1) . A cluster with an index less than n  corresponds to one of the n original observations. The distance between clusters Z[i, 0] and Z[i, 1] is given by Z[i, 2]. The fourth value Z[i, 3] represents the number of original observations in the newly formed cluster.
 	    - delta_min: pT cut scale for the showering process to stop.
 		- lam: decaying rate value for the exponential distribution.
+		- backend: likelihood backend used to score the pairings (see likelihood_invM.getBackend).
 
 	"""
 
+	backend = likelihood.getBackend(backend)
 
-	""" 
-	right: Index of the pair that gives the max logLH, also the index of the right node to be removed from the idx list.
-	We do not consider the 1st entry to find the max log LH pairing, because all the pairings of that node are considered by the nodes to the right. This way we do not need to update the 1st node NN when the NN is clustered with some other node. 
-	This avoids getting an error. Reason: when Delta_Parent<Delta_cut that pairing is not viable within our model, thus we give it a logLH = - Infinity. However, we also had set to (- infinity) the node with idx=0 and the 1st node of NNpairs at each level (only when we had to update its NN).
-	Thus, (especially toward the top of the tree), it can happen that all the options have logLH= - Infinity, choosing the 1st entry on the NNpairs list. The problem is that this entry sometimes has as the NN a node that is missing (was already clustered) because, as mentioned, we do not update that node NN.
 	"""
+	rightIdx: node that gives the max logLH pairing with its NN (leftIdx). If there is a tie, we keep the 1st node.
+	Pop the heap until we get an entry that is up to date (the node was not merged and its NN did not change since the entry was pushed).
+	"""
+	while True:
+		_, rightIdx, version = heapq.heappop(NNheap)
+		if active[rightIdx] and version == NNversion[rightIdx]:
+			break
 
-	logger.debug(f" maxPairLogLH, maxPairIdx = {max(NNpairs[1::], key=lambda x: x[0])}")
-	logger.debug(f" NNpairs = {NNpairs}")
-	right = NNpairs.index(max(NNpairs[1::], key=lambda x: x[0]))
-
-
-	""" Remove nodes pair with max logLH """
-	maxPairLogLH, maxPairIdx = NNpairs.pop(right)
-
-	leftIdx = maxPairIdx[1]
-	rightIdx = maxPairIdx[0]
-
-
-	""" Index of the left node to be removed """
-	left = [entry[1][0] for entry in NNpairs].index(leftIdx)
-	logger.debug(f" (lef,right) = {left,right}")
-	logger.debug(f" left idxs list = {[entry[1][0] for entry in NNpairs]}")
+	rightIdx = int(rightIdx)
+	leftIdx = int(NNidx[rightIdx])
+	maxPairLogLH = NNlogLH[rightIdx]
 
-	NNpairs.pop(left)
+	logger.debug(f" maxPairLogLH, maxPairIdx = {maxPairLogLH, [rightIdx, leftIdx]}")
 
 
+	""" Update active nodes, idx, nodeContent, nodeDeltas, jetContent, N_leaves_list, linkage_list, jetTree and logLH lists """
+	active[leftIdx] = False
+	active[rightIdx] = False
+	NNversion[leftIdx] += 1
+	NNversion[rightIdx] += 1
 
-	""" Update levelDeltas, idx, levelContent, jetContent, N_leaves_list, linkage_list, jetTree and logLH lists """
-	idx.pop(right)
-	idx.pop(left)
+	idx.remove(rightIdx)
+	idx.remove(leftIdx)
 	idx.append(Nparent)
 
-	rightContent = levelContent.pop(right)
-	leftContent = levelContent.pop(left)
+	leftContent = nodeContent[leftIdx]
+	rightContent = nodeContent[rightIdx]
 
 	newNode = np.sum([leftContent,rightContent],axis = 0)
-	levelContent.append(newNode)
+	nodeContent[Nparent] = newNode
 	jetContent.append(newNode)
 
 	"""Calculate parent mass squared"""
 	newDelta = likelihood.get_delta_LR(leftContent,rightContent)
-	levelDeltas.pop(right)
-	levelDeltas.pop(left)
-	levelDeltas.append(newDelta)
+	nodeDeltas[Nparent] = newDelta
 
 	N_leaves_list.append(N_leaves_list[leftIdx] + N_leaves_list[rightIdx])
 
@@ -448,74 +468,41 @@ def logLHMaxLevel(
 	logger.debug(f" Per level logLH  = {logLH}")
 
 
-	""" Find if any other node had one of the merged nodes as its NN """
-	NNidxUpdate = [i for i, entry in enumerate(NNpairs) if (entry[1][1] == leftIdx or entry[1][1] == rightIdx)]
-	logger.debug(f" NNpairs after pop = {NNpairs}")
-	if NNidxUpdate!=[]:
-
-		logger.debug(f" Indices that need to get the NN updated = {NNidxUpdate}")
-		logger.debug(f" First entry of NNpairs = {NNpairs[0]}")
-
-		if NNidxUpdate[0]==0:
-			""" Do not update the 1st entry NN, but set the logLH = - Infinity. All the pairings of the 1st element of the list are taken into account by the elements to the right"""
-			NNpairs[NNidxUpdate[0]] = (-np.inf, NNpairs[NNidxUpdate[0]][1])
-			NNidxUpdate = NNidxUpdate[1::]
-
-		NNpairsUpdate = [
-			max(
-				[
-					(
-						likelihood.split_logLH(
-							levelContent[k],
-							levelDeltas[k],
-							levelContent[k - j],
-							levelDeltas[k - j],
-							delta_min,
-							lam
-						),
-						[idx[k], idx[k - j]]
-					)
-					for j in range(k, 0, -1)
-				],
-				key=lambda x: x[0]
-			)
-			for k in NNidxUpdate
-		]
-
-		for i,entry in enumerate(NNidxUpdate):
-			NNpairs[entry] = NNpairsUpdate[i]
-			logger.debug(f" i,entry = {i,entry}")
-			logger.debug(f" NNpairs after updating = {NNpairs}")
-
-
-	logger.debug(f"-----"*5)
-	logger.debug(f" idx = {idx}")
-	logger.debug(f" levelContent = {levelContent}")
-
-	""" Find merged node NN and append to list """
-	if len(levelContent)>1:
-		NewNodeNN = max(
-			[
-				(
-					likelihood.split_logLH(
-						newNode,
-						newDelta,
-						levelContent[j],
-						levelDeltas[j],
-						delta_min,
-						lam
-					),
-					[Nparent, idx[j]]
-				)
-				for j in range(len(levelContent)-1)
-			],
-			key=lambda x: x[0]
+	""" Find if any other node had one of the merged nodes as its NN and refresh its NN from the pairings matrix (no new log likelihood evaluations needed) """
+	levelNodes = np.flatnonzero(active)
+	NNidxUpdate = levelNodes[(NNidx[levelNodes] == leftIdx) | (NNidx[levelNodes] == rightIdx)]
+	logger.debug(f" Nodes that need to get the NN updated = {NNidxUpdate}")
+
+	for node in NNidxUpdate:
+		NNidx[node], NNlogLH[node] = _leftNN(pairLogLH, node, levelNodes[levelNodes < node])
+		NNversion[node] += 1
+		if NNidx[node] != -1:
+			heapq.heappush(NNheap, (- NNlogLH[node], node, NNversion[node]))
+
+
+	""" Fill the merged node row/column of the pairings matrix and find its NN """
+	if len(levelNodes)>0:
+
+		newNodePairs = backend.split_logLH_batch(
+			np.broadcast_to(newNode, (len(levelNodes), 4)),
+			np.full(len(levelNodes), newDelta),
+			nodeContent[levelNodes],
+			nodeDeltas[levelNodes],
+			delta_min,
+			lam,
 		)
+		pairLogLH[Nparent, levelNodes] = newNodePairs
+		pairLogLH[levelNodes, Nparent] = newNodePairs
 
-		NNpairs.append(NewNodeNN)
+		""" If there is a tie, keep the 1st node """
+		best = np.argmax(newNodePairs)
+		NNidx[Nparent] = levelNodes[best]
+		NNlogLH[Nparent] = newNodePairs[best]
+		heapq.heappush(NNheap, (- NNlogLH[Nparent], Nparent, NNversion[Nparent]))
 
-		logger.debug(f" NNpairs after adding merged node = {NNpairs}")
+		logger.debug(f" Merged node NN = {NNlogLH[Nparent], [Nparent, NNidx[Nparent]]}")
 
+	active[Nparent] = True
 
 
 
@@ -533,7 +520,7 @@ def _traverse(
         dendrogram=True,
 ):
 	"""
-    This function call the recursive function _traverse_rec to make the trees starting from the root
+    This function builds the tree starting from the root, with the node ids relabeled in preorder (see treeKernels.relabelPreorder)
     :param root: root node id
     :param jetContent: array with the momentum of all the nodes of the jet tree (both leaves and inners).
     :param jetTree: dictionary that has the node id of a parent as a key and a list with the id of the 2 children as the values
@@ -549,150 +536,10 @@ def _traverse(
 
     """
 
-	tree = []
-	content = []
-	node_id = []
-	tree_ancestors = []
-
-	_traverse_rec(
-    root,
-    -1,
-    False,
-    tree,
-    content,
-    jetContent,
-    jetTree=jetTree,
-    Nleaves=Nleaves,
-    node_id=node_id,
-    ancestors=[],
-    tree_ancestors=tree_ancestors,
-    dendrogram=dendrogram,
-    )
-
-	return tree, content, node_id, tree_ancestors
-
-
-
-
-
-
-def _traverse_rec(
-        root,
-        parent_id,
-        is_left,
-        tree,
-        content,
-        jetContent,
-        jetTree=None,
-        Nleaves=None,
-        node_id=None,
-        ancestors=None,
-        tree_ancestors=[],
-        dendrogram=False,
-):
-	"""
-	Recursive function to build the jet tree structure.
-	:param root: parent node momentum
-	:param parent_id: parent node idx
-	:param is_left: bool.
-	:param tree: List with the tree
-	:param content: List with the momentum vectors
-	:param jetContent: array with the momentum of all the nodes of the jet tree (both leaves and inners).
-	:param jetTree: dictionary that has the node id of a parent as a key and a list with the id of the 2 children as the values
-	:param Nleaves: Number of constituents (leaves)
-	:param node_id: list where leaves idxs are added in the order they appear when we traverse the reclustered tree (each number indicates the node id
-	that we picked when we did the reclustering.). However, the idx value specifies the order in which the leaf nodes appear when traversing the truth level jet . The value here is an integer between 0 and Nleaves.
-	So if we went from truth to kt algorithm, then in the truth tree the leaves go as [0,1,2,3,4,,...,Nleaves-1]
-	:param ancestors: 1 entry of tree_ancestors (there is one for each leaf of the tree). It is appended to tree_ancestors.
-	:param tree_ancestors: List with one entry for each leaf of the tree, where each entry lists all the ancestor node ids when traversing the tree from the root to the leaf node.
-	:param dendrogram: bool. If True, append ancestors to tree_ancestors list.
-	"""
-
-	""""
-	(With each momentum vector we increase the content array by one element and the tree array by 2 elements. 
-	But then we take id=tree.size()//2, so the id increases by 1.)
-	"""
-	id = len(tree) // 2
-
-	if parent_id >= 0:
-		if is_left:
-
-			"""Insert in the tree list, the location of the lef child in the content array."""
-			tree[2 * parent_id] = id
-		else:
-
-			"""Insert in the tree list, the location of the right child in the content array."""
-			tree[2 * parent_id + 1] = id
-
-
-	"""Insert 2 new nodes to the vector that constitutes the tree. If the current node is a parent, then we will replace the -1 with its children idx in the content array"""
-	tree.append(-1)
-	tree.append(-1)
-
-
-	""" Append node momentum to content list """
-	content.append(jetContent[root])
-
-
-	""" Fill node ancestors list """
-	new_ancestors = None
-	if dendrogram:
-		new_ancestors = np.copy(ancestors)
-		logger.debug(f" ancestors before = {ancestors}")
-
-		new_ancestors = np.append(new_ancestors, root)
-		logger.debug(f" ancestors after = {ancestors}")
-
-
-	""" Move from the root down recursively until we get to the leaves. """
-	if root >= Nleaves:
-
-		children = jetTree[root]
-
-		logger.debug(f"Children = {children}")
-
-		L_idx = children[0]
-		R_idx = children[1]
-
-
-		_traverse_rec(L_idx, id,
-                      True,
-                      tree,
-                      content,
-                      jetContent,
-                      jetTree,
-                      Nleaves=Nleaves,
-                      node_id=node_id,
-                      ancestors=new_ancestors,
-                      dendrogram=dendrogram,
-                      tree_ancestors=tree_ancestors,
-                      )
-
-		_traverse_rec(R_idx,
-                      id,
-                      False,
-                      tree,
-                      content,
-                      jetContent,
-                      jetTree,
-                      Nleaves=Nleaves,
-                      node_id=node_id,
-                      ancestors=new_ancestors,
-                      dendrogram=dendrogram,
-                      tree_ancestors=tree_ancestors,
-                      )
-
-
-
-	else:
-		""" If the node is a leaf, then append idx to node_id and its ancestors as a new row of tree_ancestors """
-
-		node_id.append(root)
-
-		if dendrogram:
-
-			tree_ancestors.append(new_ancestors)
-			logger.debug(f"tree_ancestors= {tree_ancestors}")
-
-
-
+	return treeKernels.relabelPreorder(
+		root,
+		jetContent,
+		jetTree,
+		Nleaves,
+		dendrogram=dendrogram,
+	)
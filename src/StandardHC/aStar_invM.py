@@ -0,0 +1,439 @@
+import numpy as np
+import logging
+import pickle
+import heapq
+import time
+
+from . import likelihood_invM as likelihood
+from . import N2Greedy_invM as N2Greedy
+from . import auxFunctions_invM as auxFunctions
+
+from .utils import get_logger
+
+logger = get_logger(level=logging.INFO)
+
+
+"""
+Best-first (A*) search for the maximum likelihood tree:
+Each state is a forest (the set of nodes of the current level, each node a bitmask of its leaves) reached after some merges with accumulated log likelihood g.
+States are expanded in decreasing order of f = g + h, where h is an upper bound of the log likelihood of the remaining merges (admissible heuristic):
+every node of the remaining tree except the root is a child exactly once, so
+	h = sum over the current nodes of their child bound + (k-2) x child bound of a future node + (k-1) x log(1/(4 pi))
+with k the number of current nodes (see likelihood_invM.split_logLH_child_bound), plus the largest increase of the bound of two nodes as children of the root (lamRoot). A future node is the union of at least 2 current nodes,
+so its invariant mass is at least the smallest invariant mass of a pair of current nodes (for physical, i.e. timelike, momenta).
+
+The best complete tree found so far (incumbent) starts from a greedy completion and is improved by greedy completions of the expanded states along the search.
+States that can not beat the incumbent (f <= incumbent) are dropped, and the search stops when the best state in the queue can not beat it (the incumbent is optimal)
+or when the expanded states reach the node budget (anytime mode: the incumbent is returned with the upper bound of the queue).
+Forests reached by different merge orders are the same state, so only the one with the best g is kept.
+"""
+
+
+def recluster(
+		input_jet,
+		save = False,
+		delta_min = None,
+		lam = None,
+		nodeBudget = 10000,
+		diveEvery = 50,
+		visualize = False,
+		backend = None,
+):
+	"""
+	Get the leaves of an input jet, run the best-first search and create the jet dictionary for the best tree found.
+
+	New features added to the tree (besides the ones of N2Greedy_invM.recluster):
+		- jet["maxLogLH"]: log likelihood of the tree in the model of the backend (the search objective).
+		- jet["logLHUpperBound"]: upper bound of the log likelihood of the best tree (equal to maxLogLH if the tree is optimal).
+		- jet["optimal"]: True if the tree is proven to be the maximum likelihood tree.
+		- jet["Nexpanded"]: number of expanded states.
+
+	Args:
+		- input_jet: any jet dictionary with the clustering history.
+		- delta_min: pT cut scale for the showering process to stop.
+		- lam: decaying rate value for the exponential distribution.
+		- nodeBudget: max number of states to expand. When it is reached, return the best tree found so far.
+		- diveEvery: run a greedy completion of every diveEvery-th expanded state to improve the incumbent (None to only run it for the initial state).
+		- visualize: if true, calculate extra features needed for the visualizations and add them to the tree dictionary.
+		- backend: likelihood backend used to score the pairings (see likelihood_invM.getBackend). Default: stop / non-stop model (fast backend).
+		- save: if true, save the reclustered jet dictionary
+
+	Returns:
+		- jet dictionary
+	"""
+	startTime = time.time()
+
+	jet_const = N2Greedy.getConstituents(
+		input_jet,
+		input_jet["root_id"],
+		[],
+	)
+	Nconst = len(jet_const)
+
+	jetTree, \
+	jetContent, \
+	root_node, \
+	logLH, \
+	search = aStar(
+		jet_const,
+		delta_min = delta_min,
+		lam = lam,
+		lamRoot = float(input_jet["LambdaRoot"]),
+		nodeBudget = nodeBudget,
+		diveEvery = diveEvery,
+		backend = backend,
+	)
+
+	tree, \
+	content, \
+	node_id, \
+	tree_ancestors = N2Greedy._traverse(
+		root_node,
+		jetContent,
+		jetTree=jetTree,
+		Nleaves=Nconst,
+	)
+
+	jet = {}
+	jet["root_id"] = 0
+	jet["node_id"] = node_id
+	jet["tree"] = np.asarray(tree).reshape(-1, 2)
+	jet["content"] = np.asarray(content).reshape(-1, 4)
+	jet["Nconst"] = Nconst
+	jet["algorithm"] = "aStar"
+	jet["M_Hard"] = float(input_jet["M_Hard"])
+	jet["pt_cut"] = delta_min
+	jet["Lambda"] = lam
+	jet["LambdaRoot"] = float(input_jet["LambdaRoot"])
+	jet["logLH"] = np.asarray(logLH)
+	jet["maxLogLH"] = search["logLH"]
+	jet["logLHUpperBound"] = search["upperBound"]
+	jet["optimal"] = search["optimal"]
+	jet["Nexpanded"] = search["Nexpanded"]
+
+	""" Extra features needed for visualizations """
+	if visualize:
+		jet["tree_ancestors"] = tree_ancestors
+
+	""" Fill deltas list (needed to fill the jet log LH)"""
+	jet = likelihood.fill_jet_info(jet, parent_id=None)
+
+	"""Fill jet dictionaries with log likelihood of truth jet"""
+	jet = likelihood.enrich_jet_logLH(jet, dij=True)
+
+	""" Angular quantities"""
+	ConstPhi, PhiDelta, PhiDeltaListRel = auxFunctions.traversePhi(jet, jet["root_id"], [], [], [])
+	jet["ConstPhi"] = ConstPhi
+	jet["PhiDelta"] = PhiDelta
+	jet["PhiDeltaRel"] = PhiDeltaListRel
+
+	logger.debug(f" A* total time = {time.time() - startTime}")
+
+	""" Save reclustered tree """
+	if save:
+		out_dir = "data/"
+		out_filename = out_dir + str(input_jet["name"]) + '_aStar.pkl'
+		logger.info(f"Output jet filename = {out_filename}")
+		with open(out_filename, "wb") as f:
+			pickle.dump(jet, f, protocol=2)
+
+	return jet
+
+
+
+
+class forestScorer(object):
+	"""
+	Momentum, delta and child bound of the nodes (keyed by the bitmask of their leaves) and log likelihood of the pairings, shared by all the states of one search.
+	Each pairing is only scored once, in batches with the likelihood backend.
+
+	Args:
+		- leaves: array of shape (N, 4) with the jet constituents.
+		- delta_min, lam, lamRoot: model parameters (lamRoot is used for the pairings whose parent is the root, i.e. has all the leaves).
+		- backend: likelihoodBackend object.
+	"""
+
+	def __init__(self, leaves, delta_min, lam, lamRoot, backend):
+		self.delta_min = delta_min
+		self.lam = lam
+		self.lamRoot = lam if lamRoot is None else lamRoot
+		self.backend = backend
+		self.full = 2 ** len(leaves) - 1
+
+		self.content = {1 << i: leaves[i] for i in range(len(leaves))}
+		self.deltas = {1 << i: 0. for i in range(len(leaves))}
+		self.bounds = {}
+		self.pairs = {}
+
+		self.logAngular = np.log(1 / (4 * np.pi))
+
+	def addNode(self, a, b):
+		""" Add the node that merges a and b """
+		node = a | b
+		if node not in self.content:
+			self.content[node] = self.content[a] + self.content[b]
+			self.deltas[node] = likelihood.get_delta_LR(self.content[a], self.content[b])
+		return node
+
+	def boundT(self, node):
+		""" Node delta (legacy model) or invariant mass squared, for split_logLH_child_bound """
+		if self.backend.model == "legacy":
+			return self.deltas[node]
+		return likelihood.get_invM_batch(self.content[node])[0]
+
+	def childBound(self, t):
+		""" Child bound as a child of a splitting with lam and as a child of the root splitting (lamRoot) """
+		return (
+			likelihood.split_logLH_child_bound(t, self.delta_min, self.lam, self.backend.model)[()],
+			likelihood.split_logLH_child_bound(t, self.delta_min, self.lamRoot, self.backend.model)[()],
+		)
+
+	def nodeBound(self, node):
+		if node not in self.bounds:
+			self.bounds[node] = self.childBound(self.boundT(node))
+		return self.bounds[node]
+
+	def futureBound(self, tFuture):
+		"""
+		Child bounds of a node with invariant mass at least tFuture. The bounds decrease with t, except for the jump at t_cut (stop / non-stop model).
+		"""
+		tFuture = max(tFuture, 0.)
+		if tFuture == 0:
+			return np.inf, np.inf
+		above = np.nextafter(max(tFuture, self.delta_min), np.inf)
+		return tuple(np.maximum(self.childBound(tFuture), self.childBound(above)))
+
+	def heuristic(self, active, tFuture):
+		"""
+		Upper bound of the log likelihood of the remaining merges of a forest: every node of the remaining tree except the root is a child once,
+		with the lam bound, plus the largest increase (lamRoot bound - lam bound) for the two children of the root.
+		"""
+		k = len(active)
+		if k < 2:
+			return 0.
+
+		bounds = [self.nodeBound(node) for node in active]
+		if k > 2:
+			bounds += [self.futureBound(tFuture)] * min(k - 2, 2)
+
+		rootIncrease = sorted(root - other for other, root in bounds)[-2:]
+
+		bound = sum(other for other, _ in bounds[:k]) + sum(rootIncrease) + (k - 1) * self.logAngular
+		if k > 2:
+			bound += (k - 2) * bounds[-1][0]
+		return bound
+
+	def scorePairs(self, pairs):
+		"""
+		Log likelihood of each (a, b) pairing (a < b), scoring the new ones in one batch.
+
+		Returns:
+			- logLH: array with the log likelihood of each pairing.
+		"""
+		new = [pair for pair in pairs if pair not in self.pairs]
+		if new:
+			a = [pair[0] for pair in new]
+			b = [pair[1] for pair in new]
+			lam = np.where(np.asarray([x | y for x, y in new]) == self.full, self.lamRoot, self.lam)
+			scores = self.backend.split_logLH_batch(
+				np.asarray([self.content[x] for x in b]).reshape(-1, 4),
+				np.asarray([self.deltas[x] for x in b]),
+				np.asarray([self.content[x] for x in a]).reshape(-1, 4),
+				np.asarray([self.deltas[x] for x in a]),
+				self.delta_min,
+				lam,
+			)
+			self.pairs.update(zip(new, scores.tolist()))
+
+		return np.asarray([self.pairs[pair] for pair in pairs])
+
+	def pairMasses(self, pairs):
+		""" Invariant mass squared of the union of each pairing (nodes do not need to be added) """
+		pL = np.asarray([self.content[a] for a, _ in pairs]).reshape(-1, 4)
+		pR = np.asarray([self.content[b] for _, b in pairs]).reshape(-1, 4)
+		return likelihood.get_delta_LR_batch(pL, pR)
+
+
+
+
+def _greedyDive(scorer, active):
+	"""
+	Complete a forest greedily (merge the max logLH pairing at each level).
+
+	Returns:
+		- merges: list of (a, b, logLH) merges.
+		- logLH: sum of the log likelihood of the merges.
+	"""
+	active = list(active)
+	merges = []
+	total = 0.
+	while len(active) > 1:
+		pairs = [(a, b) for i, b in enumerate(active) for a in active[:i]]
+		scores = scorer.scorePairs(pairs)
+		best = int(np.argmax(scores))
+		a, b = pairs[best]
+		merges.append((a, b, scores[best]))
+		total += scores[best]
+		active.remove(a)
+		active.remove(b)
+		active.append(scorer.addNode(a, b))
+	return merges, total
+
+
+
+
+def aStar(
+		levelContent,
+		delta_min = None,
+		lam = None,
+		lamRoot = None,
+		nodeBudget = 10000,
+		diveEvery = 50,
+		backend = None,
+):
+	"""
+	Runs the best-first search over the jet constituents.
+
+	Args:
+		- levelContent: jet constituents (i.e. the leaves of the tree)
+		- delta_min: pT cut scale for the showering process to stop.
+		- lam: decaying rate value for the exponential distribution.
+		- lamRoot: decaying rate value for the root splitting.
+		- nodeBudget: max number of states to expand.
+		- diveEvery: run a greedy completion of every diveEvery-th expanded state (None to only run it for the initial state).
+		- backend: likelihood backend used to score the pairings (name or likelihood_invM.likelihoodBackend object). Default: stop / non-stop model (fast backend).
+
+	Returns:
+		- jetTree: list with the [left, right] children of each node of the clustering history (leaves 0, ..., N-1, then the inner nodes in the order they are merged).
+		- jetContent: list with the momentum of all the nodes of the clustering history.
+		- root_node: root node id
+		- logLH: list with the log likelihood of each merge, in the order of the inner nodes.
+		- search: dictionary with the search results: "logLH" (log likelihood of the tree), "upperBound" (upper bound of the best log likelihood),
+		  "optimal" (True if the tree is proven optimal) and "Nexpanded" (number of expanded states).
+	"""
+
+	backend = likelihood.getBackend(backend)
+
+	leaves = np.asarray(levelContent, dtype=float).reshape(-1, 4)
+	Nconst = len(leaves)
+	scorer = forestScorer(leaves, delta_min, lam, lamRoot, backend)
+
+	""" States: (active nodes, g, parent state, (a, b, logLH) merge from the parent state) """
+	root = tuple(1 << i for i in range(Nconst))
+	states = [(root, 0., -1, None)]
+
+	def path(stateId):
+		merges = []
+		while states[stateId][2] != -1:
+			merges.append(states[stateId][3])
+			stateId = states[stateId][2]
+		return merges[::-1]
+
+	""" Incumbent: greedy completion of the initial state """
+	diveMerges, incumbentLogLH = _greedyDive(scorer, root)
+	incumbent = list(diveMerges)
+
+	heap = [(- np.inf, 0, 0)]
+	bestG = {root: 0.}
+	Nexpanded = 0
+	optimal = False
+	upperBound = incumbentLogLH
+	counter = 1
+
+	while heap:
+
+		negF, _, stateId = heapq.heappop(heap)
+		active, g, _, _ = states[stateId]
+
+		if bestG.get(active, - np.inf) > g:
+			continue
+
+		if -negF <= incumbentLogLH:
+			""" No state in the queue can beat the incumbent """
+			optimal = True
+			break
+
+		if len(active) == 1:
+			incumbentLogLH = g
+			incumbent = path(stateId)
+			optimal = True
+			break
+
+		if Nexpanded >= nodeBudget:
+			heapq.heappush(heap, (negF, 0, stateId))
+			break
+
+		Nexpanded += 1
+
+		""" Score all the pairings of the forest, and get the invariant mass lower bound for the future nodes """
+		pairs = [(a, b) for i, b in enumerate(active) for a in active[:i]]
+		scores = scorer.scorePairs(pairs)
+
+		inv = likelihood.get_invM_batch(np.asarray([scorer.content[node] for node in active]))
+		tFuture = np.min(scorer.pairMasses(pairs)) if np.all(inv >= 0) else 0.
+
+		if diveEvery is not None and Nexpanded % diveEvery == 0:
+			diveMerges, diveLogLH = _greedyDive(scorer, active)
+			if g + diveLogLH > incumbentLogLH:
+				incumbentLogLH = g + diveLogLH
+				incumbent = path(stateId) + diveMerges
+				logger.debug(f" New incumbent from a greedy completion = {incumbentLogLH}")
+
+		for (a, b), score in zip(pairs, scores.tolist()):
+			if score == - np.inf:
+				continue
+
+			node = scorer.addNode(a, b)
+			childActive = tuple(sorted([x for x in active if x != a and x != b] + [node]))
+			childG = g + score
+
+			if childG <= bestG.get(childActive, - np.inf):
+				continue
+
+			childF = childG + scorer.heuristic(childActive, tFuture)
+			if childF <= incumbentLogLH:
+				continue
+
+			bestG[childActive] = childG
+			states.append((childActive, childG, stateId, (a, b, score)))
+
+			if len(childActive) == 1 and childG > incumbentLogLH:
+				incumbentLogLH = childG
+				incumbent = path(len(states) - 1)
+
+			heapq.heappush(heap, (- childF, counter, len(states) - 1))
+			counter += 1
+
+	else:
+		""" The queue is empty: every state was expanded or dropped """
+		optimal = True
+
+	if optimal:
+		upperBound = incumbentLogLH
+	else:
+		upperBound = max(incumbentLogLH, - heap[0][0])
+
+	logger.debug(f" A* expanded states = {Nexpanded}, logLH = {incumbentLogLH}, upper bound = {upperBound}, optimal = {optimal}")
+
+	""" Build the clustering history of the incumbent """
+	jetTree = [[-1, -1] for _ in range(Nconst)]
+	jetContent = [leaves[i] for i in range(Nconst)]
+	nodeId = {1 << i: i for i in range(Nconst)}
+	logLH = []
+	for a, b, score in incumbent:
+		node = scorer.addNode(a, b)
+		nodeId[node] = len(jetContent)
+		jetTree.append([nodeId[a], nodeId[b]])
+		jetContent.append(scorer.content[node])
+		logLH.append(score)
+
+	root_node = nodeId[scorer.full]
+
+	search = {
+		"logLH": incumbentLogLH,
+		"upperBound": upperBound,
+		"optimal": optimal,
+		"Nexpanded": Nexpanded,
+	}
+
+	return jetTree, jetContent, root_node, logLH, search
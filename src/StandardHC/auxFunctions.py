@@ -22,6 +22,7 @@ from matplotlib import gridspec
 
 # from . import likelihood
 
+from . import treeKernels
 from .utils import get_logger
 
 logger = get_logger(level=logging.INFO)
@@ -410,48 +411,34 @@ def scanJets(DicList, angles=False, dijmetrics=False):
 
 def traversePhi(jet, node_id, constPhiList, PhiDeltaList, PhiDeltaListRel):
     """
-    Recursive function that traverses the tree. Gets leaves angle phi, and delta_parent phi angle for all parents in the tree.
+    Traverse the tree in preorder (see treeKernels.preorder). Gets leaves angle phi, and delta_parent phi angle for all parents in the tree.
     """
 
-    if jet["tree"][node_id, 0] == -1:
+    for node_id in treeKernels.preorder(jet["tree"], node_id).tolist():
 
-        constPhi = np.arctan2(jet["content"][node_id][0], jet["content"][node_id][1])
-        constPhiList.append(constPhi)
+        if jet["tree"][node_id, 0] == -1:
 
-    else:
+            constPhi = np.arctan2(jet["content"][node_id][0], jet["content"][node_id][1])
+            constPhiList.append(constPhi)
 
-        """ Get angle for the splitting value Delta """
-        idL = jet["tree"][node_id][0]
-        idR = jet["tree"][node_id][1]
-        pL = jet["content"][idL]
-        pR = jet["content"][idR]
+        else:
 
-        delta_vec = (pR - pL) / 2
+            """ Get angle for the splitting value Delta """
+            idL = jet["tree"][node_id][0]
+            idR = jet["tree"][node_id][1]
+            pL = jet["content"][idL]
+            pR = jet["content"][idR]
 
-        """ Find subjet angle"""
-        PhiPseudoJet = np.arctan2(jet["content"][node_id][0], jet["content"][node_id][1])
+            delta_vec = (pR - pL) / 2
 
-        """ arctan2 to find the right quadrant"""
-        TempDeltaPhi = np.arctan2(delta_vec[0], delta_vec[1])
-        PhiDeltaList.append(TempDeltaPhi)
-
-        PhiDeltaListRel.append( abs(TempDeltaPhi - PhiPseudoJet))
-
-        traversePhi(
-            jet,
-            jet["tree"][node_id, 0],
-            constPhiList,
-            PhiDeltaList,
-            PhiDeltaListRel,
-        )
-
-        traversePhi(
-            jet,
-            jet["tree"][node_id, 1],
-            constPhiList,
-            PhiDeltaList,
-            PhiDeltaListRel,
-        )
+            """ Find subjet angle"""
+            PhiPseudoJet = np.arctan2(jet["content"][node_id][0], jet["content"][node_id][1])
+
+            """ arctan2 to find the right quadrant"""
+            TempDeltaPhi = np.arctan2(delta_vec[0], delta_vec[1])
+            PhiDeltaList.append(TempDeltaPhi)
+
+            PhiDeltaListRel.append( abs(TempDeltaPhi - PhiPseudoJet))
 
     return constPhiList, PhiDeltaList, PhiDeltaListRel
 
@@ -535,42 +522,29 @@ def treeImbalance(jet, node_id, w, node_idLevel):
 
 def mainTraverse(jet, node_id, inners_list, Imbalance, Nlevel, w=None):
     """
-    Recursive function to get a list of the imbalance for all the branches of a tree (at all levels).
+    Get a list of the imbalance for all the branches of a tree (at all levels), visiting the nodes in preorder (see treeKernels.preorder).
     We weight the contribution of each level by a decaying exponential with rate w * the level number Nlevel
+    The number of constituents of each branch is computed once for all the nodes (see treeKernels.subtreeLeafCounts).
     """
-    #     inners_list.append(1)
-
-    Imbalance.append(np.exp(- w * Nlevel) * subjetConst(jet, node_id))
-
-    Nlevel += 1
-    #     print("Nlevel = ", Nlevel)
-
-    if jet["tree"][node_id, 0] != -1:
-
-        mainTraverse(
-            jet,
-            jet["tree"][node_id, 0],
-            inners_list,
-            Imbalance,
-            Nlevel,
-            w,
-        )
-
-        mainTraverse(
-            jet,
-            jet["tree"][node_id, 1],
-            inners_list,
-            Imbalance,
-            Nlevel,
-            w,
-        )
-
-        # Add all the inner nodes, except the ones whose both children are leaves.
-        # L = jet["tree"][node_id, 0]
-        # R = jet["tree"][node_id, 1]
-        #
-        # if jet["tree"][L, 0] != -1 and jet["tree"][R, 0] != -1:
-        inners_list.append(1)
+    tree = jet["tree"]
+    order = treeKernels.preorder(tree, node_id)
+    depth = treeKernels.depths(tree, node_id, order=order)
+    Nconst = treeKernels.subtreeLeafCounts(tree, node_id)
+
+    for node in order.tolist():
+
+        if tree[node, 0] != -1:
+            LConst = Nconst[tree[node, 0]]
+            RConst = Nconst[tree[node, 1]]
+            Im = abs(LConst - RConst) / (LConst + RConst)
+
+            # Add all the inner nodes
+            inners_list.append(1)
+        else:
+            """ Both branches of a leaf are the same node, so the imbalance is 0 """
+            Im = 0.
+
+        Imbalance.append(np.exp(- w * (Nlevel + depth[node])) * Im)
 
     return inners_list, Imbalance
 
@@ -595,26 +569,7 @@ def traverse(jet, node_id, outers_list, Nconst):
     """
     Traverse function to get the number of constituents of a branch
     """
-    if jet["tree"][node_id, 0] == -1:
-
-        Nconst.append(1)
-    #         print("Nconst = ", Nconst)
-    #         outers_list.append(jet["content"][node_id])
-
-    else:
-        traverse(
-            jet,
-            jet["tree"][node_id, 0],
-            outers_list,
-            Nconst,
-        )
-
-        traverse(
-            jet,
-            jet["tree"][node_id, 1],
-            outers_list,
-            Nconst,
-        )
+    Nconst.extend([1] * len(treeKernels.leaves(jet["tree"], node_id)))
 
     return len(Nconst)
 
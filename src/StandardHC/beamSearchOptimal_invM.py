@@ -7,6 +7,7 @@ import copy
 import heapq
 import time
 import bisect
+from collections import OrderedDict
 
 from . import likelihood_invM as likelihood
 from . import N2Greedy_invM as N2Greedy
@@ -21,64 +22,259 @@ logger = get_logger(level=logging.INFO)
 Beam search algorithm:
 1) Get all the possible pairings log likelihood for the leaves of the tree and sort them. O(N^2 logN)
 2) for each level:
-	for each beam get a list of size b (b is the beam size) with max log LH pairs. 
-	Sort the list => O (b^2 log b)
-	loop over the list and keep only one jet each time the total log LH value is repeated. O(b^2)
-	update each tree => O(b N^2 log N)
+	get the best b (b is the beam size) latent paths with a k-way merge (heap) over the already sorted pairings list of each beam,
+	keeping only one latent path for each tree => O (b log b)
+	update each tree: drop the pairings of the merged nodes and merge the (already sorted) remaining pairings with the sorted new node pairings => O(b N^2)
 	
-Total: O( b^2 N log b + b N^3 log N). Typically b > N, but for b log < N^2 log N,  we get O(b N^3 log N)
+Total: O( b N log b + b N^3) => O(b N^3)
 
 """
 
 
-class latentPath(object):
+"""####################################"""
+"""
+Canonical tree hashing:
+Each leaf i gets a fixed 64 bit hash and each inner node the hash of the (sorted) hashes of its children (Merkle tree), so the hash of a node
+only depends on the branch below it and not on the left/right order of the children.
+The hash of a forest is the sum of the hashes of its roots (mod 2^64), so it does not depend on the order in which the pairings were clustered and
+it is updated in O(1) when 2 nodes are merged: subtract the hashes of the children and add the hash of the parent.
+"""
+
+HASH_MASK = (1 << 64) - 1
+
+
+def mix64(x):
 	"""
-	Class that stores the jet dictionary information for each latent path included in the beam search algorithm:
+	splitmix64 finalizer: bijective mixing of a 64 bit integer.
+	"""
+	x = (x ^ (x >> 30)) * 0xbf58476d1ce4e5b9 & HASH_MASK
+	x = (x ^ (x >> 27)) * 0x94d049bb133111eb & HASH_MASK
+	return x ^ (x >> 31)
 
-		- levelContent: nodes list after deleting the constituents that are merged and adding the new pseudojet in each level.
-		  So this should only have the root of the tree at the end.
 
-		- levelDeltas: list with the delta value (for the splitting of a parent node) of each node. Zero if a leaf.
+def leafHash(i):
+	"""
+	Hash of leaf i.
+	"""
+	return mix64((i + 1) * 0x9e3779b97f4a7c15 & HASH_MASK)
 
-		- logLH: list with the log likelihood of each pairing.
 
-		- jetContent: array with the momentum of all the nodes of the jet tree (both leaves and inners).
+def nodeHash(leftHash, rightHash):
+	"""
+	Hash of the node from merging the nodes with hashes leftHash and rightHash. Symmetric in the children.
+	"""
+	if leftHash > rightHash:
+		leftHash, rightHash = rightHash, leftHash
+	return mix64(mix64(leftHash ^ 0x632be59bd9b4e019) ^ rightHash)
+
 
-		- tree_dic: dictionary that has the node id of a parent as a key and a list with the id of the 2 children as the values
+def forestHashUpdate(forestHash, leftHash, rightHash, parentHash):
+	"""
+	Forest hash after merging the roots with hashes leftHash and rightHash into a node with hash parentHash.
+	"""
+	return (forestHash - leftHash - rightHash + parentHash) & HASH_MASK
 
-		- idx: array that stores the node id
-		(the node id determines the location of the momentum vector of a pseudojet in the jet_content array)
-		of the pseudojets that are in the current content_level array. It has the same elements as the content_level (they get updated
-		level by level).
 
-		- N_leaves_list: List that given a node idx, stores for that idx, the number of leaves for the branch below that node. It is initialized only with the tree leaves
 
-		- linkage_list: linkage list to build heat clustermap visualizations.
+
+"""####################################"""
+class nodePool(object):
+	"""
+	Class that stores the momentum and delta of all the nodes created by the latent paths of the beam search algorithm in preallocated arrays, shared by all the latent paths.
+	The leaves are stored in the first Nconst rows and each new node gets the next row. There are at most beamSize new nodes per level, so we allocate Nconst + beamSize * (Nconst - 1) rows.
+
+		- content: array with the momentum of each node.
+
+		- deltas: array with the delta value (for the splitting of a parent node) of each node. Zero if a leaf.
+
+		- N_leaves: array with the number of leaves for the branch below each node.
+
+		- treeIdx: array with the node id of each node in the jet tree (the leaves keep their id, and the node clustered at level j gets the id Nconst + j).
+
+		- hashes: list with the canonical (Merkle-style) hash of the branch below each node, see nodeHash.
+
+		- leafBits: list with the set of leaves below each node, as a bitset (python int with bit i set for leaf i). Nodes with the same leaves have the same
+		  momentum and delta, whatever the branch below them, so this is the key of the pair likelihood cache (see pairCache).
+
+		- Nconst: Number of leaves.
+
+		- Nnodes: number of nodes stored.
 	"""
 
 	def __init__(
 			self,
-			path_sortPairs = None,
-			path_levelContent = None,
-			path_levelDeltas = None,
-			path_logLH = None,
-			path_jetTree = None,
-			path_jetContent =None,
-			path_idx = None,
-			path_N_leaves_list = None,
-			path_linkage_list = None,
+			levelContent = None,
+			beamSize = None,
+	):
+
+		self.Nconst = len(levelContent)
+		maxNodes = self.Nconst + beamSize * max(self.Nconst - 1, 0)
+
+		self.content = np.zeros((maxNodes, 4))
+		self.content[0:self.Nconst] = np.asarray(levelContent).reshape(-1, 4)
+		self.deltas = np.zeros(maxNodes)
+		self.N_leaves = np.zeros(maxNodes)
+		self.N_leaves[0:self.Nconst] = 1.
+		self.treeIdx = np.zeros(maxNodes, dtype=int)
+		self.treeIdx[0:self.Nconst] = np.arange(self.Nconst)
+		self.hashes = [leafHash(i) for i in range(self.Nconst)] + [0] * (maxNodes - self.Nconst)
+		self.leafBits = [1 << i for i in range(self.Nconst)] + [0] * (maxNodes - self.Nconst)
+		self.Nnodes = self.Nconst
+
+
+	def addNode(self, leftIdx, rightIdx, Nparent):
+		"""
+		Store the node from merging leftIdx and rightIdx, with id Nparent in the jet tree, and return its row.
+		"""
+		row = self.Nnodes
+
+		leftContent = self.content[leftIdx]
+		rightContent = self.content[rightIdx]
 
+		self.content[row] = np.sum([leftContent, rightContent], axis=0)
+		self.deltas[row] = likelihood.get_delta_LR(leftContent, rightContent)
+		self.N_leaves[row] = self.N_leaves[leftIdx] + self.N_leaves[rightIdx]
+		self.treeIdx[row] = Nparent
+		self.hashes[row] = nodeHash(self.hashes[leftIdx], self.hashes[rightIdx])
+		self.leafBits[row] = self.leafBits[leftIdx] | self.leafBits[rightIdx]
+
+		self.Nnodes += 1
+
+		return row
+
+
+
+
+class pairCache(object):
+	"""
+	Least recently used (LRU) cache of the pairings log likelihood, shared by all the latent paths of one beam search (one jet).
+	Different latent paths keep clustering the same nodes, so the same (new node, node) pairings are scored again and again in updateLevelPaths.
+	A pairing is identified by the leaves of each node (nodePool.leafBits) and lam, so it is found again even if the branches below the nodes are different.
+	The cached value is the one of the first latent path that scored the pairing, which only differs from recomputing it by the rounding of the node momentum sums.
+
+		- maxSize: max number of pairings stored. When it is reached, the least recently used pairing is dropped.
+
+		- table: OrderedDict with (new node leafBits, node leafBits, lam) as a key and the log likelihood as the value, in LRU order.
+
+		- hits, misses: number of pairings found / not found in the cache.
+	"""
+
+	def __init__(self, maxSize = 2 ** 18):
+
+		self.maxSize = maxSize
+		self.table = OrderedDict()
+		self.hits = 0
+		self.misses = 0
+
+
+	def split_logLH_batch(self, backend, nodes, newIdx, levelNodes, delta_min, lam):
+		"""
+		Log likelihood of the pairings of node newIdx with each node in levelNodes (nodePool rows). Only the pairings that are not in the cache are scored
+		with the backend, in one batch.
+		"""
+		table = self.table
+		newBits = nodes.leafBits[newIdx]
+		keys = [(newBits, nodes.leafBits[j], lam) for j in levelNodes.tolist()]
+
+		pairsLogLH = np.empty(len(keys))
+		missing = []
+		for k, key in enumerate(keys):
+			value = table.get(key)
+			if value is None:
+				missing.append(k)
+			else:
+				table.move_to_end(key)
+				pairsLogLH[k] = value
+
+		self.hits += len(keys) - len(missing)
+		self.misses += len(missing)
+
+		if missing:
+			missingNodes = levelNodes[missing]
+			pairsLogLH[missing] = backend.split_logLH_batch(
+				np.broadcast_to(nodes.content[newIdx], (len(missingNodes), 4)),
+				np.full(len(missingNodes), nodes.deltas[newIdx]),
+				nodes.content[missingNodes],
+				nodes.deltas[missingNodes],
+				delta_min,
+				lam,
+			)
+
+			for k in missing:
+				table[keys[k]] = pairsLogLH[k]
+
+			while len(table) > self.maxSize:
+				table.popitem(last=False)
+
+		return pairsLogLH
+
+
+
+
+
+
+class latentPath(object):
+	"""
+	Class that stores each latent path included in the beam search algorithm.
+	To avoid copying the tree for each latent path at every level, we only store the pairing added at the current level and a pointer to the predecessor latent path.
+	Node ids are rows of the nodePool arrays. The full tree is built with getPathTree (only for the final latent paths).
+
+		- nodes: nodePool shared by all the latent paths.
+
+		- predecessor: latentPath of the previous level (None for the initial path with the leaves only).
+
+		- mergedPair: [left node, right node, new node] ids of the pairing added at this level (None for the initial path).
+
+		- pairLogLH: log likelihood of the pairing added at this level.
+
+		- sumLogLH: total log likelihood of the latent path.
+
+		- forestHash: canonical hash of the forest of the latent path (sum of the hashes of the nodes in levelNodes, mod 2^64). It only depends on the forest,
+		  not on the order in which the pairings were clustered, and it is updated incrementally at each level (see forestHashUpdate).
+
+		- levelNodes: array with the ids of the nodes of the current level, i.e. after deleting the nodes that are merged and adding the new node in each level.
+		  So this should only have the root of the tree at the end.
+
+		- sortPairsLogLH: array with the log likelihood of all the pairings of the nodes in levelNodes, sorted in increasing order.
+
+		- sortPairsIdx: array of shape (P, 2) with the [node, node] ids of each pairing in sortPairsLogLH.
+		  sortPairsLogLH and sortPairsIdx are read-only, so they are shared by all the latent paths that come from the same predecessor
+		  until a new pairing is added (copy-on-write).
+
+	levelNodes, sortPairsLogLH and sortPairsIdx are only needed to build the next level, so they are released once it is built.
+	"""
+
+	def __init__(
+			self,
+			path_nodes = None,
+			path_predecessor = None,
+			path_mergedPair = None,
+			path_pairLogLH = None,
+			path_sumLogLH = None,
+			path_forestHash = None,
+			path_levelNodes = None,
+			path_sortPairsLogLH = None,
+			path_sortPairsIdx = None,
 	):
 
-		self.sortPairs = path_sortPairs
-		self.levelContent = path_levelContent
-		self.levelDeltas = path_levelDeltas
-		self.logLH = path_logLH
-		self.jetTree = path_jetTree
-		self.jetContent =path_jetContent
-		self.idx = path_idx
-		self.N_leaves_list = path_N_leaves_list
-		self.linkage_list = path_linkage_list
+		self.nodes = path_nodes
+		self.predecessor = path_predecessor
+		self.mergedPair = path_mergedPair
+		self.pairLogLH = path_pairLogLH
+		self.sumLogLH = path_sumLogLH
+		self.forestHash = path_forestHash
+		self.levelNodes = path_levelNodes
+		self.sortPairsLogLH = path_sortPairsLogLH
+		self.sortPairsIdx = path_sortPairsIdx
+
+
+	def release(self):
+		"""
+		Release the arrays that are only needed to build the next level.
+		"""
+		self.levelNodes = None
+		self.sortPairsLogLH = None
+		self.sortPairsIdx = None
 
 
 
@@ -93,6 +289,10 @@ def recluster(
 		beamSize = None,
 		N_best = None,
 		visualize = False,
+		backend = None,
+		timeBudget = None,
+		maxPaths = None,
+		cacheSize = 2 ** 18,
 ):
 	"""
 	Get the leaves of an  input jet,
@@ -113,6 +313,9 @@ def recluster(
 		- jet["linkage_list"]: linkage list to build heat clustermap visualizations.
 		- jet["Nconst"]: Number of leaves of the tree.
 		- jet["algorithm"]: Algorithm to generate the tree structure, e.g. truth, kt, antikt, CA.
+		- jet["budgetHit"]: True if the time budget or maxPaths changed the search (only if timeBudget or maxPaths are given).
+		- jet["greedyLevel"]: level where the search switched to greedy completion because of the time budget (None if it did not).
+		- jet["beamSizes"]: number of latent paths kept at each level.
 
 	Args:
 		- jet_dic: any jet dictionary with the clustering history.
@@ -127,10 +330,19 @@ def recluster(
 
 		- save: if true, save the reclustered jet dictionary list
 
+		- backend: likelihood backend used to score the pairings (see likelihood_invM.getBackend). Default: stop / non-stop model (fast backend).
+
+		- timeBudget: wall-clock budget in seconds for the search (see beamSearch). None for no budget.
+
+		- maxPaths: max number of latent paths kept in memory at each level (see beamSearch). None for no limit.
+
+		- cacheSize: max number of pairings in the pair likelihood cache shared by the latent paths (see pairCache). 0 or None to disable it.
+
 	Returns:
 		- jetsList: List of jet dictionaries
 	"""
 	startTime = time.time()
+	deadline = startTime + timeBudget if timeBudget is not None else None
 
 	""" Get jet constituents list (tree leaves) """
 	jet_const = N2Greedy.getConstituents(
@@ -143,13 +355,18 @@ def recluster(
 	reclustStartTime = time.time()
 
 	bestLogLH_paths, \
-	root_node = beamSearch(
+	root_node, \
+	budget = beamSearch(
 		jet_const,
 		delta_min = delta_min,
 		lam = lam,
 		beamSize = beamSize,
 		lamRoot = float(jet_dic["LambdaRoot"]),
-
+		backend = backend,
+		deadline = deadline,
+		maxPaths = maxPaths,
+		survivors = N_best if N_best is not None else 1,
+		cacheSize = cacheSize,
 	)
 
 
@@ -159,18 +376,29 @@ def recluster(
 
 	for path in bestLogLH_paths[0:N_best]:
 
+		jetTree, \
+		jetContent, \
+		N_leaves_list, \
+		linkage_list, \
+		logLH = getPathTree(path)
+
 		jet = {}
 		jet["root_id"] = root_node
-		jet["tree"] = np.asarray(path.jetTree).reshape(-1, 2)
-		jet["content"] = np.asarray(path.jetContent).reshape(-1, 4)
-		jet["linkage_list"]=path.linkage_list
+		jet["tree"] = np.asarray(jetTree).reshape(-1, 2)
+		jet["content"] = np.asarray(jetContent).reshape(-1, 4)
+		jet["linkage_list"]=linkage_list
 		jet["Nconst"]=len(jet_const)
 		jet["algorithm"]= "beamSearch"
 		jet["M_Hard"] = float(jet_dic["M_Hard"])
 		jet["pt_cut"] = delta_min
 		jet["Lambda"] = lam
 		jet["LambdaRoot"] = float(jet_dic["LambdaRoot"])
-		jet["logLH"] = np.asarray(path.logLH)
+		jet["logLH"] = np.asarray(logLH)
+
+		if timeBudget is not None or maxPaths is not None:
+			jet["budgetHit"] = budget["budgetHit"]
+			jet["greedyLevel"] = budget["greedyLevel"]
+			jet["beamSizes"] = budget["beamSizes"]
 
 
 		tree, \
@@ -178,8 +406,8 @@ def recluster(
 		node_id, \
 		tree_ancestors = N2Greedy._traverse(
 			root_node,
-			path.jetContent,
-			jetTree=path.jetTree,
+			jetContent,
+			jetTree=jetTree,
 			Nleaves=len(jet_const),
 		)
 
@@ -248,49 +476,84 @@ def beamSearch(
 		lam = None,
 		beamSize = None,
 		lamRoot  = None,
+		backend = None,
+		deadline = None,
+		maxPaths = None,
+		survivors = 1,
+		cacheSize = 2 ** 18,
 ):
 	"""
 	Runs a beam search algorithm to cluster the jet constituents
 
+	Anytime mode (deadline and/or maxPaths):
+		- maxPaths caps the number of latent paths kept in memory at each level, i.e. the beam size is min(beamSize, maxPaths).
+		- After each level, we estimate the time needed for the remaining levels from the time of the last one. If we would finish after the deadline, the beam size is halved.
+		- Once the deadline has passed, we keep the best survivors latent paths and finish each of them greedily (adding its best pairing at each level).
+
 	Args:
 		- levelContent: jet constituents (i.e. the leaves of the tree)
 		- beamSize: beam size for the beam search algorithm, i.e. it determines the number of trees latent path run in parallel and kept in memory
 		- delta_min: pT cut scale for the showering process to stop.
 		- lam: decaying rate value for the exponential distribution.
+		- lamRoot: decaying rate value for the root splitting.
+		- backend: likelihood backend used to score the pairings (name or likelihood_invM.likelihoodBackend object). Default: stop / non-stop model (fast backend).
+		- deadline: wall-clock time (as given by time.time()) to finish the search. None for no deadline.
+		- maxPaths: max number of latent paths kept in memory at each level. None for no limit.
+		- survivors: number of latent paths kept for the greedy completion when the deadline is hit.
+		- cacheSize: max number of pairings in the pair likelihood cache shared by the latent paths (see pairCache). 0 or None to score all the pairings again.
 
 	Returns:
 
+		- predecessors: Stores the jet dictionary information for each latent path included in the beam search algorithm. Each entry is an object defined by the latentPath class
+		  (use getPathTree to build the tree lists).
 		- root_node: root node idx.
-		- predecessors: Stores the jet dictionary information for each latent path included in the beam search algorithm. Each entry is an object defined by the latentPath class.
+		- budget: dictionary with
+			- "budgetHit": True if the deadline or maxPaths changed the search.
+			- "deadlineHit": True if the beam was shrunk or the search completed greedily because of the deadline.
+			- "maxPathsHit": True if maxPaths < beamSize.
+			- "greedyLevel": level where the greedy completion started (None if it was not needed).
+			- "beamSizes": list with the number of latent paths kept at each level.
 
 	"""
 
 	Nconst = len(levelContent)
 
-	jetTree = [[-1,-1]]*Nconst
-
-	idx = [i for i in range(Nconst)]
-
-	jetContent = copy.deepcopy(levelContent)
-
 	root_node = 2 * Nconst - 2
 
-	N_leaves_list = [1.] * Nconst
-
-	linkage_list = []
-
-	logLH = []
-
-	levelDeltas = [0.] * Nconst
+	backend = likelihood.getBackend(backend)
+
+	""" Pairings log likelihood shared by all the latent paths of this jet """
+	cache = pairCache(maxSize=cacheSize) if cacheSize else None
+
+	budget = {
+		"budgetHit": False,
+		"deadlineHit": False,
+		"maxPathsHit": False,
+		"greedyLevel": None,
+		"beamSizes": [],
+	}
+
+	""" The beam never grows, so maxPaths also bounds the nodes stored """
+	levelBeam = beamSize
+	if maxPaths is not None and maxPaths < beamSize:
+		levelBeam = max(int(maxPaths), 1)
+		budget["maxPathsHit"] = True
+
+	""" Momentum and delta of all the nodes, shared by all the latent paths """
+	nodes = nodePool(
+		levelContent = levelContent,
+		beamSize = levelBeam,
+	)
 
 
 	""" Calculate the sorted list of all pairs based on max log likelihood (logLH) for each leaf of the tree. O(2 N^2 logN)"""
-	sortPairs =  sortedPairs(
-			levelContent,
-			levelDeltas,
+	sortPairsLogLH, sortPairsIdx =  sortedPairs(
+			nodes.content[0:Nconst],
+			nodes.deltas[0:Nconst],
 			Nconst = Nconst,
 			delta_min = delta_min,
 			lam = lam,
+			backend = backend,
 	)
 
 
@@ -298,15 +561,12 @@ def beamSearch(
 	predecessors = [ ]
 
 	path = latentPath(
-		path_sortPairs = sortPairs,
-		path_levelContent = levelContent,
-		path_levelDeltas = levelDeltas,
-		path_logLH=logLH,
-		path_jetTree = jetTree,
-		path_jetContent = jetContent,
-		path_idx = idx,
-		path_N_leaves_list=N_leaves_list,
-		path_linkage_list=linkage_list,
+		path_nodes = nodes,
+		path_sumLogLH = 0.,
+		path_forestHash = sum(nodes.hashes[0:Nconst]) & HASH_MASK,
+		path_levelNodes = np.arange(Nconst),
+		path_sortPairsLogLH = sortPairsLogLH,
+		path_sortPairsIdx = sortPairsIdx,
 	)
 
 	predecessors.append(path)
@@ -319,73 +579,35 @@ def beamSearch(
 		logger.debug(f" LEVEL = {level}")
 		logger.debug(f" LENGTH PREDECESSORS = {len(predecessors)}")
 
+		levelStartTime = time.time()
 
-		total_levelLatentPaths = []
-
-		# if level == (Nconst - 2) and M_Hard is not None:
-		#
-		# 	for j in range(len(predecessors)):
-		#
-		# 		levelLatentPaths = [
-		# 			(int(j), 0. + np.sum(predecessors[j].logLH), y, 0.)
-		# 			for (x, y) in predecessors[j].sortPairs[-beamSize::]
-		# 		]
-		#
-		# 		"""Append latent path  => we get a final list of beamSize^2 latent paths)"""
-		# 		total_levelLatentPaths = total_levelLatentPaths + levelLatentPaths
-		#
-		# else:
+		""" Deadline passed: keep the best survivors latent paths (predecessors are in decreasing order of logLH) and finish them greedily """
+		if budget["greedyLevel"] is None and deadline is not None and levelStartTime > deadline:
+			budget["deadlineHit"] = True
+			budget["greedyLevel"] = level
+			survivors = max(int(survivors), 1)
+			for path in predecessors[survivors:]:
+				path.release()
+			predecessors = predecessors[0:survivors]
+			logger.debug(f" Deadline hit at level {level}, greedy completion of {len(predecessors)} latent paths")
 
-		for j in range(len(predecessors)):
 
-			levelLatentPaths = [
-				(int(j), x + np.sum(predecessors[j].logLH), y, x)
-				for (x, y) in predecessors[j].sortPairs[-beamSize::]
-			]
+		""" Get the best beamSize latent paths for this level (one for each different tree) """
+		if budget["greedyLevel"] is None:
+			best_LevelLatentPaths = bestLevelPaths(
+				predecessors,
+				beamSize = levelBeam,
+			)
+		else:
+			best_LevelLatentPaths = bestLevelPaths(
+				predecessors,
+				beamSize = len(predecessors),
+				maxPerPath = 1,
+			)
 
+		budget["beamSizes"].append(len(best_LevelLatentPaths))
 
-			"""Append latent path  => we get a final list of beamSize^2 latent paths)"""
-			total_levelLatentPaths = total_levelLatentPaths + levelLatentPaths
-
-
-		# for j in range(len(predecessors)):
-		#
-		# 	""" Append to list: (beamIdx, sumLogLH, MaxPairIdx, pairlogLH) """
-		# 	if level == (Nconst - 2) and M_Hard is not None:
-		#
-		# 		levelLatentPaths = [
-		# 			(int(j), 0. + np.sum(predecessors[j].logLH), y, 0.)
-		# 			for (x, y) in predecessors[j].sortPairs[-beamSize::]
-		# 		]
-		#
-		# 	else:
-		#
-		# 		levelLatentPaths = [
-		# 			(int(j), x + np.sum(predecessors[j].logLH), y, x)
-		# 			for (x, y) in predecessors[j].sortPairs[-beamSize::]
-		# 		]
-		#
-		# 	"""Append latent path  => we get a final list of beamSize^2 latent paths)"""
-		# 	total_levelLatentPaths = total_levelLatentPaths + levelLatentPaths
-
-
-		logger.debug(f" Lenght total_levelLatentPaths = {len(total_levelLatentPaths)}")
-
-
-		""" Sort all latent paths """
-		dtype = [('beamIdx', int),('SumlogLH', float), ('pair', object),('logLH', float)]
-		c = np.array(total_levelLatentPaths, dtype=dtype)
-		total_levelLatentPaths = np.sort(c, order='SumlogLH')
-
-
-		""" Keep only one latent path for each total log likelihood value. This results in a much smaller beam size needed to achieve same performance. The reason is that trees are permutation invariant => many latent path give the same tree"""
-		best_LevelLatentPaths = ([total_levelLatentPaths[0]]
-		                         +[total_levelLatentPaths[i]
-		                           for i in range(1,len(total_levelLatentPaths))
-		                           if total_levelLatentPaths[i][1] > total_levelLatentPaths[i-1][1]]
-		                         )[-beamSize::]
-
-		logger.debug(f" best_LevelLatentPaths = {best_LevelLatentPaths}")
+		logger.debug(f" Length best_LevelLatentPaths = {len(best_LevelLatentPaths)}")
 
 
 		"""Heavy resonance is modeled by a different decaying rate"""
@@ -393,17 +615,41 @@ def beamSearch(
 			lam =lamRoot
 
 		""" Update latent paths (remove clustered nodes and add new one) and store them in predecessors """
-		predecessors = updateLevelPaths(
+		updatedPredecessors = updateLevelPaths(
 			best_LevelPaths = best_LevelLatentPaths,
 			prevPredecessors = predecessors,
 			Nconst = Nconst,
 			Nparent = Nconst + level,
 			delta_min=delta_min,
 			lam=lam,
+			backend=backend,
+			cache=cache,
 		)
 
+		for path in predecessors:
+			path.release()
+
+		predecessors = updatedPredecessors
+
 
-	return predecessors, root_node
+		""" Shrink the beam if the remaining levels at this beam size would finish after the deadline.
+		The cost of a level scales with the number of pairings of each latent path, i.e. with (number of nodes)^2 """
+		if budget["greedyLevel"] is None and deadline is not None and levelBeam > 1:
+			now = time.time()
+			levelNodes = Nconst - level
+			remainingWork = np.sum(np.arange(2, levelNodes) ** 2) / levelNodes ** 2
+			if now + (now - levelStartTime) * remainingWork > deadline:
+				levelBeam = max(levelBeam // 2, 1)
+				budget["deadlineHit"] = True
+				logger.debug(f" Beam size shrunk to {levelBeam} at level {level}")
+
+
+	budget["budgetHit"] = budget["deadlineHit"] or budget["maxPathsHit"]
+
+	if cache is not None:
+		logger.debug(f" Pair cache hits = {cache.hits}, misses = {cache.misses}")
+
+	return predecessors, root_node, budget
 
 
 
@@ -415,7 +661,8 @@ def sortedPairs(
 	levelDeltas,
     Nconst=None,
 	delta_min = None,
-	lam = None
+	lam = None,
+	backend = None,
 ):
 	"""
 	-For each leaf i of the tree, calculate its nearest neighbor (NN) j and the log likelihood for that pairing. This is O(N^2)
@@ -432,36 +679,101 @@ def sortedPairs(
 	    - Nconst: Number of leaves
 	    - delta_min: pT cut scale for the showering process to stop.
 		- lam: decaying rate value for the exponential distribution.
+		- backend: likelihood backend used to score the pairings (see likelihood_invM.getBackend).
 
 	Returns:
-		- pairs
+		- pairsLogLH: array with the log likelihood of all the pairings, sorted in increasing order.
+		- pairsIdx: array of shape (P, 2) with the [node, node] ids of each pairing.
+
+	"""
+
+	right, left = np.tril_indices(Nconst, -1)
+	content = np.asarray(levelContent).reshape(-1, 4)
+	deltas = np.asarray(levelDeltas, dtype=float)
+
+	pairsLogLH = likelihood.getBackend(backend).split_logLH_batch(
+		content[right],
+		deltas[right],
+		content[left],
+		deltas[left],
+		delta_min,
+		lam,
+	)
+	pairsIdx = np.stack((right, left), axis=1)
+
+	""" Sort by logLH. Ties are sorted by the pair [node, node] ids """
+	order = np.lexsort((pairsIdx[:, 1], pairsIdx[:, 0], pairsLogLH))
+	pairsLogLH = pairsLogLH[order]
+	pairsIdx = pairsIdx[order]
+	pairsLogLH.flags.writeable = False
+	pairsIdx.flags.writeable = False
+
+	logger.debug(f" best pairs = {pairsLogLH[-10::], pairsIdx[-10::]}")
+
+	return pairsLogLH, pairsIdx
 
+
+
+
+
+
+
+def bestLevelPaths(
+		predecessors,
+		beamSize = None,
+		maxPerPath = None,
+):
 	"""
+	Get the best beamSize latent paths for the next level, among all the pairings of all the predecessors.
+	The pairings list of each predecessor is already sorted, so we do a k-way merge over the predecessors with a heap, where each time we pop the best
+	pairing we push the next best pairing of the same predecessor. This is O(beamSize log beamSize), instead of sorting all the beamSize^2 candidates.
 
-	pairs =  [
-				           (
-					           likelihood.split_logLH(
-						           levelContent[k],
-						           levelDeltas[k],
-						           levelContent[k - j],
-						           levelDeltas[k - j],
-						           delta_min,
-						           lam,
-					           ),
-					           [k, k - j]
-				           )
-		           for k in range(1, Nconst, 1)
-		           for j in range(k, 0, -1)
-	           ]
+	We keep only one latent path for each tree. This results in a much smaller beam size needed to achieve same performance. The reason is that trees are permutation invariant => many latent paths give the same tree.
+	Two latent paths give the same tree if they have the same forest hash after adding the pairing.
 
+	Args:
+		- predecessors: list with the latent paths of the current level.
+		- beamSize: beam size for the beam search algorithm.
+		- maxPerPath: max number of pairings taken from each predecessor. With maxPerPath=1 each predecessor is extended with its best pairing only (greedy completion).
 
-	dtype = [('logLH', float), ('pair', object)]
-	b = np.array(pairs, dtype=dtype)
-	pairs = np.sort(b, order='logLH')
+	Returns:
+		- best_LevelPaths: List with the best latent paths (beamIdx, total Log Likelihood, Max Pair Idx and last pairing log likelihood), in decreasing order of total log likelihood.
+	"""
 
-	logger.debug(f" best pairs = {pairs[-10::]}")
+	""" Heap entries: (- total logLH, beamIdx, position of the pairing counting from the end of the predecessor sorted pairings list) """
+	heap = [
+		(- (path.sumLogLH + path.sortPairsLogLH[-1]), j, 1)
+		for j, path in enumerate(predecessors)
+		if len(path.sortPairsLogLH) > 0
+	]
+	heapq.heapify(heap)
 
-	return pairs
+	best_LevelPaths = []
+	levelTrees = set()
+
+	while heap and len(best_LevelPaths) < beamSize:
+
+		negSumLogLH, beamIdx, k = heapq.heappop(heap)
+		path = predecessors[beamIdx]
+
+		if k < len(path.sortPairsLogLH) and (maxPerPath is None or k < maxPerPath):
+			heapq.heappush(heap, (- (path.sumLogLH + path.sortPairsLogLH[-k - 1]), beamIdx, k + 1))
+
+		maxPairIdx = path.sortPairsIdx[-k]
+		maxPairLogLH = path.sortPairsLogLH[-k]
+
+		""" Skip the latent path if we already have its tree """
+		hashes = path.nodes.hashes
+		rightHash = hashes[maxPairIdx[0]]
+		leftHash = hashes[maxPairIdx[1]]
+		tree = forestHashUpdate(path.forestHash, leftHash, rightHash, nodeHash(leftHash, rightHash))
+		if tree in levelTrees:
+			continue
+		levelTrees.add(tree)
+
+		best_LevelPaths.append((beamIdx, - negSumLogLH, maxPairIdx, maxPairLogLH))
+
+	return best_LevelPaths
 
 
 
@@ -476,13 +788,16 @@ def updateLevelPaths(
 		Nparent = None,
 		delta_min=None,
 		lam=None,
+		backend=None,
+		cache=None,
 ):
 	"""
 	Update the jet dictionary information by deleting the constituents that are merged and adding the new pseudojets
     (We refer to both leaves and inner nodes as pseudojets.)
+    Each updated latent path only stores the new pairing and a pointer to its predecessor. The new node is added to the shared nodePool.
 
     Args:
-		best_LevelPaths: List with the best latent paths (beamIdx, total Log Likelihood, Max Pair Idx and last pairing log likelihood)
+		best_LevelPaths: List with the best latent paths (beamIdx, total Log Likelihood, Max Pair Idx and last pairing log likelihood), in decreasing order of total log likelihood.
 
 		prevPredecessors: predecessors list with the the jet dictionary information for the current best latent paths.
 
@@ -490,6 +805,10 @@ def updateLevelPaths(
 
 		Nparent: parent idx for current pairing
 
+		backend: likelihood backend used to score the pairings (see likelihood_invM.getBackend).
+
+		cache: pairCache shared by the latent paths (None to score all the new node pairings with the backend).
+
 	returns:
 		-updatedPredecessors: updated predecessors list after adding current pairing.
 
@@ -497,131 +816,186 @@ def updateLevelPaths(
 	# print("lam = ", lam)
 	updatedPredecessors = []
 
-	""" Dequeue each item (in increasing order of logLH )"""
-	for k in range(len(best_LevelPaths)):
+	backend = likelihood.getBackend(backend)
+
+	""" Loop over the best latent paths (in decreasing order of logLH )"""
+	for k, (beamIdx, SumLogLH, maxPairIdx, maxPairLogLH) in enumerate(best_LevelPaths):
 
 		logger.debug(f" ------------------------------- ")
 		logger.debug(f" beam number = {k}")
 
-		(beamIdx, SumLogLH, maxPairIdx, maxPairLogLH) = best_LevelPaths.pop()
-
 
 		logger.debug(f" (SumLogLH, maxPairLogLH) = {SumLogLH, maxPairLogLH}")
-		logger.debug(f" prev logLH = {prevPredecessors[beamIdx].logLH}")
+		logger.debug(f" prev logLH = {prevPredecessors[beamIdx].sumLogLH}")
 		logger.debug(f" ")
 
 		beamIdx = int(beamIdx)
+		prevPath = prevPredecessors[beamIdx]
+		nodes = prevPath.nodes
 
 
-		sortPairs = copy.copy(prevPredecessors[beamIdx].sortPairs)
-		levelContent = copy.copy(prevPredecessors[beamIdx].levelContent)
-		levelDeltas = copy.copy(prevPredecessors[beamIdx].levelDeltas)
-		logLH = copy.copy(prevPredecessors[beamIdx].logLH)
-		N_leaves_list = copy.copy(prevPredecessors[beamIdx].N_leaves_list)
-		linkage_list = copy.copy(prevPredecessors[beamIdx].linkage_list)
-		jetTree = copy.copy(prevPredecessors[beamIdx].jetTree)
-		jetContent = copy.copy(prevPredecessors[beamIdx].jetContent)
-		idx = copy.copy(prevPredecessors[beamIdx].idx)
-
-
-		""" Nodes indexes in the jetContent list for the pair that gives the max logLH (nodes to be removed and clustered)"""
-		leftIdx = maxPairIdx[1]
-		rightIdx = maxPairIdx[0]
+		""" Nodes ids for the pair that gives the max logLH (nodes to be removed and clustered)"""
+		leftIdx = int(maxPairIdx[1])
+		rightIdx = int(maxPairIdx[0])
 		logger.debug(f" Left idx ={leftIdx}")
 		logger.debug(f" Right idx  = {rightIdx}")
 
 
-		""" Nodes indexes in the levelContent list for the pair that gives the max logLH (nodes to be removed and clustered)"""
-		right = idx.index(rightIdx)
-		left = idx.index(leftIdx)
-		logger.debug(f" idx list = {idx}")
+		""" Delete merged nodes """
+		levelNodes = prevPath.levelNodes
+		levelNodes = levelNodes[(levelNodes != leftIdx) & (levelNodes != rightIdx)]
+
+
+		""" Add the new node to the shared nodes arrays """
+		newIdx = nodes.addNode(leftIdx, rightIdx, Nparent)
+
+
+		""" Find new node pairings and merge them into the sorted pairings list (after deleting the merged nodes pairings) """
+		if len(levelNodes) > 0 and cache is not None:
+			NewNodePairsLogLH = cache.split_logLH_batch(backend, nodes, newIdx, levelNodes, delta_min, lam)
+		elif len(levelNodes) > 0:
+			NewNodePairsLogLH = backend.split_logLH_batch(
+				np.broadcast_to(nodes.content[newIdx], (len(levelNodes), 4)),
+				np.full(len(levelNodes), nodes.deltas[newIdx]),
+				nodes.content[levelNodes],
+				nodes.deltas[levelNodes],
+				delta_min,
+				lam,
+			)
+		else:
+			NewNodePairsLogLH = np.zeros(0)
+
+		NewNodePairsIdx = np.stack((np.full(len(levelNodes), newIdx), levelNodes), axis=1)
+
+		sortPairsLogLH, sortPairsIdx = mergePairs(
+			prevPath.sortPairsLogLH,
+			prevPath.sortPairsIdx,
+			NewNodePairsLogLH,
+			NewNodePairsIdx,
+			mergedNodes = [leftIdx, rightIdx],
+		)
 
 
-		""" Delete merged nodes """
-		idx.pop(right)
-		idx.pop(left)
+		""" Add updated path to predecessors list"""
+		updatedPath = latentPath(
+			path_nodes = nodes,
+			path_predecessor = prevPath,
+			path_mergedPair = [leftIdx, rightIdx, newIdx],
+			path_pairLogLH = maxPairLogLH,
+			path_sumLogLH = prevPath.sumLogLH + maxPairLogLH,
+			path_forestHash = forestHashUpdate(
+				prevPath.forestHash,
+				nodes.hashes[leftIdx],
+				nodes.hashes[rightIdx],
+				nodes.hashes[newIdx],
+			),
+			path_levelNodes = np.append(levelNodes, newIdx),
+			path_sortPairsLogLH = sortPairsLogLH,
+			path_sortPairsIdx = sortPairsIdx,
+		)
 
-		rightContent = levelContent.pop(right)
-		leftContent = levelContent.pop(left)
+		updatedPredecessors.append(updatedPath)
 
-		levelDeltas.pop(right)
-		levelDeltas.pop(left)
 
+	return updatedPredecessors
 
-		""" Delete nodes from all pairings list """
-		sortPairs = [entry for entry in sortPairs
-		             if (entry[1][0]!=leftIdx and entry[1][0]!=rightIdx and entry[1][1]!=leftIdx and entry[1][1]!=rightIdx )
-		             ]
 
 
-		""" Find new node pairings and insert into sortPairs list """
 
-		newNode = np.sum([leftContent, rightContent], axis=0)
-		newDelta = likelihood.get_delta_LR(leftContent, rightContent)
 
-		NewNodePairs = [
-				(
-					likelihood.split_logLH(
-						newNode,
-						newDelta,
-						levelContent[j],
-						levelDeltas[j],
-						delta_min,
-						lam
-					),
-					[Nparent, idx[j]]
-				)
-				for j in range(len(idx))
-			]
 
 
-		sortPairs = sortPairs + NewNodePairs
+def getPathTree(path):
+	"""
+	Build the tree of a latent path by following the predecessors back to the leaves.
 
-		dtype = [('logLH', float), ('pair', object)]
-		a = np.array(sortPairs, dtype=dtype)
-		sortPairs = np.sort(a, order='logLH')
+	Args:
+		- path: latentPath
 
+	Returns:
+		- jetTree: list with the [left, right] children ids of each node of the tree ([-1, -1] for the leaves)
+		- jetContent: list with the momentum of all the nodes of the jet tree (both leaves and inners).
+		- N_leaves_list: List that given a node idx, stores for that idx, the number of leaves for the branch below that node.
+		- linkage_list: linkage list to build heat clustermap visualizations.
+		- logLH: list with the log likelihood of each pairing.
+	"""
+	nodes = path.nodes
+	Nconst = nodes.Nconst
 
-		""" Update lists """
+	mergedPairs = []
+	while path.predecessor is not None:
+		mergedPairs.append((path.mergedPair, path.pairLogLH))
+		path = path.predecessor
 
-		idx.append(Nparent)
+	jetTree = [[-1, -1]] * Nconst
+	jetContent = [np.copy(entry) for entry in nodes.content[0:Nconst]]
+	N_leaves_list = [1.] * Nconst
+	linkage_list = []
+	logLH = []
 
-		levelContent.append(newNode)
+	for (leftIdx, rightIdx, newIdx), pairLogLH in mergedPairs[::-1]:
 
-		jetContent.append(newNode)
+		""" Node ids in the jet tree """
+		left = int(nodes.treeIdx[leftIdx])
+		right = int(nodes.treeIdx[rightIdx])
+		Nparent = int(nodes.treeIdx[newIdx])
 
-		levelDeltas.append(newDelta)
+		jetContent.append(np.copy(nodes.content[newIdx]))
 
-		N_leaves_list.append(N_leaves_list[leftIdx] + N_leaves_list[rightIdx])
+		N_leaves_list.append(N_leaves_list[left] + N_leaves_list[right])
 
-		linkage_list.append([leftIdx, rightIdx, Nparent, N_leaves_list[-1]])
+		linkage_list.append([left, right, Nparent, N_leaves_list[-1]])
 
-		jetTree.append([leftIdx, rightIdx])
+		jetTree.append([left, right])
 
-		logLH.append(maxPairLogLH)
+		logLH.append(pairLogLH)
 
+	return jetTree, jetContent, N_leaves_list, linkage_list, logLH
 
-		""" Add updated path to predecessors list"""
-		updatedPath = latentPath(
-			path_sortPairs = sortPairs,
-			path_levelContent=levelContent,
-			path_levelDeltas=levelDeltas,
-			path_logLH=logLH,
-			path_jetTree=jetTree,
-			path_jetContent=jetContent,
-			path_idx=idx,
-			path_N_leaves_list=N_leaves_list,
-			path_linkage_list=linkage_list,
-		)
 
-		updatedPredecessors.append(updatedPath)
 
 
-	return updatedPredecessors
 
 
 
+def mergePairs(
+		pairsLogLH,
+		pairsIdx,
+		newPairsLogLH,
+		newPairsIdx,
+		mergedNodes = None,
+):
+	"""
+	Delete the pairings of the merged nodes from a sorted pairings list and merge the remaining ones with the new node pairings. This is O(P), instead of sorting all the pairings again.
+	The input arrays are not modified (they can be shared with other latent paths). The output arrays are read-only.
+
+	Args:
+		- pairsLogLH: array with the log likelihood of the pairings, sorted in increasing order.
+		- pairsIdx: array of shape (P, 2) with the [node, node] ids of each pairing.
+		- newPairsLogLH: array with the log likelihood of the new node pairings (not sorted).
+		- newPairsIdx: array of shape (M, 2) with the [new node, node] ids of each new pairing.
+		- mergedNodes: [left, right] ids of the two nodes that are merged at this level.
+
+	Returns:
+		- pairsLogLH, pairsIdx: updated sorted pairings list.
+	"""
+
+	""" Delete merged nodes from all pairings list """
+	keep = ~((pairsIdx == mergedNodes[0]) | (pairsIdx == mergedNodes[1])).any(axis=1)
+	pairsLogLH = pairsLogLH[keep]
+	pairsIdx = pairsIdx[keep]
 
+	""" Sort the new node pairings. Ties are sorted by the node ids. All the new pairings have the same 1st node, which has the largest id """
+	order = np.lexsort((newPairsIdx[:, 1], newPairsLogLH))
+	newPairsLogLH = newPairsLogLH[order]
+	newPairsIdx = newPairsIdx[order]
 
+	""" Insert the new pairings after the pairings with the same logLH """
+	position = np.searchsorted(pairsLogLH, newPairsLogLH, side="right")
 
+	pairsLogLH = np.insert(pairsLogLH, position, newPairsLogLH)
+	pairsIdx = np.insert(pairsIdx, position, newPairsIdx, axis=0)
+	pairsLogLH.flags.writeable = False
+	pairsIdx.flags.writeable = False
 
+	return pairsLogLH, pairsIdx
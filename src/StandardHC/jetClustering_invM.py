@@ -6,6 +6,10 @@ import importlib
 import copy
 import argparse
 import os
+import traceback
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 from . import reclusterTree_invM as reclusterTree
 from . import linkageList
@@ -13,6 +17,9 @@ from . import heatClustermap
 from . import likelihood_invM as likelihood
 from . import N2Greedy_invM as N2Greedy
 from . import beamSearchOptimal_invM as BSO
+from . import trellis_invM as trellis
+from . import aStar_invM as aStar
+from . import jetStore
 from .utils import get_logger
 
 logger = get_logger(level=logging.INFO)
@@ -28,7 +35,10 @@ root_dir="/Users/sebastianmacaluso/Documents/PrinceData/invMassGinkgo/"
 
 """####################################"""
 
-def logLHCut(in_truth_Dic, in_Greedy_Dic, in_BSO_Dic, NleavesMin=2, NleavesMax=np.inf, BSTrellis = False):
+def logLHCut(in_truth_Dic, in_Greedy_Dic, in_BSO_Dic, NleavesMin=2, NleavesMax=np.inf, BSTrellis = False, rerunLH = False):
+    """ Keep the jets where the greedy and beam search trees are allowed by the model, with NleavesMin <= # of leaves <= NleavesMax, and fill jet["sumlogLH"].
+        If rerunLH, the truth jets sumlogLH is scored again from their trees (for all the jets of each set at once, see likelihood.get_jets_sumLogLH_batch)
+    """
 
     # dic = {}
     # Total_jetsListLogLH = []
@@ -58,12 +68,15 @@ def logLHCut(in_truth_Dic, in_Greedy_Dic, in_BSO_Dic, NleavesMin=2, NleavesMax=n
         GreedyJets = []
         BSJets = []
 
-        # NewJetList = [likelihood.enrich_jet_logLH(jet) for jet in truthDic["jetsList"][k]]
+        if rerunLH:
+            truthSumLogLH = likelihood.get_jets_sumLogLH_batch(list(truthDic["jetsList"][k]))
 
         for i_jet in range(len(truthDic["jetsList"][k])):
 
-            # tempLogLHTruth = np.sum(NewJetList[i_jet]["logLH"])
-            tempLogLHTruth = np.sum(truthDic["jetsList"][k][i_jet]["logLH"])
+            if rerunLH:
+                tempLogLHTruth = truthSumLogLH[i_jet]
+            else:
+                tempLogLHTruth = np.sum(truthDic["jetsList"][k][i_jet]["logLH"])
             tempLogLHGreedy = np.sum(GreedyDic["jetsList"][k][i_jet]["logLH"])
             if BSTrellis:
                 tempLogLHBS = np.sum(BSODic["jetsList"][k][i_jet][0]["logLH"])
@@ -380,6 +393,41 @@ def appendTruthJetsOnly(start, end, Njets, truth = False, BS = False, Greedy = F
 
 
 
+def appendStoreColumns(start, end, Njets, columns=None, truth = False, BS = False, Greedy = False, jetType = None):
+    """ Load the columns of the jet stores (see jetStore) of the datasets with ids from start to end-1 and concatenate them.
+        Only the requested columns are read, e.g. columns=["sumLogLH", "Nconst"] for a log likelihood scatter plot.
+        The jet stores are the .npz files written by the scans with --output_format npz (the other append* loaders read the .pkl files of the default output format).
+
+        returns: dictionary with the column name as a key and the array with the values for all the jets as the value.
+    """
+
+    startTime = time.time()
+
+    TruthFilename = "Truth/tree_" + str(Njets) + "_truth_"
+    GreedyFilename = "GreedyJets/Greedy_" + str(Njets) + "_"
+    BSFilename = "BeamSearchJets/BSO_" + str(Njets) + "_"
+
+    if truth:
+        filename = TruthFilename
+    elif BS:
+        filename = BSFilename
+    elif Greedy:
+        filename = GreedyFilename
+    else:
+        raise ValueError(f" Please specify algorithm")
+
+    stores = [jetStore.loadJetStore(root_dir + jetType + "/" + filename + str(i) + ".npz", columns=columns)
+              for i in range(start, end)
+              if os.path.isfile(root_dir + jetType + "/" + filename + str(i) + ".npz")]
+
+    logger.info(f" TOTAL TIME = {time.time() - startTime}")
+
+    return jetStore.concatJetStores(stores)
+
+
+
+
+
 def appendGreedyJets(start, end, Njets):
     """ Load greedy trees and logLH lists """
 
@@ -505,54 +553,389 @@ def appendBSO_Scan(start, end, Njets):
 
 
 
-""" RUN GREEDY AND BEAM SEARCH ALGORITHMS """
+""" BATCH EXECUTION """
 
-def fill_GreedyList(input_jets, Nbest=1, k1=0, k2=2):
-    """ Run the greedy algorithm over a list of sets of input jets.
-        Args: input jets
-        returns: clustered jets
-                     jets logLH
+def _runChunk(func, chunk, kwargs):
+    """ Run func over a chunk of jets in a worker process. An exception in one jet is returned (as the traceback) instead of the result, so it does not lose the chunk.
+        returns: list of (result, error) for each jet, with result = None if there was an error and error = None otherwise.
     """
+    results = []
+    for jet in chunk:
+        try:
+            results.append((func(jet, **kwargs), None))
+        except Exception:
+            results.append((None, traceback.format_exc()))
 
+    return results
 
 
-    with open(args.data_dir + str(input_jets) + '.pkl', "rb") as fd:
-        truth_jets = pickle.load(fd, encoding='latin-1')[k1:k2]
+
+def runBatch(func, jets, workers=1, chunksize=1, progressEvery=None, raiseErrors=False, **kwargs):
+    """ Run func(jet, **kwargs) over a list of jets, fanning the jets out over a pool of worker processes.
+
+        The jets are split in chunks of chunksize jets, that are sent to the workers. The results are returned in the same order as the input jets.
+        If a jet raises an exception, the error is logged and its result is None, and the rest of the jets are not affected (unless raiseErrors).
+        If a worker process dies (e.g. killed by the OS), the jets that were not finished are run again in a new pool one by one and then, if the pool breaks again,
+        each of them in its own process, so only the jet that crashes the worker is lost (with result None).
+        With workers=1 the jets are run in this process one after the other, with the same error handling.
+
+        Args:
+            - func: function with the jet as the first argument. It must be defined at module level (so that it can be sent to the workers).
+            - jets: list of input jets.
+            - workers: number of worker processes.
+            - chunksize: number of jets sent to a worker at once. Larger chunks have less overhead, smaller ones balance better the load between workers.
+            - progressEvery: if not None, log the number of jets finished every progressEvery jets.
+            - raiseErrors: if True, stop at the first jet that fails instead: its exception is raised with workers=1, and a RuntimeError with its traceback
+              (or with the jet that crashed its worker process) otherwise. Useful to debug func.
+            - kwargs: keyword arguments for func.
+
+        returns: list with the result of func for each jet.
+    """
 
     startTime = time.time()
 
-    # for k,truth_jet in enumerate(truth_jets):
-    #     print("k = ",k)
-    #     if k==27:
-    #         print("M_Hard = ",truth_jet["M_Hard"])
-    #         # print("Nconst = ", truth_jet["Nconst"] )
-    #     N2Greedy.recluster(
-    #         truth_jet,
-    #         delta_min=truth_jet["pt_cut"],
-    #         lam=float(truth_jet["Lambda"]),
-    #         visualize=True,
-    #     )
+    def _progress(Ndone, Nprev):
+        if progressEvery and Ndone // progressEvery > Nprev // progressEvery:
+            logger.info(f" # of reclustered jets = {Ndone}; Partial time = {time.time() - startTime}")
+
+    if workers is None or workers <= 1:
+        results = []
+        for i, jet in enumerate(jets):
+            _progress(i, i - 1)
+            try:
+                results.append(func(jet, **kwargs))
+            except Exception:
+                if raiseErrors:
+                    raise
+                logger.error(f" Jet {i} failed:\n{traceback.format_exc()}")
+                results.append(None)
+        return results
+
+    results = [None] * len(jets)
+
+    """ Work items: (index of the 1st jet of the chunk, chunk of jets). After a worker crash, the unfinished jets are split in chunks of one jet """
+    pending = [(start, jets[start:start + chunksize]) for start in range(0, len(jets), chunksize)]
+    Ndone = 0
+
+    for isolated in (False, False, True):
+
+        broken = []
+
+        """ In the last round, each jet runs in its own pool, so a crash can only lose that jet """
+        rounds = [pending] if not isolated else [[item] for item in pending]
+
+        for items in rounds:
+            with ProcessPoolExecutor(max_workers=1 if isolated else workers) as executor:
+                futures = [(start, chunk, executor.submit(_runChunk, func, chunk, kwargs)) for start, chunk in items]
+
+                for start, chunk, future in futures:
+                    try:
+                        chunkResults = future.result()
+                    except BrokenProcessPool:
+                        if isolated:
+                            if raiseErrors:
+                                raise RuntimeError(f"Jet {start} crashed its worker process")
+                            logger.error(f" Jet {start} crashed its worker process")
+                        else:
+                            broken.extend((start + k, [jet]) for k, jet in enumerate(chunk))
+                        continue
+
+                    for k, (result, error) in enumerate(chunkResults):
+                        results[start + k] = result
+                        if error is not None:
+                            if raiseErrors:
+                                raise RuntimeError(f"Jet {start + k} failed:\n{error}")
+                            logger.error(f" Jet {start + k} failed:\n{error}")
+
+                    _progress(Ndone + len(chunk), Ndone)
+                    Ndone += len(chunk)
+
+        if not broken:
+            break
 
+        logger.warning(f" A worker process crashed, running again {len(broken)} jets")
+        pending = broken
 
-    greedyJets = [N2Greedy.recluster(
+    return results
+
+
+
+def _greedyJet(truth_jet, backend=None):
+    """ Run the greedy algorithm over one jet (backend: likelihood backend name, see likelihood_invM.getBackend) """
+    return N2Greedy.recluster(
         truth_jet,
         delta_min=truth_jet["pt_cut"],
         lam=float(truth_jet["Lambda"]),
         visualize = True,
-    ) for truth_jet in truth_jets]
+        backend = backend,
+    )
+
+
+
+def _BSJet(truth_jet, Nbest=1, backend=None, timeBudget=None, maxPaths=None):
+    """ Run the beam search algorithm over one jet and return the best tree (backend: likelihood backend name, see likelihood_invM.getBackend).
+        timeBudget (seconds) and maxPaths limit the search, see beamSearchOptimal_invM.beamSearch """
+    N = len(truth_jet["leaves"])
+
+    return BSO.recluster(
+        truth_jet,
+        beamSize=min(3 * N, np.asarray(N * (N - 1) / 2).astype(int)),
+        delta_min=truth_jet["pt_cut"],
+        lam=float(truth_jet["Lambda"]),
+        N_best=Nbest,
+        visualize = True,
+        backend = backend,
+        timeBudget = timeBudget,
+        maxPaths = maxPaths,
+    )[0]
+
+
+
+def _trellisJet(truth_jet, partition=False, backend=None):
+    """ Run the cluster trellis over one jet and return the maximum likelihood tree (None for jets with more than trellis.MAX_LEAVES leaves, that are skipped) """
+    N = len(truth_jet["leaves"])
+    if N > trellis.MAX_LEAVES:
+        logger.warning(f" Skipping a jet with {N} leaves: the trellis is for jets with up to {trellis.MAX_LEAVES} leaves")
+        return None
+
+    return trellis.recluster(
+        truth_jet,
+        delta_min=truth_jet["pt_cut"],
+        lam=float(truth_jet["Lambda"]),
+        partition=partition,
+        visualize = True,
+        backend = backend,
+    )[0]
+
+
+
+def _aStarJet(truth_jet, nodeBudget=10000, backend=None):
+    """ Run the best-first (A*) search over one jet, expanding at most nodeBudget states """
+    return aStar.recluster(
+        truth_jet,
+        delta_min=truth_jet["pt_cut"],
+        lam=float(truth_jet["Lambda"]),
+        nodeBudget=nodeBudget,
+        visualize = True,
+        backend = backend,
+    )
+
+
+
+def _ktJet(truth_jet, alpha=None):
+    """ Run the generalized kt algorithm over one jet """
+    return reclusterTree.recluster(truth_jet, alpha=alpha, save=False)
+
+
+
+
+
+""" PICKLE OUTPUT """
+
+def _jetsListLogLH(jetsList):
+    """ Pickle output of the scans: (jetsList, jetsListLogLH), with NaN log likelihood for the jets where the algorithm failed """
+    return jetsList, [sum(jet["logLH"]) if jet is not None else np.nan for jet in jetsList]
+
+
+
+def _trellisJetsList(jetsList):
+    """ Pickle output of the trellis scan: each jet as a [jet] list (the BSTrellis layout of logLHCut) """
+    jetsList, jetsListLogLH = _jetsListLogLH(jetsList)
+    return [[jet] if jet is not None else None for jet in jetsList], jetsListLogLH
+
+
+
+def _ktJetsList(jetsList):
+    """ Pickle output of the generalized kt scans: the jets list alone (the kt jets have no log likelihood) """
+    return jetsList
+
+
+
+
+
+""" STREAMING """
+
+def iterTruthJets(filename, start=0, stop=None):
+    """ Read input jets one at a time, without loading the whole sample in memory.
+
+        Args:
+            - filename: input jets file. Either a jet store (.npz, see jetStore.writeJetStore), that is memory mapped,
+              or a pickle file. The pickle file can contain several pickled objects written one after the other (each one a jet or a list of jets),
+              that are loaded one at a time. (A pickle with a single list of jets still works, but the list is loaded at once).
+            - start: index of the first jet.
+            - stop: index after the last jet (None to read until the end of the file).
+
+        returns: generator of (jet index, jet)
+    """
+
+    if filename.endswith(".npz"):
+        dataset = jetStore.mmapJetDataset(filename)
+        stop = len(dataset) if stop is None else min(stop, len(dataset))
+        for k in range(start, stop):
+            yield k, dataset[k]
+        return
+
+    k = 0
+    with open(filename, "rb") as fd:
+        while stop is None or k < stop:
+            try:
+                obj = pickle.load(fd, encoding='latin-1')
+            except EOFError:
+                return
+
+            """ (jetsList, jetsListLogLH) tuples as saved by the scans """
+            if isinstance(obj, tuple):
+                obj = obj[0]
+            jets = obj if isinstance(obj, list) else [obj]
+
+            for jet in jets:
+                if stop is not None and k >= stop:
+                    return
+                if k >= start:
+                    yield k, jet
+                k += 1
+
+
+
+def streamRecluster(func, jets, chunkSize=1000, workers=1, chunksize=1, **kwargs):
+    """ Run func(jet, **kwargs) over a stream of jets in chunks of chunkSize jets, so that at most one chunk of input and output jets is in memory.
+
+        Args:
+            - func: function with the jet as the first argument (see runBatch).
+            - jets: iterable of (jet index, jet), e.g. iterTruthJets.
+            - chunkSize: number of jets in each chunk.
+            - workers, chunksize: number of worker processes and jets sent to a worker at once (see runBatch).
+            - kwargs: keyword arguments for func.
+
+        returns: generator of (index of the 1st jet of the chunk, index after the last jet of the chunk, list with the result of func for each jet of the chunk)
+    """
+
+    jets = iter(jets)
+
+    while True:
+        chunk = list(itertools.islice(jets, chunkSize))
+        if not chunk:
+            return
+
+        indices = [k for k, _ in chunk]
+        results = runBatch(func, [jet for _, jet in chunk], workers=workers, chunksize=chunksize, **kwargs)
+
+        yield indices[0], indices[-1] + 1, results
+
+
+
+def _readCheckpoint(checkpointFile):
+    """ Index of the next jet to run, saved in the checkpoint file (0 if there is no checkpoint) """
+    if not os.path.exists(checkpointFile):
+        return 0
+    with open(checkpointFile, "r") as f:
+        return int(f.read().strip())
+
+
+
+def _writeCheckpoint(checkpointFile, k):
+    """ Save the index of the next jet to run. The file is replaced atomically, so a killed job can not leave it half written """
+    with open(checkpointFile + ".tmp", "w") as f:
+        f.write(str(k))
+    os.replace(checkpointFile + ".tmp", checkpointFile)
+
+
+
+def runStream(func, in_filename, out_prefix, chunkSize=1000, start=None, stop=None, workers=1, chunksize=1, output_format="pickle", pickleOutput=_jetsListLogLH, **kwargs):
+    """ Recluster a jet sample chunk by chunk, writing the output jets of each chunk to its own file, with checkpoint / resume by jet index.
+
+        The output jets of the jets [k1, k2) are saved in out_prefix + "_" + k1 + "_" + k2 + ".pkl" as pickleOutput(jetsList) (or .npz with output_format="npz").
+        After each chunk is saved, the index of the next jet is written to the checkpoint file out_prefix + ".checkpoint".
+        If the job is killed, running it again starts from the checkpoint (a chunk that was being written when the job was killed is run again).
+        The chunk files can be joined with jetStore.concatJetStores.
+
+        Args:
+            - func: function with the jet as the first argument (see runBatch).
+            - in_filename: input jets file (see iterTruthJets).
+            - out_prefix: path and name prefix of the output files.
+            - chunkSize: number of jets in each chunk (and output file).
+            - start: index of the first jet. If None, start from the checkpoint (0 if there is none).
+            - stop: index after the last jet (None to run until the end of the input file).
+            - workers, chunksize: number of worker processes and jets sent to a worker at once (see runBatch).
+            - output_format: "pickle" or "npz" (jet store).
+            - pickleOutput: function that takes the output jets list of a chunk and returns the object to pickle, so that each scan saves the same layout
+              with and without streaming. Default: (jetsList, jetsListLogLH).
+            - kwargs: keyword arguments for func.
+
+        returns: list with the output filenames written in this run.
+    """
+
+    checkpointFile = out_prefix + ".checkpoint"
+    if start is None:
+        start = _readCheckpoint(checkpointFile)
+        if start > 0:
+            logger.info(f" Resuming from jet {start}")
+
+    startTime = time.time()
+    filenames = []
+
+    for k1, k2, jetsList in streamRecluster(
+        func,
+        iterTruthJets(in_filename, start=start, stop=stop),
+        chunkSize=chunkSize,
+        workers=workers,
+        chunksize=chunksize,
+        **kwargs
+    ):
+
+        filename = out_prefix + "_" + str(k1) + "_" + str(k2)
+        if output_format == "npz":
+            filename += ".npz"
+            jetStore.writeJetStore(filename, jetsList)
+        else:
+            filename += ".pkl"
+            with open(filename, "wb") as f:
+                pickle.dump(pickleOutput(jetsList), f)
+
+        _writeCheckpoint(checkpointFile, k2)
+        filenames.append(filename)
+
+        logger.info(f" Jets [{k1}, {k2}) saved in {filename}; Partial time = {time.time() - startTime}")
+
+    return filenames
+
+
+
+""" RUN GREEDY AND BEAM SEARCH ALGORITHMS """
+
+def fill_GreedyList(input_jets, Nbest=1, k1=0, k2=2, workers=1, chunksize=1, backend=None):
+    """ Run the greedy algorithm over a list of sets of input jets.
+        Args: input jets
+              workers, chunksize: number of worker processes and jets per chunk (see runBatch)
+              backend: likelihood backend name (see likelihood_invM.getBackend)
+        returns: clustered jets (None if the algorithm failed for a jet)
+                     jets logLH (NaN if the algorithm failed for a jet)
+    """
+
+
+
+    with open(args.data_dir + str(input_jets) + '.pkl', "rb") as fd:
+        truth_jets = pickle.load(fd, encoding='latin-1')[k1:k2]
+
+    startTime = time.time()
+
+    greedyJets = runBatch(_greedyJet, truth_jets, workers=workers, chunksize=chunksize, backend=backend)
 
     print("TOTAL TIME = ", time.time() - startTime)
 
-    greedyJetsLogLH = [sum(jet["logLH"]) for jet in greedyJets]
+    greedyJetsLogLH = [sum(jet["logLH"]) if jet is not None else np.nan for jet in greedyJets]
 
     return greedyJets, greedyJetsLogLH
 
 
-def fill_BSList(input_jets, Nbest=1, k1=0, k2=2):
+def fill_BSList(input_jets, Nbest=1, k1=0, k2=2, workers=1, chunksize=1, backend=None, timeBudget=None, maxPaths=None):
     """ Run the Beam search algorithm (algorithm where when the logLH of 2 or more trees is the same, we only keep one of them) over a list  of sets of input jets.
         Args: input jets
-        returns: clustered jets
-                     jets logLH
+              workers, chunksize: number of worker processes and jets per chunk (see runBatch)
+              backend: likelihood backend name (see likelihood_invM.getBackend)
+              timeBudget, maxPaths: wall-clock budget (seconds) and max number of latent paths for each jet (None for no limit)
+        returns: clustered jets (None if the algorithm failed for a jet)
+                     jets logLH (NaN if the algorithm failed for a jet)
     """
 
 
@@ -561,42 +944,86 @@ def fill_BSList(input_jets, Nbest=1, k1=0, k2=2):
         truth_jets = pickle.load(fd, encoding='latin-1')[k1:k2]
 
     startTime = time.time()
-    BSO_jetsList = []
 
-    a = time.time()
+    BSO_jetsList = runBatch(
+        _BSJet,
+        truth_jets,
+        workers=workers,
+        chunksize=chunksize,
+        progressEvery=50,
+        Nbest=Nbest,
+        backend=backend,
+        timeBudget=timeBudget,
+        maxPaths=maxPaths,
+    )
+
+    print("TOTAL TIME = ", time.time() - startTime)
+
+    BSO_jetsListLogLH = [sum(jet["logLH"]) if jet is not None else np.nan for jet in BSO_jetsList]
+
+    return BSO_jetsList, BSO_jetsListLogLH
+
+
+
+def fill_TrellisList(input_jets, k1=0, k2=2, partition=False, workers=1, chunksize=1, backend=None):
+    """ Run the cluster trellis (exact maximum likelihood tree) over a list of sets of input jets.
+        Args: input jets
+              partition: if True, also calculate the partition function of each jet
+              workers, chunksize: number of worker processes and jets per chunk (see runBatch)
+              backend: likelihood backend name (see likelihood_invM.getBackend)
+        returns: clustered jets (None for the jets with more than trellis.MAX_LEAVES leaves, that are skipped, or if the algorithm failed for a jet)
+                     jets logLH (NaN for the jets that are None)
+    """
 
-    for i, truth_jet in enumerate(truth_jets):
 
-        if i % 50 == 0:
-            print(" # of reclustered jets = ", i, "; Partial time = ", time.time() - a)
-            #                 print("PARTIAL TIME = ",time.time() -a)
-            a = time.time()
 
-        N = len(truth_jet["leaves"])
+    with open(args.data_dir + str(input_jets) + '.pkl', "rb") as fd:
+        truth_jets = pickle.load(fd, encoding='latin-1')[k1:k2]
+
+    startTime = time.time()
 
-        BSO_jetsList.append(BSO.recluster(
-            truth_jet,
-            beamSize=min(3 * N, np.asarray(N * (N - 1) / 2).astype(int)),
-            delta_min=truth_jet["pt_cut"],
-            lam=float(truth_jet["Lambda"]),
-            N_best=Nbest,
-            visualize = True,
-        )[0]
-                            )
+    trellisJets = runBatch(_trellisJet, truth_jets, workers=workers, chunksize=chunksize, partition=partition, backend=backend)
 
     print("TOTAL TIME = ", time.time() - startTime)
 
-    BSO_jetsListLogLH = [sum(jet["logLH"]) for jet in BSO_jetsList]
+    trellisJetsLogLH = [sum(jet["logLH"]) if jet is not None else np.nan for jet in trellisJets]
 
-    return BSO_jetsList, BSO_jetsListLogLH
+    return trellisJets, trellisJetsLogLH
+
+
+
+def fill_AStarList(input_jets, k1=0, k2=2, nodeBudget=10000, workers=1, chunksize=1, backend=None):
+    """ Run the best-first (A*) search over a list of sets of input jets.
+        Args: input jets
+              nodeBudget: max number of expanded states for each jet (the best tree found so far is returned when it is reached)
+              workers, chunksize: number of worker processes and jets per chunk (see runBatch)
+              backend: likelihood backend name (see likelihood_invM.getBackend)
+        returns: clustered jets (None if the algorithm failed for a jet)
+                     jets logLH (NaN if the algorithm failed for a jet)
+    """
+
+
+
+    with open(args.data_dir + str(input_jets) + '.pkl', "rb") as fd:
+        truth_jets = pickle.load(fd, encoding='latin-1')[k1:k2]
+
+    startTime = time.time()
+
+    aStarJets = runBatch(_aStarJet, truth_jets, workers=workers, chunksize=chunksize, nodeBudget=nodeBudget, backend=backend)
+
+    print("TOTAL TIME = ", time.time() - startTime)
 
+    aStarJetsLogLH = [sum(jet["logLH"]) if jet is not None else np.nan for jet in aStarJets]
 
+    return aStarJets, aStarJetsLogLH
 
-def fill_ktAlgos(input_jets, k1=0, k2=2, alpha = None):
+
+
+def fill_ktAlgos(input_jets, k1=0, k2=2, alpha = None, workers=1, chunksize=1):
     """ Run the generalized kt algorithm over a list of sets of input jets.
         Args: input jets
-        returns: clustered jets
-                     jets logLH
+              workers, chunksize: number of worker processes and jets per chunk (see runBatch)
+        returns: clustered jets (None if the algorithm failed for a jet)
     """
 
 
@@ -606,8 +1033,7 @@ def fill_ktAlgos(input_jets, k1=0, k2=2, alpha = None):
 
     startTime = time.time()
 
-    generalizedKtjets = [reclusterTree.recluster(truth_jet, alpha=alpha, save=False)
-                         for truth_jet in truth_jets]
+    generalizedKtjets = runBatch(_ktJet, truth_jets, workers=workers, chunksize=chunksize, alpha=alpha)
 
     print("TOTAL TIME = ", time.time() - startTime)
 
@@ -637,40 +1063,117 @@ if __name__ == "__main__":
     #         with open(data_dir + "BeamSearchJets/BSO_" + str(Njets) + "Mw_" + str(i) + ".pkl", "wb") as f:
     #             pickle.dump((BSO_jetsList, BSO_jetsListLogLH), f)
 
+    def inputFile(name):
+        """ Input jets file: jet store (.npz) if there is one, pickle otherwise """
+        if os.path.exists(args.data_dir + name + ".npz"):
+            return args.data_dir + name + ".npz"
+        return args.data_dir + name + ".pkl"
+
+
     def runGreedy_Scan(i, Njets):
         """ Run greedy algorithm"""
 
+        if args.stream_chunk > 0:
+            output_dir = args.output_dir+"/GreedyJets/"
+            os.system('mkdir -p ' + output_dir)
+            runStream(_greedyJet, inputFile("tree_" + str(Njets) + "_truth_" + str(i)), output_dir+"Greedy_" + str(Njets) + "_" + str(i),
+                      chunkSize=args.stream_chunk, stop=Njets, workers=args.workers, chunksize=args.chunksize, output_format=args.output_format,
+                      backend=args.backend)
+            return
+
         jetsList, jetsListLogLH = fill_GreedyList("tree_" + str(Njets) + "_truth_" + str(i), k1=0,
-                                                  k2=Njets)
+                                                  k2=Njets, workers=args.workers, chunksize=args.chunksize, backend=args.backend)
 
         output_dir = args.output_dir+"/GreedyJets/"
         os.system('mkdir -p ' + output_dir)
 
-        with open(output_dir+"Greedy_" + str(Njets) + "_" + str(i) + ".pkl", "wb") as f:
-            pickle.dump((jetsList, jetsListLogLH), f)
+        if args.output_format == "npz":
+            jetStore.writeJetStore(output_dir+"Greedy_" + str(Njets) + "_" + str(i) + ".npz", jetsList)
+        else:
+            with open(output_dir+"Greedy_" + str(Njets) + "_" + str(i) + ".pkl", "wb") as f:
+                pickle.dump((jetsList, jetsListLogLH), f)
 
 
     def runBSO_Scan(i, Njets):
         """ Run beam search algorithm"""
 
+        if args.stream_chunk > 0:
+            output_dir = args.output_dir+"/BeamSearchJets/"
+            os.system('mkdir -p ' + output_dir)
+            runStream(_BSJet, inputFile("tree_" + str(Njets) + "_truth_" + str(i)), output_dir+"BSO_" + str(Njets) + "_" + str(i),
+                      chunkSize=args.stream_chunk, stop=Njets, workers=args.workers, chunksize=args.chunksize, output_format=args.output_format,
+                      backend=args.backend, timeBudget=args.time_budget, maxPaths=args.max_paths)
+            return
+
         BSO_jetsList, BSO_jetsListLogLH = fill_BSList("tree_" + str(Njets) + "_truth_" + str(i), k1=0,
-                                                      k2=Njets)
+                                                      k2=Njets, workers=args.workers, chunksize=args.chunksize, backend=args.backend,
+                                                      timeBudget=args.time_budget, maxPaths=args.max_paths)
 
         output_dir = args.output_dir+"/BeamSearchJets/"
         os.system('mkdir -p ' + output_dir)
 
-        with open(output_dir+"BSO_" + str(Njets) + "_" + str(i) + ".pkl", "wb") as f:
-            pickle.dump((BSO_jetsList, BSO_jetsListLogLH), f)
+        if args.output_format == "npz":
+            jetStore.writeJetStore(output_dir+"BSO_" + str(Njets) + "_" + str(i) + ".npz", BSO_jetsList)
+        else:
+            with open(output_dir+"BSO_" + str(Njets) + "_" + str(i) + ".pkl", "wb") as f:
+                pickle.dump((BSO_jetsList, BSO_jetsListLogLH), f)
+
+
+
+    def runTrellis_Scan(i, Njets):
+        """ Run the cluster trellis. The pickle output keeps the [jet] list for each jet (the BSTrellis layout of logLHCut), with and without streaming """
+
+        partition = args.partition == "True"
+
+        if args.stream_chunk > 0:
+            output_dir = args.output_dir+"/TrellisJets/"
+            os.system('mkdir -p ' + output_dir)
+            runStream(_trellisJet, inputFile("tree_" + str(Njets) + "_truth_" + str(i)), output_dir+"Trellis_" + str(Njets) + "_" + str(i),
+                      chunkSize=args.stream_chunk, stop=Njets, workers=args.workers, chunksize=args.chunksize, output_format=args.output_format,
+                      pickleOutput=_trellisJetsList, partition=partition, backend=args.backend)
+            return
+
+        trellisJets, trellisJetsLogLH = fill_TrellisList("tree_" + str(Njets) + "_truth_" + str(i), k1=0, k2=Njets, partition=partition,
+                                                         workers=args.workers, chunksize=args.chunksize, backend=args.backend)
+
+        output_dir = args.output_dir+"/TrellisJets/"
+        os.system('mkdir -p ' + output_dir)
+
+        if args.output_format == "npz":
+            jetStore.writeJetStore(output_dir+"Trellis_" + str(Njets) + "_" + str(i) + ".npz", trellisJets)
+        else:
+            with open(output_dir+"Trellis_" + str(Njets) + "_" + str(i) + ".pkl", "wb") as f:
+                pickle.dump(_trellisJetsList(trellisJets), f)
+
+
+
+    def runAStar_Scan(i, Njets):
+        """ Run the best-first (A*) search"""
+
+        if args.stream_chunk > 0:
+            output_dir = args.output_dir+"/AStarJets/"
+            os.system('mkdir -p ' + output_dir)
+            runStream(_aStarJet, inputFile("tree_" + str(Njets) + "_truth_" + str(i)), output_dir+"AStar_" + str(Njets) + "_" + str(i),
+                      chunkSize=args.stream_chunk, stop=Njets, workers=args.workers, chunksize=args.chunksize, output_format=args.output_format,
+                      nodeBudget=args.node_budget, backend=args.backend)
+            return
+
+        aStarJets, aStarJetsLogLH = fill_AStarList("tree_" + str(Njets) + "_truth_" + str(i), k1=0, k2=Njets, nodeBudget=args.node_budget,
+                                                   workers=args.workers, chunksize=args.chunksize, backend=args.backend)
+
+        output_dir = args.output_dir+"/AStarJets/"
+        os.system('mkdir -p ' + output_dir)
+
+        if args.output_format == "npz":
+            jetStore.writeJetStore(output_dir+"AStar_" + str(Njets) + "_" + str(i) + ".npz", aStarJets)
+        else:
+            with open(output_dir+"AStar_" + str(Njets) + "_" + str(i) + ".pkl", "wb") as f:
+                pickle.dump((aStarJets, aStarJetsLogLH), f)
 
 
 
     def runKtAntiKtCA_Scan(i, Njets, alpha=None):
         """ Run beam search algorithm"""
-        generalizedKtjets = fill_ktAlgos("tree_" + str(Njets) + "_truth_" + str(i),
-                                         k1=0,
-                                         k2=Njets,
-                                         alpha=alpha)
-
         if alpha == 1:
             name = "Kt"
         elif alpha == -1:
@@ -680,11 +1183,29 @@ if __name__ == "__main__":
         else:
             raise ValueError(f"Please pick a valid value for alpha (e.g. -1,0,1)")
 
+        if args.stream_chunk > 0:
+            output_dir = args.output_dir+"/"+name+"Jets/"
+            os.system('mkdir -p ' + output_dir)
+            runStream(_ktJet, inputFile("tree_" + str(Njets) + "_truth_" + str(i)), output_dir + name+"_" + str(Njets) + "_" + str(i),
+                      chunkSize=args.stream_chunk, stop=Njets, workers=args.workers, chunksize=args.chunksize, output_format=args.output_format,
+                      pickleOutput=_ktJetsList, alpha=alpha)
+            return
+
+        generalizedKtjets = fill_ktAlgos("tree_" + str(Njets) + "_truth_" + str(i),
+                                         k1=0,
+                                         k2=Njets,
+                                         alpha=alpha,
+                                         workers=args.workers,
+                                         chunksize=args.chunksize)
+
         output_dir = args.output_dir+"/"+name+"Jets/"
         os.system('mkdir -p ' + output_dir)
 
-        with open(output_dir + name+"_" + str(Njets) + "_" + str(i) + ".pkl", "wb") as f:
-            pickle.dump(generalizedKtjets, f)
+        if args.output_format == "npz":
+            jetStore.writeJetStore(output_dir + name+"_" + str(Njets) + "_" + str(i) + ".npz", generalizedKtjets)
+        else:
+            with open(output_dir + name+"_" + str(Njets) + "_" + str(i) + ".pkl", "wb") as f:
+                pickle.dump(_ktJetsList(generalizedKtjets), f)
 
 
 
@@ -704,6 +1225,30 @@ if __name__ == "__main__":
         "--BSScan", type=str, default="False", help="Flag to run beam seach clustering"
     )
 
+    parser.add_argument(
+        "--TrellisScan", type=str, default="False", help="Flag to run the cluster trellis (exact maximum likelihood tree, for jets with up to 15 leaves)"
+    )
+
+    parser.add_argument(
+        "--partition", type=str, default="False", help="Flag to also calculate the partition function with the cluster trellis"
+    )
+
+    parser.add_argument(
+        "--AStarScan", type=str, default="False", help="Flag to run the best-first (A*) search"
+    )
+
+    parser.add_argument(
+        "--node_budget", type=int, default=10000, help="Max number of states expanded by the A* search for each jet"
+    )
+
+    parser.add_argument(
+        "--time_budget", type=float, default=None, help="Wall-clock budget in seconds for the beam search of each jet (the beam shrinks and the search finishes greedily when it is hit)"
+    )
+
+    parser.add_argument(
+        "--max_paths", type=int, default=None, help="Max number of latent paths kept in memory by the beam search at each level"
+    )
+
     parser.add_argument(
         "--KtAntiktCAscan", type=str, default="False", help="Flag to run generalized kt clustering"
     )
@@ -716,6 +1261,35 @@ if __name__ == "__main__":
         "--N_jets", type=str, default=2, help="# of jets in each dataset"
     )
 
+    parser.add_argument(
+        "--N_ids", type=int, default=1, help="# of datasets to run, with ids from --id to --id + N_ids - 1"
+    )
+
+    parser.add_argument(
+        "--workers", type=int, default=1, help="# of worker processes to run the jets of each dataset in parallel"
+    )
+
+    parser.add_argument(
+        "--chunksize", type=int, default=1, help="# of jets sent to a worker process at once"
+    )
+
+    parser.add_argument(
+        "--stream_chunk", type=int, default=0, help="If > 0, read and recluster the jets in chunks of stream_chunk jets, saving each chunk to its own file, with a checkpoint to resume a killed job"
+    )
+
+    parser.add_argument(
+        "--backend", type=str, default=likelihood.DEFAULT_BACKEND, choices=list(likelihood.LIKELIHOOD_BACKENDS),
+        help="Likelihood backend used by the greedy, beam search, trellis and A* algorithms to score the pairings (see likelihood_invM.getBackend). "
+             "'fast' (default, stop / non-stop model) uses numba when it is installed. The trees and log likelihoods obtained with the default can differ from "
+             "the ones of the versions before the backends were added, that optimized the split_logLH model: 'legacy' reproduces them"
+    )
+
+    parser.add_argument(
+        "--output_format", type=str, default="pickle", choices=["pickle", "npz"],
+        help="Output format: pickle of the jets list (read by the append* loaders and logLHCut) or columnar jet store (npz, read by appendStoreColumns and jetStore). "
+             "The jet store only keeps the tree, content, deltas, logLH, leaves and scalar columns (see jetStore), not e.g. dij or ConstPhi"
+    )
+
 
     parser.add_argument(
         "--data_dir", type=str, required=True, help="Data dir"
@@ -756,18 +1330,31 @@ if __name__ == "__main__":
 
     """We ran a scan for 30 sets of 500 jets each."""
     if args.greedyScan == "True":
-        runGreedy_Scan(int(args.id), int(args.N_jets))
+        for dataset_id in range(int(args.id), int(args.id) + args.N_ids):
+            runGreedy_Scan(dataset_id, int(args.N_jets))
         # runGreedy_Scan(Nstart, Nend, N_jets)
 
 
 
     """We ran a scan for 10 sets of 500 jets each. (Below as an example there is a scan for 4 sets of 2 jets each)"""
     if args.BSScan == "True":
-        runBSO_Scan(int(args.id), int(args.N_jets))
+        for dataset_id in range(int(args.id), int(args.id) + args.N_ids):
+            runBSO_Scan(dataset_id, int(args.N_jets))
         # runBSO_Scan(Nstart, Nend, N_jets)
 
 
+    if args.TrellisScan == "True":
+        for dataset_id in range(int(args.id), int(args.id) + args.N_ids):
+            runTrellis_Scan(dataset_id, int(args.N_jets))
+
+
+    if args.AStarScan == "True":
+        for dataset_id in range(int(args.id), int(args.id) + args.N_ids):
+            runAStar_Scan(dataset_id, int(args.N_jets))
+
+
     """We ran a scan for 10 sets of 500 jets each. (Below as an example there is a scan for 4 sets of 2 jets each)"""
     if args.KtAntiktCAscan == "True":
-        for alphaValue in [-1,0,1]:
-            runKtAntiKtCA_Scan(int(args.id), int(args.N_jets), alpha = alphaValue)
+        for dataset_id in range(int(args.id), int(args.id) + args.N_ids):
+            for alphaValue in [-1,0,1]:
+                runKtAntiKtCA_Scan(dataset_id, int(args.N_jets), alpha = alphaValue)
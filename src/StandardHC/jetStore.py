@@ -0,0 +1,311 @@
+import numpy as np
+import logging
+import pickle
+import struct
+import zipfile
+
+from .utils import get_logger
+
+logger = get_logger(level=logging.INFO)
+
+
+"""
+Columnar jet store: a list of jet dictionaries saved as flat arrays in a single (uncompressed) .npz file, instead of a pickle of python dictionaries.
+
+Layout:
+    - nodeOffsets: array of shape (Njets + 1,). The nodes of jet k are the rows nodeOffsets[k]:nodeOffsets[k+1] of the node columns.
+    - Node columns (one row per node of each jet, in the same order as the jet dictionary arrays):
+        - content: (Nnodes, 4) momentum of each node.
+        - tree: (Nnodes, 2) [left, right] children of each node, with the node ids of the jet (i.e. relative to nodeOffsets[k]). [-1, -1] for the leaves.
+        - deltas: (Nnodes,) delta of each node (if the jets have jet["deltas"]).
+        - logLH: (Nnodes,) log likelihood of each node splitting (if the jets have jet["logLH"] with one entry per node).
+    - leafOffsets, leaves: same for jet["leaves"] (if the jets have them).
+    - Scalar columns (one entry per jet): root_id, Nconst, sumLogLH, M_Hard, Lambda, LambdaRoot, pt_cut, algorithm. Missing values are NaN (or "" for algorithm).
+
+Each column is a separate member of the .npz file, so loadJetStore only reads the columns that are requested.
+The other keys of the jet dictionaries (e.g. dij, ConstPhi, PhiDelta, PhiDeltaRel, linkage_list, node_id, tree_ancestors, Delta_0, draws) are not stored,
+so the analysis that needs them has to use the pickle output of the scans (the default --output_format of jetClustering_invM).
+A jet that is None (e.g. the algorithm failed) is stored with no nodes and NaN scalars, and it is loaded back as None (see getJet).
+"""
+
+NODE_COLUMNS = ["content", "tree", "deltas", "logLH"]
+SCALAR_COLUMNS = ["root_id", "Nconst", "sumLogLH", "M_Hard", "Lambda", "LambdaRoot", "pt_cut"]
+
+
+
+
+def _scalar(jet, key):
+    """
+    Scalar value of jet[key] as a float (NaN if missing or None).
+    """
+    if jet is None or jet.get(key) is None:
+        return np.nan
+    return float(jet[key])
+
+
+
+
+def writeJetStore(filename, jetsList):
+    """
+    Save a list of jet dictionaries as a columnar jet store.
+
+    Args:
+        - filename: output .npz filename.
+        - jetsList: list of jet dictionaries (None entries are allowed).
+    """
+
+    jets = [jet if jet is not None else {} for jet in jetsList]
+
+    Nnodes = np.array([len(jet["tree"]) if "tree" in jet else 0 for jet in jets], dtype=np.int64)
+
+    store = {}
+    store["nodeOffsets"] = np.concatenate(([0], np.cumsum(Nnodes)))
+
+    store["content"] = np.concatenate(
+        [np.asarray(jet["content"], dtype=float).reshape(-1, 4) for jet in jets if "tree" in jet] + [np.zeros((0, 4))]
+    )
+    store["tree"] = np.concatenate(
+        [np.asarray(jet["tree"]).reshape(-1, 2).astype(np.int32) for jet in jets if "tree" in jet] + [np.zeros((0, 2), dtype=np.int32)]
+    )
+
+    """ Optional node columns, only if all the jets have one entry per node """
+    for key in ["deltas", "logLH"]:
+        if all(key in jet and len(jet[key]) == n for jet, n in zip(jets, Nnodes) if n > 0):
+            store[key] = np.concatenate([np.asarray(jet[key], dtype=float).reshape(-1) for jet in jets if "tree" in jet] + [np.zeros(0)])
+
+    if all("leaves" in jet for jet, n in zip(jets, Nnodes) if n > 0):
+        Nleaves = np.array([len(jet["leaves"]) if "leaves" in jet else 0 for jet in jets], dtype=np.int64)
+        store["leafOffsets"] = np.concatenate(([0], np.cumsum(Nleaves)))
+        store["leaves"] = np.concatenate(
+            [np.asarray(jet["leaves"], dtype=float).reshape(-1, 4) for jet in jets if "leaves" in jet] + [np.zeros((0, 4))]
+        )
+
+    """ Scalar columns """
+    store["root_id"] = np.array([jet.get("root_id", -1) for jet in jets], dtype=np.int64)
+    store["Nconst"] = np.array(
+        [np.sum(np.asarray(jet["tree"]).reshape(-1, 2)[:, 0] == -1) if "tree" in jet else 0 for jet in jets],
+        dtype=np.int64,
+    )
+    store["sumLogLH"] = np.array([np.sum(jet["logLH"]) if "logLH" in jet else np.nan for jet in jets])
+    for key in ["M_Hard", "Lambda", "LambdaRoot", "pt_cut"]:
+        store[key] = np.array([_scalar(jet, key) for jet in jets])
+    store["algorithm"] = np.array([str(jet.get("algorithm", "")) for jet in jets])
+
+    with open(filename, "wb") as f:
+        np.savez(f, **store)
+
+
+
+
+def loadJetStore(filename, columns=None):
+    """
+    Load the columns of a jet store. Only the requested columns are read from the file.
+
+    Args:
+        - filename: jet store .npz filename.
+        - columns: list with the names of the columns to load (e.g. ["sumLogLH", "Nconst"]). If None, load all the columns.
+          The offsets needed for the node columns are always included.
+
+    Returns:
+        - store: dictionary with the column name as a key and the array as the value.
+    """
+
+    with np.load(filename) as npz:
+
+        if columns is None:
+            columns = list(npz.files)
+
+        columns = list(columns)
+        if any(column in columns for column in NODE_COLUMNS):
+            columns.append("nodeOffsets")
+        if "leaves" in columns:
+            columns.append("leafOffsets")
+
+        store = {column: npz[column] for column in dict.fromkeys(columns)}
+
+    return store
+
+
+
+
+def getJet(store, k):
+    """
+    Build the dictionary of jet k from a jet store loaded with all the columns. The arrays are views into the store columns.
+    A jet stored with no nodes (a None jet in writeJetStore) is returned as None.
+    """
+
+    start, end = store["nodeOffsets"][k], store["nodeOffsets"][k + 1]
+    if start == end:
+        return None
+
+    jet = {}
+    for key in NODE_COLUMNS:
+        if key in store:
+            jet[key] = store[key][start:end]
+
+    if "leaves" in store:
+        jet["leaves"] = store["leaves"][store["leafOffsets"][k]:store["leafOffsets"][k + 1]]
+
+    for key in SCALAR_COLUMNS:
+        if key in store:
+            jet[key] = store[key][k].item()
+    if "algorithm" in store:
+        jet["algorithm"] = str(store["algorithm"][k])
+
+    for key in ["Lambda", "LambdaRoot"]:
+        if key in jet and np.isnan(jet[key]):
+            jet[key] = None
+
+    return jet
+
+
+
+
+def storeJetsList(store):
+    """
+    List of jet dictionaries of a jet store (see getJet).
+    """
+    return [getJet(store, k) for k in range(len(store["nodeOffsets"]) - 1)]
+
+
+
+
+def pickleToJetStore(in_filename, out_filename):
+    """
+    Convert a pickle with a list of jet dictionaries (or a (jetsList, jetsListLogLH) tuple) to a jet store.
+    """
+    with open(in_filename, "rb") as fd:
+        jetsList = pickle.load(fd, encoding='latin-1')
+
+    if isinstance(jetsList, tuple):
+        jetsList = jetsList[0]
+
+    writeJetStore(out_filename, jetsList)
+
+
+
+
+def concatJetStores(stores):
+    """
+    Concatenate jet stores loaded with the same columns (e.g. one for each dataset id) into a single one. The node and leaf offsets are shifted accordingly.
+    """
+    if len(stores) == 0:
+        return {}
+
+    store = {}
+    for key in stores[0]:
+        if key in ["nodeOffsets", "leafOffsets"]:
+            offsets = [s[key] for s in stores]
+            shifts = np.cumsum([0] + [o[-1] for o in offsets[:-1]])
+            store[key] = np.concatenate([offsets[0][0:1]] + [o[1:] + shift for o, shift in zip(offsets, shifts)])
+        else:
+            store[key] = np.concatenate([s[key] for s in stores])
+
+    return store
+
+
+
+
+def _npzMemmap(filename):
+    """
+    Memory map the members of an uncompressed .npz file (as written by writeJetStore) without reading them.
+
+    Args:
+        - filename: .npz filename.
+
+    Returns:
+        - arrays: dictionary with the member name as a key and a read-only np.memmap (a view into the file) as the value.
+    """
+
+    arrays = {}
+    with zipfile.ZipFile(filename) as zf, open(filename, "rb") as f:
+
+        for info in zf.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(f"{filename}: member {info.filename} is compressed and can not be memory mapped")
+
+            """ The member data starts after the zip local header (30 bytes + file name + extra field) """
+            f.seek(info.header_offset)
+            header = f.read(30)
+            nameLength, extraLength = struct.unpack("<HH", header[26:30])
+            f.seek(info.header_offset + 30 + nameLength + extraLength)
+
+            """ The array data starts after the .npy header """
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            elif version == (2, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            else:
+                raise ValueError(f"{filename}: unsupported .npy format version {version} for member {info.filename}")
+
+            name = info.filename[:-len(".npy")] if info.filename.endswith(".npy") else info.filename
+
+            """ mmap can not map an empty region """
+            if int(np.prod(shape)) == 0:
+                arrays[name] = np.zeros(shape, dtype=dtype)
+            else:
+                arrays[name] = np.memmap(
+                    filename,
+                    dtype=dtype,
+                    mode="r",
+                    offset=f.tell(),
+                    shape=shape,
+                    order="F" if fortran_order else "C",
+                )
+
+    return arrays
+
+
+
+
+class mmapJetDataset(object):
+    """
+    Read-only dataset of jets backed by a single memory mapped jet store file (see writeJetStore).
+
+    Nothing is read or unpickled when the dataset is opened: each jet is a dictionary (see getJet) whose arrays are views into the mapped file,
+    and the operating system only loads the pages that are accessed. The mapping is shared through the page cache, so several processes
+    can open the same file without copying it.
+
+    The dataset can be used as the "jetsList" of the auxFunctions_invM analysis helpers that only read the stored columns (tree, content, deltas, logLH, ...):
+    deltaRoot, subjetPt, subjetPhi, scanJets and scanTreeImbalance, e.g. auxFunctions_invM.deltaRoot({"jetsList": dataset}).
+    scanAngles and scanDij need jet["ConstPhi"], jet["PhiDelta"], jet["PhiDeltaRel"] and jet["dij"], that are not stored: use the pickle output of the scans for them.
+
+    Args:
+        - filename: jet store .npz filename. It has to be uncompressed (as written by writeJetStore).
+
+    Jets stored as None are returned as None, as in the jets list that was saved.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.columns = _npzMemmap(filename)
+        self.Njets = len(self.columns["nodeOffsets"]) - 1
+
+    def __len__(self):
+        return self.Njets
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return [self[i] for i in range(*k.indices(self.Njets))]
+        if k < 0:
+            k += self.Njets
+        if not 0 <= k < self.Njets:
+            raise IndexError(f"jet index {k} out of range for {self.Njets} jets")
+        return getJet(self.columns, k)
+
+    def __iter__(self):
+        for k in range(self.Njets):
+            yield getJet(self.columns, k)
+
+    def flatten(self):
+        """
+        The dataset itself, so that it can replace the jetsList numpy array in the loops over jetDic["jetsList"].flatten().
+        """
+        return self
+
+    def column(self, name):
+        """
+        Memory mapped column of the store (e.g. "sumLogLH" for all the jets).
+        """
+        return self.columns[name]
@@ -1,7 +1,17 @@
 import pickle
+import math
 import numpy as np
 import torch
+import logging
 from scipy.special import logsumexp
+from scipy import optimize
+
+from . import treeKernels
+from .utils import get_logger
+
+logger = get_logger(level=logging.INFO)
+
+LOG2 = math.log(2)
 
 
 def get_delta_LR(pL, pR):
@@ -24,6 +34,26 @@ def get_delta_LR(pL, pR):
 
 
 
+def log1mexp(x):
+    """
+    Numerically stable log(1 - exp(-x)), for x >= 0 (scalar or array), as in M. Maechler, "Accurately Computing log(1 - exp(-|a|))":
+        - x <= log(2): log(-expm1(-x)). For small x, 1 - exp(-x) is computed without cancellation (it goes as log(x) for x -> 0).
+        - x > log(2): log1p(-exp(-x)). For large x, it goes as -exp(-x) instead of rounding to 0.
+
+    Accuracy envelope (compared with 400 digit mpmath values): relative error below 2.5e-16 (about 1 ulp) for 1e-300 <= x <= 700.
+    log1mexp(0) = -inf, and it underflows to -0. for x > ~745 (where exp(-x) is below the smallest double).
+    The direct np.log(1 - np.exp(-x)) has a relative error that grows as ~1e-16 / x for small x and gives -inf for x below ~4e-17,
+    so splittings with lam * t_cut / tP below ~4e-17 were scored as not allowed.
+    """
+    x = np.asarray(x, dtype=float)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        result = np.where(x <= np.log(2), np.log(-np.expm1(-x)), np.log1p(-np.exp(-x)))
+
+    return result if result.ndim > 0 else result[()]
+
+
+
 def split_logLH(pL, tL, pR, tR, t_cut, lam):
     """
     Take two nodes and return the splitting log likelihood
@@ -41,10 +71,10 @@ def split_logLH(pL, tL, pR, tR, t_cut, lam):
     """ We add a normalization factor -np.log(1 - np.exp(- lam)) because we need the mass squared to be strictly decreasing """
     def get_p(tP, t, t_cut, lam):
         if t > 0:
-            return -np.log(1 - np.exp(- lam)) + np.log(lam) - np.log(tP) - lam * t / tP
+            return -log1mexp(lam) + np.log(lam) - np.log(tP) - lam * t / tP
 
         else: # if t<t_min then we set t=0
-            return -np.log(1 - np.exp(- lam)) + np.log(1 - np.exp(-lam * t_cut / tP))
+            return -log1mexp(lam) + log1mexp(lam * t_cut / tP)
 
     """We sample a unit vector uniformly over the 2-sphere, so the angular likelihood is 1/(4*pi)"""
     logLH = (
@@ -62,166 +92,744 @@ def split_logLH(pL, tL, pR, tR, t_cut, lam):
 
 
 
-def fill_jet_info(jet, parent_id=None):
+"""####################################"""
+""" Batched likelihood kernels: score P pairs of nodes in one NumPy pass """
+
+def get_invM_batch(p):
     """
-    Fill jet["deltas"] amd jet["draws"] given jet["tree"] and jet["content"]
-    Assing r = None to the root and the leaves, and assign delta = 0 to the leaves
+    Calculate the invariant mass squared of a batch of nodes.
+
+    Args:
+        - p: array of shape (P, 4) with the nodes momentum vectors.
+
+    Returns:
+        - array of shape (P,)
     """
-    deltas = []
-    draws = []
+    p = np.asarray(p, dtype=float).reshape(-1, 4)
 
-    root_id = jet["root_id"]
+    return p[:, 0] ** 2 - np.linalg.norm(p[:, 1::], axis=1) ** 2
 
-    _get_jet_info(jet, root_id=root_id, parent_id=parent_id, deltas=deltas, draws=draws)
 
-    jet["deltas"] = deltas
-    jet["draws"] = draws
+def get_delta_LR_batch(pL, pR):
+    """
+    Calculate the invariant mass squared of a batch of parent nodes, given their children momenta.
+    Batched version of get_delta_LR.
 
-    return jet
+    Args:
+        - pL, pR: arrays of shape (P, 4) with the left and right children momentum vectors.
 
-def _get_jet_info(jet, root_id=None, parent_id=None, deltas=None, draws=None):
+    Returns:
+        - array of shape (P,)
     """
-    Recursion to fill jet["deltas"] amd jet["draws"]
-    """
-
-    if jet["tree"][root_id][0] != -1 and jet["tree"][root_id][1] != -1:
-
-        idL = jet["tree"][root_id][0]
-        idR = jet["tree"][root_id][1]
-        pL = jet["content"][idL]
-        pR = jet["content"][idR]
-        delta = get_delta_LR(pL, pR)
-        if parent_id is not None:
-            # print("Parent id = ", parent_id)
-            # print("Len deltas = ",len(deltas))
-            # pP = jet["content"][parent_id]
-            # delta_parent2 = pP[0] ** 2 - np.linalg.norm(pP[1::]) ** 2
-            delta_parent = deltas[parent_id]
-            # print("DP 1 = ",delta_parent)
-            # print("DP 2 = ", delta_parent2)
-            r = torch.tensor(delta / delta_parent)
-        else:
-            r = None
+    pP = np.asarray(pR, dtype=float).reshape(-1, 4) + np.asarray(pL, dtype=float).reshape(-1, 4)
 
-        deltas.append(delta)
-        draws.append(r)
+    return get_invM_batch(pP)
 
-        _get_jet_info(jet, root_id=idL, parent_id=root_id, deltas=deltas, draws=draws)
-        _get_jet_info(jet, root_id=idR, parent_id=root_id, deltas=deltas, draws=draws)
 
-    else:
-        if jet["tree"][root_id][0] * jet["tree"][root_id][1] != 1:
-            raise ValueError(f"Invalid jet left and right child are not both -1")
-        else:
-            deltas.append(0)
-            draws.append(None)
 
+def split_logLH_batch(pL, tL, pR, tR, t_cut, lam):
+    """
+    Batched version of split_logLH. Take P pairs of nodes and return the P splitting log likelihoods.
+    Pairs that are not allowed (tp < t_cut) get logLH = - np.inf, as in split_logLH.
 
-def enrich_jet_logLH(jet, delta_min=None, dij=False, alpha = None):
+    Args:
+        - pL, pR: arrays of shape (P, 4) with the left and right nodes momentum vectors.
+        - tL, tR: arrays of shape (P,) with the left and right nodes invariant mass squared.
+        - t_cut: pT cut scale for the showering process to stop.
+        - lam: decaying rate value for the exponential distribution. Either a scalar or an array of shape (P,).
+
+    Returns:
+        - logLH: array of shape (P,)
+    """
+    tL = np.asarray(tL, dtype=float).reshape(-1)
+    tR = np.asarray(tR, dtype=float).reshape(-1)
+
+    """Parent invariant mass squared"""
+    tp1 = get_delta_LR_batch(pL, pR)
+
+    tmax = np.maximum(tL, tR)
+    tmin = np.minimum(tL, tR)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+
+        tp2 = (np.sqrt(tp1) - np.sqrt(tmax)) ** 2
+
+        def get_p(tP, t):
+            inner = -log1mexp(lam) + np.log(lam) - np.log(tP) - lam * t / tP
+            outer = -log1mexp(lam) + log1mexp(lam * t_cut / tP)
+            return np.where(t > 0, inner, outer)
+
+        logLH = (
+            get_p(tp1, tmax)
+            + get_p(tp2, tmin)
+            + np.log(1 / (4 * np.pi))
+        )
+
+    "If the pairing is not allowed"
+    logLH[tp1 < t_cut] = - np.inf
+
+    return logLH
+
+
+
+def split_logLH_with_stop_nonstop_prob_batch(pL, pR, t_cut, lam):
     """
-    Attach splitting log likelihood to each edge, by calling recursive
-    _get_jet_likelihood.
+    Batched version of split_logLH_with_stop_nonstop_prob. Take P pairs of nodes and return the P splitting log likelihoods.
+    The pairings that are not allowed within the model get logLH = - np.inf:
+        - tp <= 0, tL < 0 or tR < 0
+        - tp <= t_cut
+        - tL or tR are not smaller than tp (mass ordering)
+        - sqrt(tL) + sqrt(tR) > sqrt(tp) (invariant mass triangle inequality)
+
+    Args:
+        - pL, pR: arrays of shape (P, 4) with the left and right nodes momentum vectors.
+        - t_cut: pT cut scale for the showering process to stop.
+        - lam: decaying rate value for the exponential distribution. Either a scalar or an array of shape (P,).
+
+    Returns:
+        - logLH: array of shape (P,)
     """
-    logLH = []
-    dijList = []
+    tL = get_invM_batch(pL)
+    tR = get_invM_batch(pR)
 
-    root_id = jet["root_id"]
+    """Parent invariant mass squared"""
+    tp = get_delta_LR_batch(pL, pR)
+
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+
+        allowed = (
+            (tp > 0) & (tL >= 0) & (tR >= 0)
+            & (tp > t_cut)
+            & (tL < (1 - 1e-3) * tp) & (tR < (1 - 1e-3) * tp)
+            & ~(np.sqrt(tL) + np.sqrt(tR) > np.sqrt(tp))
+        )
+
+        def get_logp(tP_local, t):
+            """ Same two branches as get_logp in split_logLH_with_stop_nonstop_prob """
+            log_norm = -log1mexp((1. - 1e-3) * lam)
+            inner = log_norm + np.log(lam) - np.log(tP_local) - lam * t / tP_local
+            t_upper = np.minimum(tP_local, t_cut)
+            outer = log_norm + log1mexp(lam * t_upper / tP_local)
+            return np.where(t > t_cut, inner, outer)
+
+        tpLR = (np.sqrt(tp) - np.sqrt(tL)) ** 2
+        tpRL = (np.sqrt(tp) - np.sqrt(tR)) ** 2
+
+        logpLR = np.log(1 / 2) + get_logp(tp, tL) + get_logp(tpLR, tR)  # First sample tL
+        logpRL = np.log(1 / 2) + get_logp(tp, tR) + get_logp(tpRL, tL)  # First sample tR
+
+        logp_split = np.logaddexp(logpLR, logpRL)
+
+    logLH = np.where(allowed, logp_split + np.log(1 / (4 * np.pi)), - np.inf)
+
+    return logLH
+
+
+
+def get_dij_batch(pL, pR, alphas=(-1, 0, 1)):
+    """
+    Generalized kt distances of P pairs of nodes, for each value of alpha:
+    dij=min(pTi^(2 alpha),pTj^(2 alpha)) * [arccos((pi.pj)/|pi|*|pj|)]^2
+
+    Args:
+        - pL, pR: arrays of shape (P, 4) with the left and right nodes momentum vectors.
+        - alphas: values of alpha ({-1,0,1} for the {anti-kt, CA and kt} algorithms).
+
+    Returns:
+        - dij: array of shape (P, len(alphas))
+    """
+    pL = np.asarray(pL, dtype=float).reshape(-1, 4)
+    pR = np.asarray(pR, dtype=float).reshape(-1, 4)
+
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+
+        cosLR = np.sum(pL[:, 1::] * pR[:, 1::], axis=1) / (np.linalg.norm(pL[:, 1::], axis=1) * np.linalg.norm(pR[:, 1::], axis=1))
+        angle2 = np.arccos(np.clip(cosLR, -1, 1)) ** 2
+
+        ptL = np.linalg.norm(pL[:, 1:3], axis=1)
+        ptR = np.linalg.norm(pR[:, 1:3], axis=1)
+
+        dij = np.stack([np.minimum(ptL ** (2 * alpha), ptR ** (2 * alpha)) * angle2 for alpha in alphas], axis=1)
+
+    return dij
+
+
+
+def get_jet_logLH_batch(jet, delta_min=None, dij=False):
+    """
+    Tree-level evaluator: gather the (left, right) children momenta of all the inner nodes of the tree with one indexing operation and score all the splittings at once
+    (see split_logLH_with_stop_nonstop_prob_batch). The root splitting is scored with jet["LambdaRoot"] and the rest with jet["Lambda"].
+
+    Args:
+        - jet: jet dictionary with jet["tree"], jet["content"], jet["root_id"], jet["Lambda"] and jet["LambdaRoot"].
+        - delta_min: pT cut scale for the showering process to stop. If None, jet["pt_cut"].
+        - dij: if True, also get the generalized kt distances of each splitting.
+
+    Returns:
+        - logLH: array with the splitting log likelihood of each node of the tree, in preorder (0 for the leaves).
+        - dijs: array of shape (Ninner, 4) with [logLH, dij anti-kt, dij CA, dij kt] for each inner node, in preorder (None if dij=False).
+    """
 
     if delta_min is None:
         delta_min = jet.get("pt_cut")
         if delta_min is None:
             raise ValueError(f"No pt_cut specified by the jet.")
 
-    _get_jet_logLH(
-        jet,
-        root_id = root_id,
-        delta_min = delta_min,
-        logLH = logLH,
-        dij = dij,
-        dijList = dijList,
-        alpha = alpha,
-    )
+    tree = np.asarray(jet["tree"]).reshape(-1, 2)
+    content = np.asarray(jet["content"], dtype=float).reshape(-1, 4)
 
-    jet["logLH"] = np.asarray(logLH)
-    jet["dij"] = dijList
-    return jet
+    order = treeKernels.preorder(tree, jet["root_id"])
+    inner = tree[order, 0] != -1
+    nodes = order[inner]
+
+    pL = content[tree[nodes, 0]]
+    pR = content[tree[nodes, 1]]
+
+    lam = np.full(len(nodes), float(jet["Lambda"]))
+    lam[nodes == jet["root_id"]] = float(jet["LambdaRoot"])
 
+    logLH = np.zeros(len(order))
+    logLH[inner] = split_logLH_with_stop_nonstop_prob_batch(pL, pR, delta_min, lam)
 
-def _get_jet_logLH(
-        jet,
-        root_id = None,
-        delta_min = None,
-        logLH = None,
-        dij = False,
-        dijList = None,
-        alpha = None
-):
+    dijs = None
+    if dij:
+        dijs = np.concatenate((logLH[inner][:, None], get_dij_batch(pL, pR)), axis=1)
+
+    return logLH, dijs
+
+
+
+
+def _segment_sum(values, offsets):
     """
-    Recursively enrich every edge from root_id downward with their log likelihood.
-    log likelihood of a leaf is 0. Assumes a valid jet.
+    Sum of values[..., offsets[k]:offsets[k+1]] for each segment k, along the last axis (0 for the empty segments, which np.add.reduceat does not give).
     """
-    if jet["tree"][root_id][0] != -1:
+    Nsegments = len(offsets) - 1
+    out = np.zeros(values.shape[:-1] + (Nsegments,))
+    nonEmpty = np.flatnonzero(np.diff(offsets) > 0)
+    if len(nonEmpty) > 0:
+        out[..., nonEmpty] = np.add.reduceat(values, offsets[nonEmpty], axis=-1)
+    return out
+
 
 
-        idL = jet["tree"][root_id][0]
-        idR = jet["tree"][root_id][1]
-        pL = jet["content"][idL]
-        pR = jet["content"][idR]
-        tL = jet["deltas"][idL]
-        tR = jet["deltas"][idR]
+def _jet_param(jet, key):
+    """ jet[key] as a float (NaN if missing or None) """
+    if jet is None or jet.get(key) is None:
+        return np.nan
+    return float(jet[key])
 
-        Lambda = jet["Lambda"]
-        if root_id == jet["root_id"]:
-            Lambda = jet["LambdaRoot"]
 
 
-        # llh = split_logLH(pL, tL, pR, tR, delta_min, Lambda)
-        llh = split_logLH_with_stop_nonstop_prob(pL, pR, delta_min, Lambda)
-        logLH.append(llh)
-        # print('logLH = ', llh)
+def pack_jet_splits(jets):
+    """
+    Pack the splittings (inner nodes) of many jets into concatenated arrays, with the offsets of the splittings of each jet.
+    The packing only depends on the trees, so it can be reused to score the same jets under different Lambda / pt_cut hypotheses (see score_jet_splits).
+
+    Args:
+        - jets: list of jet dictionaries (None entries are allowed, e.g. when the algorithm failed for a jet),
+          or a jet store with the "content", "tree" and "root_id" columns (see jetStore.loadJetStore), that is packed without a python loop over the jets.
+
+    Returns:
+        - splits: dictionary with
+            - pL, pR: arrays of shape (S, 4) with the left and right children momenta of the S splittings.
+            - isRoot: boolean array of shape (S,). True for the root splitting of each jet.
+            - offsets: array of shape (Njets + 1,). The splittings of jet k are splits[offsets[k]:offsets[k+1]].
+            - valid: boolean array of shape (Njets,). False for the None jets.
+            - Lambda, LambdaRoot, pt_cut: arrays of shape (Njets,) with the parameters of each jet (NaN if missing).
+    """
 
-        if dij:
+    if isinstance(jets, dict):
+        nodeOffsets = np.asarray(jets["nodeOffsets"])
+        Nnodes = np.diff(nodeOffsets)
+        tree = np.asarray(jets["tree"])
+        content = np.asarray(jets["content"], dtype=float)
+
+        """ Jet of each node and global ids of the children """
+        jetIds = np.repeat(np.arange(len(Nnodes)), Nnodes)
+        inner = np.flatnonzero(tree[:, 0] != -1)
+        shift = nodeOffsets[jetIds[inner]]
+
+        splits = {
+            "pL": content[tree[inner, 0] + shift],
+            "pR": content[tree[inner, 1] + shift],
+            "isRoot": inner - shift == np.asarray(jets["root_id"])[jetIds[inner]],
+            "offsets": np.concatenate(([0], np.cumsum(np.bincount(jetIds[inner], minlength=len(Nnodes))))),
+            "valid": Nnodes > 0,
+        }
+        for key in ["Lambda", "LambdaRoot", "pt_cut"]:
+            splits[key] = np.asarray(jets[key], dtype=float) if key in jets else np.full(len(Nnodes), np.nan)
+
+        return splits
+
+    pL, pR, isRoot, Nsplits = [], [], [], []
+    for jet in jets:
+        if jet is None:
+            Nsplits.append(0)
+            continue
+
+        tree = np.asarray(jet["tree"]).reshape(-1, 2)
+        content = np.asarray(jet["content"], dtype=float).reshape(-1, 4)
+        inner = np.flatnonzero(tree[:, 0] != -1)
+
+        pL.append(content[tree[inner, 0]])
+        pR.append(content[tree[inner, 1]])
+        isRoot.append(inner == jet["root_id"])
+        Nsplits.append(len(inner))
+
+    splits = {
+        "pL": np.concatenate(pL + [np.zeros((0, 4))]),
+        "pR": np.concatenate(pR + [np.zeros((0, 4))]),
+        "isRoot": np.concatenate(isRoot + [np.zeros(0, dtype=bool)]),
+        "offsets": np.concatenate(([0], np.cumsum(Nsplits))).astype(np.int64),
+        "valid": np.array([jet is not None for jet in jets], dtype=bool),
+    }
+    for key in ["Lambda", "LambdaRoot", "pt_cut"]:
+        splits[key] = np.array([_jet_param(jet, key) for jet in jets])
+
+    return splits
+
+
+
+def score_jet_splits(splits, lam=None, lamRoot=None, delta_min=None):
+    """
+    Score all the packed splittings in one batch (see split_logLH_with_stop_nonstop_prob_batch) and reduce them with a segment sum into the total log likelihood of each jet.
 
-            """ dij=min(pTi^(2 alpha),pTj^(2 alpha)) * [arccos((pi.pj)/|pi|*|pj|)]^2 """
-            dijs= [float(llh)]
+    Args:
+        - splits: packed splittings (see pack_jet_splits).
+        - lam: decaying rate value for the exponential distribution. Either a scalar or an array of shape (Njets,). If None, the Lambda of each jet.
+        - lamRoot: decaying rate value for the root splitting. Same options. If None, the LambdaRoot of each jet.
+        - delta_min: pT cut scale for the showering process to stop. Same options. If None, the pt_cut of each jet.
 
-            for alpha in [-1,0,1]:
+    Returns:
+        - sumLogLH: array of shape (Njets,) with the sum of the splittings log likelihood of each jet (0 for a jet with a single constituent and NaN for the None jets).
+    """
 
-                tempCos = np.dot(pL[1::], pR[1::]) / (np.linalg.norm(pL[1::]) * np.linalg.norm(pR[1::]))
-                if abs(tempCos) > 1: tempCos = np.sign(tempCos)
+    offsets = splits["offsets"]
+    Njets = len(offsets) - 1
+    Nsplits = np.diff(offsets)
 
-                dijVal = np.sort((np.array([np.linalg.norm(pL[1:3]),np.linalg.norm(pR[1:3])])) ** (2 * alpha))[0]  * \
-                         (
-                             np.arccos(tempCos)
-                          ) ** 2
+    def _perSplit(value, default):
+        """ Parameter of the jet of each splitting """
+        value = splits[default] if value is None else np.broadcast_to(np.asarray(value, dtype=float), (Njets,))
+        return np.repeat(value, Nsplits)
 
-                dijs.append(dijVal)
+    lamSplit = np.where(splits["isRoot"], _perSplit(lamRoot, "LambdaRoot"), _perSplit(lam, "Lambda"))
 
-            dijList.append(dijs)
+    logLH = split_logLH_with_stop_nonstop_prob_batch(
+        splits["pL"],
+        splits["pR"],
+        _perSplit(delta_min, "pt_cut"),
+        lamSplit,
+    )
 
+    sumLogLH = _segment_sum(logLH, offsets)
+    sumLogLH[~splits["valid"]] = np.nan
 
-        _get_jet_logLH(
-            jet,
-            root_id = idL,
-            delta_min = delta_min,
-            logLH = logLH,
-            dij = dij,
-            dijList = dijList,
-            alpha = alpha,
-        )
-        _get_jet_logLH(
-            jet,
-            root_id = idR,
-            delta_min = delta_min,
-            logLH = logLH,
-            dij = dij,
-            dijList = dijList,
-            alpha = alpha,
+    return sumLogLH
+
+
+
+def get_jets_sumLogLH_batch(jets, lam=None, lamRoot=None, delta_min=None):
+    """
+    Total log likelihood of each jet of a list of jets (or a jet store) in one call. See pack_jet_splits and score_jet_splits.
+    """
+    return score_jet_splits(pack_jet_splits(jets), lam=lam, lamRoot=lamRoot, delta_min=delta_min)
+
+
+
+
+def get_split_invariants(pL, pR):
+    """
+    Kinematic invariants of P splittings, that do not depend on Lambda or t_cut. They are computed once per tree to scan the likelihood over a grid of parameters (see split_logLH_grid).
+
+    Args:
+        - pL, pR: arrays of shape (P, 4) with the left and right nodes momentum vectors.
+
+    Returns:
+        - invariants: dictionary of arrays of shape (P,) with
+            - tp: parent invariant mass squared.
+            - log_tp, log_tpLR, log_tpRL: log of the parent invariant mass squared of the first and second sampling in each order (first sample tL or tR).
+            - rL, rR: tL / tp and tR / tp.
+            - rLR, rRL: tR / tpLR and tL / tpRL, with tpLR = (sqrt(tp) - sqrt(tL)) ** 2 and tpRL = (sqrt(tp) - sqrt(tR)) ** 2.
+            - tL, tR: children invariant mass squared.
+            - allowed: the splitting is allowed by the mass constraints (tp > 0, tL >= 0, tR >= 0, mass ordering and triangle inequality). The tp > t_cut condition is applied in split_logLH_grid.
+    """
+    tL = get_invM_batch(pL)
+    tR = get_invM_batch(pR)
+    tp = get_delta_LR_batch(pL, pR)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+
+        allowed = (
+            (tp > 0) & (tL >= 0) & (tR >= 0)
+            & (tL < (1 - 1e-3) * tp) & (tR < (1 - 1e-3) * tp)
+            & ~(np.sqrt(tL) + np.sqrt(tR) > np.sqrt(tp))
         )
 
-    else:
+        tpLR = (np.sqrt(tp) - np.sqrt(tL)) ** 2
+        tpRL = (np.sqrt(tp) - np.sqrt(tR)) ** 2
+
+        invariants = {
+            "tp": tp,
+            "tL": tL,
+            "tR": tR,
+            "log_tp": np.log(tp),
+            "log_tpLR": np.log(tpLR),
+            "log_tpRL": np.log(tpRL),
+            "rL": tL / tp,
+            "rR": tR / tp,
+            "rLR": tR / tpLR,
+            "rRL": tL / tpRL,
+            "allowed": allowed,
+        }
+
+    return invariants
+
+
+
+def split_logLH_grid(invariants, lam, t_cut):
+    """
+    Splitting log likelihood of P splittings over a grid of Lambda x t_cut values, with broadcasting. Same model as split_logLH_with_stop_nonstop_prob_batch.
+
+    Args:
+        - invariants: kinematic invariants of the splittings (see get_split_invariants).
+        - lam: array of shape (n_lambda,) or (n_lambda, P) (e.g. a different Lambda for the root splittings).
+        - t_cut: array of shape (n_tcut,).
+
+    Returns:
+        - logLH: array of shape (n_lambda, n_tcut, P)
+    """
+    lam = np.asarray(lam, dtype=float)
+    lam = lam.reshape(len(lam), 1, -1)
+    t_cut = np.asarray(t_cut, dtype=float).reshape(1, -1, 1)
+
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+
+        log_norm = -log1mexp((1. - 1e-3) * lam)
+        log_lam = np.log(lam)
+
+        def get_logp(log_tP, r, t):
+            """ Same two branches as get_logp in split_logLH_with_stop_nonstop_prob, with r = t / tP.
+            The inner branch does not depend on t_cut, so it is only evaluated over the Lambda axis """
+            inner = log_norm + log_lam - log_tP - lam * r
+            t_upper_ratio = np.minimum(1., t_cut * np.exp(- log_tP))
+            outer = log_norm + log1mexp(lam * t_upper_ratio)
+            return np.where(t > t_cut, inner, outer)
+
+        logpLR = np.log(1 / 2) + get_logp(invariants["log_tp"], invariants["rL"], invariants["tL"]) \
+                 + get_logp(invariants["log_tpLR"], invariants["rLR"], invariants["tR"])  # First sample tL
+        logpRL = np.log(1 / 2) + get_logp(invariants["log_tp"], invariants["rR"], invariants["tR"]) \
+                 + get_logp(invariants["log_tpRL"], invariants["rRL"], invariants["tL"])  # First sample tR
+
+        logp_split = np.logaddexp(logpLR, logpRL)
+
+    allowed = invariants["allowed"] & (invariants["tp"] > t_cut)
+
+    return np.where(allowed, logp_split + np.log(1 / (4 * np.pi)), - np.inf)
+
+
+
+def scan_jets_logLH_grid(jets, lams, t_cuts, lamRoot=None, scanLambdaRoot=False, maxElements=2 ** 18):
+    """
+    Total log likelihood of fixed trees over a 2D grid of Lambda x pt_cut values.
+    The kinematic invariants of each splitting are computed once (see get_split_invariants) and the grid is evaluated with broadcasting.
+    The splittings are processed in chunks of whole jets with at most maxElements grid entries, to bound the memory.
+
+    Args:
+        - jets: list of jet dictionaries, a jet store (see pack_jet_splits) or packed splittings.
+        - lams: array of shape (n_lambda,) with the Lambda values.
+        - t_cuts: array of shape (n_tcut,) with the pt_cut values.
+        - lamRoot: Lambda for the root splittings. Either a scalar or an array of shape (Njets,). If None, the LambdaRoot of each jet.
+        - scanLambdaRoot: if True, the root splittings also take the Lambda values of the grid (and lamRoot is ignored).
+        - maxElements: maximum number of (Lambda, pt_cut, splitting) entries evaluated at once (small chunks stay in the CPU cache).
+
+    Returns:
+        - logLH: array of shape (Njets, n_lambda, n_tcut) with the log likelihood surface of each jet (NaN for the None jets).
+    """
+
+    splits = jets if isinstance(jets, dict) and "offsets" in jets else pack_jet_splits(jets)
+
+    lams = np.asarray(lams, dtype=float).reshape(-1)
+    t_cuts = np.asarray(t_cuts, dtype=float).reshape(-1)
+
+    offsets = splits["offsets"]
+    Njets = len(offsets) - 1
+    Nsplits = np.diff(offsets)
+
+    if lamRoot is None:
+        lamRoot = splits["LambdaRoot"]
+    lamRoot = np.repeat(np.broadcast_to(np.asarray(lamRoot, dtype=float), (Njets,)), Nsplits)
+
+    invariants = get_split_invariants(splits["pL"], splits["pR"])
+
+    logLH = np.zeros((Njets, len(lams), len(t_cuts)))
+
+    """ Chunks of whole jets """
+    maxSplits = max(1, maxElements // max(1, len(lams) * len(t_cuts)))
+    k1 = 0
+    while k1 < Njets:
+        k2 = max(k1 + 1, int(np.searchsorted(offsets, offsets[k1] + maxSplits, side="right")) - 1)
+        k2 = min(k2, Njets)
+        s1, s2 = offsets[k1], offsets[k2]
+
+        if s2 > s1:
+            chunk = {key: value[s1:s2] for key, value in invariants.items()}
+
+            lamSplit = np.broadcast_to(lams[:, None], (len(lams), s2 - s1))
+            if not scanLambdaRoot:
+                lamSplit = np.where(splits["isRoot"][s1:s2], lamRoot[s1:s2], lamSplit)
+
+            chunkLogLH = split_logLH_grid(chunk, lamSplit, t_cuts)
+
+            """ Segment sum over the splittings of each jet """
+            logLH[k1:k2] = np.moveaxis(_segment_sum(chunkLogLH, offsets[k1:k2 + 1] - s1), 2, 0)
+
+        k1 = k2
+
+    logLH[~splits["valid"]] = np.nan
+
+    return logLH
+
+
+
+
+def split_logLH_grad_batch(pL, pR, t_cut, lam):
+    """
+    Splitting log likelihood of P pairs of nodes (see split_logLH_with_stop_nonstop_prob_batch) and its analytic derivative with respect to Lambda.
+
+    With c = 1 - 1e-3, the normalization term N(lam) = -log(1 - exp(-c lam)) has dN/dlam = -c / (exp(c lam) - 1), and for each of the 4 get_logp terms:
+        - inner (t > t_cut): N + log(lam) - log(tP) - lam t / tP, with derivative N' + 1 / lam - t / tP
+        - leaf CDF (t <= t_cut): N + log(1 - exp(-lam u)) with u = min(tP, t_cut) / tP, with derivative N' + u / (exp(lam u) - 1)
+    The 2 sampling orders (first sample tL or tR) are combined with logaddexp, so the derivative is the average of their derivatives weighted by their probability.
+
+    Args:
+        - pL, pR: arrays of shape (P, 4) with the left and right nodes momentum vectors.
+        - t_cut: pT cut scale for the showering process to stop. Either a scalar or an array of shape (P,).
+        - lam: decaying rate value for the exponential distribution. Either a scalar or an array of shape (P,).
+
+    Returns:
+        - logLH: array of shape (P,) (- np.inf for the pairings that are not allowed).
+        - dlogLH: array of shape (P,) with d logLH / d lam (0 for the pairings that are not allowed, that do not depend on lam).
+    """
+    invariants = get_split_invariants(pL, pR)
+
+    lam = np.broadcast_to(np.asarray(lam, dtype=float), invariants["tp"].shape)
+    t_cut = np.asarray(t_cut, dtype=float)
+
+    c = 1. - 1e-3
+
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+
+        log_norm = -log1mexp(c * lam)
+        dlog_norm = - c / np.expm1(c * lam)
+
+        def get_logp(log_tP, r, t):
+            """ Same two branches as get_logp in split_logLH_with_stop_nonstop_prob, with r = t / tP, and their derivatives """
+            inner = log_norm + np.log(lam) - log_tP - lam * r
+            dinner = dlog_norm + 1 / lam - r
+
+            u = np.minimum(1., t_cut * np.exp(- log_tP))
+            outer = log_norm + log1mexp(lam * u)
+            douter = dlog_norm + u / np.expm1(lam * u)
+
+            isInner = t > t_cut
+            return np.where(isInner, inner, outer), np.where(isInner, dinner, douter)
+
+        logp1, dlogp1 = get_logp(invariants["log_tp"], invariants["rL"], invariants["tL"])
+        logp2, dlogp2 = get_logp(invariants["log_tpLR"], invariants["rLR"], invariants["tR"])
+        logpLR = np.log(1 / 2) + logp1 + logp2  # First sample tL
+        dlogpLR = dlogp1 + dlogp2
+
+        logp1, dlogp1 = get_logp(invariants["log_tp"], invariants["rR"], invariants["tR"])
+        logp2, dlogp2 = get_logp(invariants["log_tpRL"], invariants["rRL"], invariants["tL"])
+        logpRL = np.log(1 / 2) + logp1 + logp2  # First sample tR
+        dlogpRL = dlogp1 + dlogp2
+
+        logp_split = np.logaddexp(logpLR, logpRL)
+        dlogp_split = np.exp(logpLR - logp_split) * dlogpLR + np.exp(logpRL - logp_split) * dlogpRL
+
+    allowed = invariants["allowed"] & (invariants["tp"] > t_cut)
+
+    logLH = np.where(allowed, logp_split + np.log(1 / (4 * np.pi)), - np.inf)
+    dlogLH = np.where(allowed, dlogp_split, 0.)
+
+    return logLH, dlogLH
+
+
+
+def get_jets_logLH_grad(jets, lam=None, lamRoot=None, delta_min=None):
+    """
+    Total log likelihood of fixed trees and its analytic derivatives with respect to Lambda and LambdaRoot (see split_logLH_grad_batch).
+
+    Args:
+        - jets: list of jet dictionaries, a jet store or packed splittings (see pack_jet_splits).
+        - lam, lamRoot, delta_min: Lambda, LambdaRoot and pt_cut. Either scalars or arrays of shape (Njets,). If None, the values of each jet.
+
+    Returns:
+        - sumLogLH: array of shape (Njets,) with the log likelihood of each jet (NaN for the None jets).
+        - dLambda: array of shape (Njets,) with d sumLogLH / d Lambda (from all the splittings but the root one).
+        - dLambdaRoot: array of shape (Njets,) with d sumLogLH / d LambdaRoot (from the root splitting).
+    """
+
+    splits = jets if isinstance(jets, dict) and "offsets" in jets else pack_jet_splits(jets)
+
+    offsets = splits["offsets"]
+    Njets = len(offsets) - 1
+    Nsplits = np.diff(offsets)
+
+    def _perSplit(value, default):
+        """ Parameter of the jet of each splitting """
+        value = splits[default] if value is None else np.broadcast_to(np.asarray(value, dtype=float), (Njets,))
+        return np.repeat(value, Nsplits)
+
+    isRoot = splits["isRoot"]
+    lamSplit = np.where(isRoot, _perSplit(lamRoot, "LambdaRoot"), _perSplit(lam, "Lambda"))
+
+    logLH, dlogLH = split_logLH_grad_batch(splits["pL"], splits["pR"], _perSplit(delta_min, "pt_cut"), lamSplit)
+
+    sumLogLH = _segment_sum(logLH, offsets)
+    dLambda = _segment_sum(np.where(isRoot, 0., dlogLH), offsets)
+    dLambdaRoot = _segment_sum(np.where(isRoot, dlogLH, 0.), offsets)
+
+    for array in [sumLogLH, dLambda, dLambdaRoot]:
+        array[~splits["valid"]] = np.nan
+
+    return sumLogLH, dLambda, dLambdaRoot
+
+
+
+def fit_jets_Lambda(jets, lam0=1., lamRoot0=None, delta_min=None, fitLambdaRoot=True, bounds=(1e-3, 1e3), options=None):
+    """
+    Maximum likelihood fit of Lambda (and LambdaRoot) shared by a sample of fixed trees, with L-BFGS-B and the analytic gradient (see get_jets_logLH_grad).
+    Each step is one vectorized evaluation over all the splittings of the sample (packed once).
+    The jets that are not allowed by the model (log likelihood - np.inf, which does not depend on Lambda) or are None are left out of the fit.
+
+    Args:
+        - jets: list of jet dictionaries, a jet store or packed splittings (see pack_jet_splits).
+        - lam0: initial value of Lambda.
+        - lamRoot0: initial value of LambdaRoot (lam0 if None). If fitLambdaRoot=False, the fixed LambdaRoot (the LambdaRoot of each jet if None).
+        - delta_min: pt_cut. Either a scalar or an array of shape (Njets,). If None, the pt_cut of each jet.
+        - fitLambdaRoot: if True, fit LambdaRoot too.
+        - bounds: (min, max) values of Lambda and LambdaRoot.
+        - options: options for scipy.optimize.minimize.
+
+    Returns:
+        - fit: dictionary with the fitted "Lambda" and "LambdaRoot", the total log likelihood "logLH", the number of jets in the fit "Njets" and the scipy.optimize "result".
+    """
+
+    splits = jets if isinstance(jets, dict) and "offsets" in jets else pack_jet_splits(jets)
+
+    if fitLambdaRoot and lamRoot0 is None:
+        lamRoot0 = lam0
 
-        logLH.append(0)
+    """ Leave out the jets with - np.inf or NaN log likelihood """
+    sumLogLH, _, _ = get_jets_logLH_grad(splits, lam=lam0, lamRoot=lamRoot0, delta_min=delta_min)
+    fitJets = np.isfinite(sumLogLH)
+    if not fitJets.all():
+        logger.warning(f" {np.sum(~fitJets)} jets are not allowed by the model (or are None) and are left out of the fit")
+
+    def _negLogLH(x):
+        lam = x[0]
+        lamRoot = x[1] if fitLambdaRoot else lamRoot0
+        sumLogLH, dLambda, dLambdaRoot = get_jets_logLH_grad(splits, lam=lam, lamRoot=lamRoot, delta_min=delta_min)
+
+        grad = [- np.sum(dLambda[fitJets])]
+        if fitLambdaRoot:
+            grad.append(- np.sum(dLambdaRoot[fitJets]))
+
+        return - np.sum(sumLogLH[fitJets]), np.asarray(grad)
+
+    x0 = [lam0, lamRoot0] if fitLambdaRoot else [lam0]
+
+    result = optimize.minimize(
+        _negLogLH,
+        x0,
+        jac=True,
+        method="L-BFGS-B",
+        bounds=[bounds] * len(x0),
+        options=options,
+    )
+
+    fit = {
+        "Lambda": float(result.x[0]),
+        "LambdaRoot": float(result.x[1]) if fitLambdaRoot else lamRoot0,
+        "logLH": - float(result.fun),
+        "Njets": int(np.sum(fitJets)),
+        "result": result,
+    }
+
+    return fit
+
+
+
+
+def fill_jet_info(jet, parent_id=None):
+    """
+    Fill jet["deltas"] amd jet["draws"] given jet["tree"] and jet["content"]
+    Assing r = None to the root and the leaves, and assign delta = 0 to the leaves
+    """
+    deltas = []
+    draws = []
+
+    root_id = jet["root_id"]
+
+    _get_jet_info(jet, root_id=root_id, parent_id=parent_id, deltas=deltas, draws=draws)
+
+    jet["deltas"] = deltas
+    jet["draws"] = draws
+
+    return jet
+
+def _get_jet_info(jet, root_id=None, parent_id=None, deltas=None, draws=None):
+    """
+    Fill jet["deltas"] amd jet["draws"], visiting the nodes of the subtree of root_id in preorder (see treeKernels.preorder)
+    parent_id: parent of root_id (None for the root of the jet)
+    """
+
+    tree = jet["tree"]
+    parent = treeKernels.parents(tree)
+
+    for node_id in treeKernels.preorder(tree, root_id).tolist():
+
+        if jet["tree"][node_id][0] != -1 and jet["tree"][node_id][1] != -1:
+
+            idL = jet["tree"][node_id][0]
+            idR = jet["tree"][node_id][1]
+            pL = jet["content"][idL]
+            pR = jet["content"][idR]
+            delta = get_delta_LR(pL, pR)
+
+            node_parent_id = parent_id if node_id == root_id else parent[node_id]
+            if node_parent_id is not None:
+                delta_parent = deltas[node_parent_id]
+                r = torch.tensor(delta / delta_parent)
+            else:
+                r = None
+
+            deltas.append(delta)
+            draws.append(r)
+
+        else:
+            if jet["tree"][node_id][0] * jet["tree"][node_id][1] != 1:
+                raise ValueError(f"Invalid jet left and right child are not both -1")
+            else:
+                deltas.append(0)
+                draws.append(None)
+
+
+def enrich_jet_logLH(jet, delta_min=None, dij=False, alpha = None):
+    """
+    Attach splitting log likelihood to each edge, scoring all the splittings of the tree at once (see get_jet_logLH_batch).
+    jet["logLH"]: array with the log likelihood of each node in preorder (0 for the leaves).
+    jet["dij"]: list with [logLH, dij anti-kt, dij CA, dij kt] for each inner node in preorder (if dij=True, empty otherwise).
+    """
+
+    logLH, dijs = get_jet_logLH_batch(jet, delta_min=delta_min, dij=dij)
+
+    jet["logLH"] = logLH
+    jet["dij"] = dijs.tolist() if dij else []
+    return jet
 
 
 
@@ -257,11 +865,11 @@ def split_logLH_with_stop_nonstop_prob(pL, pR, t_cut, lam):
 
             # print("Inner - t = ",t," | tL =",tL, " | tR = ",tR," pL = ", pL, " | pR= ", pR, " | pP = ", pP, "logLH = ",-np.log(1 - np.exp(- lam)) + np.log(lam) - np.log(tP_local) - lam * t / tP_local)
             # return -np.log(1 - np.exp(- lam)) + np.log(lam) - np.log(tP_local) - lam * t / tP_local + np.log(1-F_s)
-            return -np.log(1 - np.exp(- (1. - 1e-3)*lam)) + np.log(lam) - np.log(tP_local) - lam * t / tP_local
+            return -log1mexp((1. - 1e-3)*lam) + np.log(lam) - np.log(tP_local) - lam * t / tP_local
 
         else: # For leaves we have t<t_cut
             t_upper = min(tP_local,t_cut) #There are cases where tp2 < t_cut
-            log_F_s = -np.log(1 - np.exp(- (1. - 1e-3)*lam)) + np.log(1 - np.exp(-lam * t_upper / tP_local))
+            log_F_s = -log1mexp((1. - 1e-3)*lam) + log1mexp(lam * t_upper / tP_local)
             # print("Outer - t = ",t," | tL =",tL, " | tR = ",tR," pL = ", pL, " | pR= ", pR, " | pP = ", pP, "logLH = ", log_F_s)
             return log_F_s
 
@@ -293,3 +901,512 @@ def split_logLH_with_stop_nonstop_prob(pL, pR, t_cut, lam):
         logLH = (logp_split + np.log(1 / (4 * np.pi)) )
 
     return logLH
+
+
+
+
+"""####################################"""
+""" Likelihood backends: one object that scores a batch of pairings, shared by the search engines (greedy, beam search) """
+
+class likelihoodBackend(object):
+    """
+    Base class of the likelihood backends. A backend scores P pairings of nodes in one call, with the same signature as split_logLH_batch,
+    so the search engines can swap implementations without changes:
+
+        logLH = backend.split_logLH_batch(pL, tL, pR, tR, t_cut, lam)
+
+    Args of split_logLH_batch:
+        - pL, pR: arrays of shape (P, 4) with the left and right nodes momentum vectors.
+        - tL, tR: arrays of shape (P,) with the left and right nodes delta (invariant mass squared of the node splitting, 0 for the leaves).
+          Only used by the legacy model. The stop / non-stop model computes the invariant masses from the momenta.
+        - t_cut: pT cut scale for the showering process to stop.
+        - lam: decaying rate value for the exponential distribution. Either a scalar or an array of shape (P,).
+
+    Returns:
+        - logLH: array of shape (P,), with - np.inf for the pairings that are not allowed.
+
+    Attributes:
+        - name: backend name (see getBackend).
+        - model: "legacy" (split_logLH) or "stop_nonstop" (split_logLH_with_stop_nonstop_prob, the model used by enrich_jet_logLH and VCSMC).
+    """
+    name = None
+    model = None
+
+    def split_logLH_batch(self, pL, tL, pR, tR, t_cut, lam):
+        raise NotImplementedError
+
+    def split_logLH(self, pL, tL, pR, tR, t_cut, lam):
+        """
+        Score a single pairing (scalar convenience wrapper).
+        """
+        return float(self.split_logLH_batch(
+            np.asarray(pL, dtype=float).reshape(1, 4),
+            np.asarray([tL], dtype=float),
+            np.asarray(pR, dtype=float).reshape(1, 4),
+            np.asarray([tR], dtype=float),
+            t_cut,
+            lam,
+        )[0])
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(model={self.model})"
+
+
+
+
+class legacyBackend(likelihoodBackend):
+    """
+    Two-term model of split_logLH (batched NumPy kernel). This is the model the greedy and beam search algorithms optimize by default.
+    """
+    name = "legacy"
+    model = "legacy"
+
+    def split_logLH_batch(self, pL, tL, pR, tR, t_cut, lam):
+        return split_logLH_batch(pL, tL, pR, tR, t_cut, lam)
+
+
+
+
+class scalarBackend(likelihoodBackend):
+    """
+    Stop / non-stop model, scoring one pairing at a time with split_logLH_with_stop_nonstop_prob. This is the reference implementation.
+    """
+    name = "scalar"
+    model = "stop_nonstop"
+
+    def split_logLH_batch(self, pL, tL, pR, tR, t_cut, lam):
+        pL = np.asarray(pL, dtype=float).reshape(-1, 4)
+        pR = np.asarray(pR, dtype=float).reshape(-1, 4)
+        lam = np.broadcast_to(np.asarray(lam, dtype=float), (len(pL),))
+
+        return np.asarray(
+            [split_logLH_with_stop_nonstop_prob(pL[k], pR[k], t_cut, lam[k]) for k in range(len(pL))],
+            dtype=float,
+        ).reshape(-1)
+
+
+
+
+class numpyBackend(likelihoodBackend):
+    """
+    Stop / non-stop model, scoring all the pairings in one NumPy pass with split_logLH_with_stop_nonstop_prob_batch.
+    """
+    name = "numpy"
+    model = "stop_nonstop"
+
+    def split_logLH_batch(self, pL, tL, pR, tR, t_cut, lam):
+        return split_logLH_with_stop_nonstop_prob_batch(pL, pR, t_cut, lam)
+
+
+
+
+def tf_split_logLH_with_stop_nonstop_prob(tf, pL, pR, t_cut, lam, notAllowedLogLH=- np.inf):
+    """
+    TensorFlow version of split_logLH_with_stop_nonstop_prob_batch, written with elementwise ops only, so it can be used inside a TF graph.
+    This is the likelihood of VCSMC.llh_bc in curr.py, where lam (the decay factor) is trained, so the gradients with respect to lam are finite for all the pairings:
+    the pairings that are not allowed are evaluated with harmless values (tp = 1, tL = tR = 0) and then replaced by notAllowedLogLH,
+    and each branch of log1mexp only sees the arguments of its own range (a tf.where over a branch with inf / NaN values gives NaN gradients).
+
+    Args:
+        - tf: the tensorflow module (tensorflow or tensorflow.compat.v1).
+        - pL, pR: float64 tensors of shape (..., 4) with the left and right nodes momentum vectors.
+        - t_cut: pT cut scale for the showering process to stop.
+        - lam: float64 tensor (or scalar) with the decaying rate value, broadcastable to pL.shape[:-1].
+        - notAllowedLogLH: log likelihood of the pairings that are not allowed (VCSMC uses - tf.float64.max).
+
+    Returns:
+        - logLH: float64 tensor of shape pL.shape[:-1]
+    """
+
+    def invM(p):
+        """ Same rounding as get_invM_batch (E^2 - norm^2) """
+        return p[..., 0] ** 2 - tf.norm(p[..., 1:], axis=-1) ** 2
+
+    def log1mexp_tf(x):
+        """ Same branches as log1mexp """
+        small = x <= np.log(2)
+        xSmall = tf.where(small, x, np.log(2) * tf.ones_like(x))
+        xLarge = tf.where(small, np.log(2) * tf.ones_like(x), x)
+        return tf.where(
+            small,
+            tf.math.log(-tf.math.expm1(-xSmall)),
+            tf.math.log1p(-tf.math.exp(-xLarge)),
+        )
+
+    tL = invM(pL)
+    tR = invM(pR)
+    tp = invM(pL + pR)
+
+    def asFloat64(x):
+        """ tf.cast of a python float goes through a float32 constant, so convert the non tensor values with numpy """
+        return tf.cast(x, tf.float64) if tf.is_tensor(x) else tf.constant(np.asarray(x, dtype=float))
+
+    lam = asFloat64(lam) * tf.ones_like(tp)
+    t_cut = asFloat64(t_cut) * tf.ones_like(tp)
+
+    allowed = (
+        (tp > 0) & (tL >= 0) & (tR >= 0)
+        & (tp > t_cut)
+        & (tL < (1 - 1e-3) * tp) & (tR < (1 - 1e-3) * tp)
+        & tf.logical_not(tf.sqrt(tL) + tf.sqrt(tR) > tf.sqrt(tp))
+    )
+
+    tp = tf.where(allowed, tp, tf.ones_like(tp))
+    tL = tf.where(allowed, tL, tf.zeros_like(tL))
+    tR = tf.where(allowed, tR, tf.zeros_like(tR))
+
+    def get_logp(tP_local, t):
+        log_norm = -log1mexp_tf((1. - 1e-3) * lam)
+        inner = log_norm + tf.math.log(lam) - tf.math.log(tP_local) - lam * t / tP_local
+        t_upper = tf.minimum(tP_local, t_cut)
+        outer = log_norm + log1mexp_tf(lam * t_upper / tP_local)
+        return tf.where(t > t_cut, inner, outer)
+
+    tpLR = (tf.sqrt(tp) - tf.sqrt(tL)) ** 2
+    tpRL = (tf.sqrt(tp) - tf.sqrt(tR)) ** 2
+
+    logpLR = np.log(1 / 2) + get_logp(tp, tL) + get_logp(tpLR, tR)  # First sample tL
+    logpRL = np.log(1 / 2) + get_logp(tp, tR) + get_logp(tpRL, tL)  # First sample tR
+
+    """ logaddexp(logpLR, logpRL) """
+    logpMax = tf.maximum(logpLR, logpRL)
+    logpMax = tf.where(tf.math.is_finite(logpMax), logpMax, tf.zeros_like(logpMax))
+    logp_split = logpMax + tf.math.log(tf.exp(logpLR - logpMax) + tf.exp(logpRL - logpMax))
+
+    return tf.where(allowed, logp_split + np.log(1 / (4 * np.pi)), notAllowedLogLH * tf.ones_like(tp))
+
+
+
+
+class tfBackend(likelihoodBackend):
+    """
+    Stop / non-stop model evaluated with TensorFlow (tf_split_logLH_with_stop_nonstop_prob), in float64.
+    TensorFlow is imported when the backend is created. With TF1 graph mode (as in curr.py) each call builds and runs a small graph in a new session,
+    so this backend is meant for consistency checks and large batches, not for the per-level calls of the search engines.
+    """
+    name = "tf"
+    model = "stop_nonstop"
+
+    def __init__(self):
+        import tensorflow as tf
+        self.tf = tf
+
+    def split_logLH_batch(self, pL, tL, pR, tR, t_cut, lam):
+        tf = self.tf
+        pL = np.asarray(pL, dtype=float).reshape(-1, 4)
+        pR = np.asarray(pR, dtype=float).reshape(-1, 4)
+        lam = np.broadcast_to(np.asarray(lam, dtype=float), (len(pL),))
+
+        if tf.executing_eagerly():
+            return tf_split_logLH_with_stop_nonstop_prob(tf, tf.constant(pL), tf.constant(pR), float(t_cut), tf.constant(lam)).numpy()
+
+        with tf.Graph().as_default():
+            logLH = tf_split_logLH_with_stop_nonstop_prob(tf, tf.constant(pL), tf.constant(pR), float(t_cut), tf.constant(lam))
+            with tf.compat.v1.Session() as sess:
+                return sess.run(logLH)
+
+
+
+
+def _split_logLH_with_stop_nonstop_prob_loop(pL, pR, t_cut, lam, logLH):
+    """
+    Loop version of split_logLH_with_stop_nonstop_prob_batch, written with scalar operations only (log1mexp and logaddexp inlined, same branches)
+    so that it can be compiled with numba.njit (see numbaBackend). It runs in plain python too, but slowly.
+    The invariant masses are computed as E^2 - |p|^2 with |p| = sqrt(px^2 + py^2 + pz^2), in the same order as np.linalg.norm along the rows,
+    so the nearly massless nodes get the same values as in the NumPy kernel.
+
+    Args:
+        - pL, pR: float arrays of shape (P, 4) with the left and right nodes momentum vectors.
+        - t_cut: pT cut scale for the showering process to stop.
+        - lam: float array of shape (P,) with the decaying rate values.
+        - logLH: output float array of shape (P,)
+    """
+    for k in range(pL.shape[0]):
+
+        normL = math.sqrt(pL[k, 1] * pL[k, 1] + pL[k, 2] * pL[k, 2] + pL[k, 3] * pL[k, 3])
+        normR = math.sqrt(pR[k, 1] * pR[k, 1] + pR[k, 2] * pR[k, 2] + pR[k, 3] * pR[k, 3])
+        px = pL[k, 1] + pR[k, 1]
+        py = pL[k, 2] + pR[k, 2]
+        pz = pL[k, 3] + pR[k, 3]
+        normP = math.sqrt(px * px + py * py + pz * pz)
+
+        tL = pL[k, 0] ** 2 - normL ** 2
+        tR = pR[k, 0] ** 2 - normR ** 2
+        tp = (pL[k, 0] + pR[k, 0]) ** 2 - normP ** 2
+
+        if not (
+            tp > 0 and tL >= 0 and tR >= 0
+            and tp > t_cut
+            and tL < (1 - 1e-3) * tp and tR < (1 - 1e-3) * tp
+            and not (math.sqrt(tL) + math.sqrt(tR) > math.sqrt(tp))
+        ):
+            logLH[k] = - np.inf
+            continue
+
+        lam_k = lam[k]
+
+        x = (1. - 1e-3) * lam_k
+        log_norm = - (math.log(-math.expm1(-x)) if x <= LOG2 else math.log1p(-math.exp(-x)))
+
+        tpLR = (math.sqrt(tp) - math.sqrt(tL)) ** 2
+        tpRL = (math.sqrt(tp) - math.sqrt(tR)) ** 2
+
+        """ get_logp(tP_local, t) for (tp, tL), (tpLR, tR) (first sample tL) and (tp, tR), (tpRL, tL) (first sample tR) """
+        logpLR = math.log(1 / 2)
+        logpRL = math.log(1 / 2)
+        for m in range(4):
+            if m == 0:
+                tP_local, t = tp, tL
+            elif m == 1:
+                tP_local, t = tpLR, tR
+            elif m == 2:
+                tP_local, t = tp, tR
+            else:
+                tP_local, t = tpRL, tL
+
+            if t > t_cut:
+                logp = log_norm + math.log(lam_k) - math.log(tP_local) - lam_k * t / tP_local
+            else:
+                x = lam_k * min(tP_local, t_cut) / tP_local
+                logp = log_norm + (math.log(-math.expm1(-x)) if x <= LOG2 else math.log1p(-math.exp(-x)))
+
+            if m < 2:
+                logpLR += logp
+            else:
+                logpRL += logp
+
+        """ np.logaddexp(logpLR, logpRL) """
+        if logpLR == logpRL:
+            logp_split = logpLR + LOG2
+        elif logpLR > logpRL:
+            logp_split = logpLR + math.log1p(math.exp(logpRL - logpLR))
+        else:
+            logp_split = logpRL + math.log1p(math.exp(logpLR - logpRL))
+
+        logLH[k] = logp_split + math.log(1 / (4 * np.pi))
+
+
+
+
+_numbaKernel = None
+
+
+class numbaBackend(likelihoodBackend):
+    """
+    Stop / non-stop model, compiled with numba (_split_logLH_with_stop_nonstop_prob_loop). Numba is imported and the kernel compiled
+    when the first numbaBackend is created (raises ImportError if numba is not installed). Use the "fast" backend (fastBackend) to get this one
+    when numba is available and the NumPy kernel otherwise.
+    """
+    name = "numba"
+    model = "stop_nonstop"
+
+    def __init__(self):
+        global _numbaKernel
+        if _numbaKernel is None:
+            import numba
+            _numbaKernel = numba.njit(_split_logLH_with_stop_nonstop_prob_loop)
+
+        self.kernel = _numbaKernel
+
+    def split_logLH_batch(self, pL, tL, pR, tR, t_cut, lam):
+        pL = np.ascontiguousarray(np.asarray(pL, dtype=float).reshape(-1, 4))
+        pR = np.ascontiguousarray(np.asarray(pR, dtype=float).reshape(-1, 4))
+        lam = np.ascontiguousarray(np.broadcast_to(np.asarray(lam, dtype=float), (len(pL),)))
+
+        logLH = np.empty(len(pL))
+        self.kernel(pL, pR, float(t_cut), lam, logLH)
+
+        return logLH
+
+
+
+
+def _selfCheckPairs(P=2000, seed=0):
+    """
+    Fixed sample of pairings for the backend self checks: massive and nearly massless nodes, with pairings that are allowed and not allowed.
+    """
+    rng = np.random.default_rng(seed)
+
+    def nodes():
+        p = rng.normal(scale=rng.choice([0.1, 1., 10., 100.], size=(P, 1)), size=(P, 3))
+        m2 = rng.choice([1e-4, 1., 10.], size=P) * rng.uniform(0.5, 1.5, size=P)
+        return np.concatenate((np.sqrt(np.sum(p ** 2, axis=1) + m2)[:, None], p), axis=1)
+
+    return nodes(), nodes(), rng.uniform(0.5, 5., size=P)
+
+
+def fastBackend(rtol=1e-12):
+    """
+    Fastest available implementation of the stop / non-stop model: numbaBackend if numba is importable and it agrees with the NumPy kernel within rtol
+    on a fixed sample of pairings (see check_backends), numpyBackend otherwise.
+    The check runs once per process, the first time a fast backend is created.
+    numba compiles the kernel lazily, the first time it is called inside the check, so any error (e.g. a numba typing error, a broken numba install)
+    from creating the numba backend or running the check is logged and the NumPy kernel is used.
+    """
+    global _fastBackendName
+
+    if _fastBackendName is None:
+        _fastBackendName = "numpy"
+        try:
+            backend = numbaBackend()
+        except ImportError:
+            logger.info(" numba is not installed, using the NumPy likelihood kernel")
+        except Exception as e:
+            logger.warning(f" numba backend could not be created, using the NumPy likelihood kernel: {type(e).__name__}: {e}")
+        else:
+            pL, pR, lam = _selfCheckPairs()
+            try:
+                maxDiff = check_backends(pL, pR, 1., lam, backends=("numpy", backend), rtol=rtol)
+                logger.debug(f" numba kernel self check max difference = {maxDiff}")
+                _fastBackendName = "numba"
+            except Exception as e:
+                logger.warning(f" numba kernel self check failed, using the NumPy likelihood kernel: {type(e).__name__}: {e}")
+
+    return LIKELIHOOD_BACKENDS[_fastBackendName]()
+
+
+_fastBackendName = None
+
+
+
+
+LIKELIHOOD_BACKENDS = {
+    "legacy": legacyBackend,
+    "scalar": scalarBackend,
+    "numpy": numpyBackend,
+    "tf": tfBackend,
+    "numba": numbaBackend,
+    "fast": fastBackend,
+}
+
+
+""" The search engines optimize the same model that enrich_jet_logLH reports (stop / non-stop) """
+DEFAULT_BACKEND = "fast"
+
+
+def getBackend(backend=None):
+    """
+    Get a likelihood backend.
+
+    Args:
+        - backend: None (DEFAULT_BACKEND, the default of the search engines), a backend name (a key of LIKELIHOOD_BACKENDS) or a likelihoodBackend object (returned as is).
+          "fast" gives the fastest implementation of the stop / non-stop model that is available (see fastBackend).
+          "legacy" gives the model the search engines used before the backends were added (split_logLH), to reproduce older results.
+
+    Returns:
+        - likelihoodBackend object
+    """
+    if backend is None:
+        backend = DEFAULT_BACKEND
+
+    if isinstance(backend, likelihoodBackend):
+        return backend
+
+    if backend not in LIKELIHOOD_BACKENDS:
+        raise ValueError(f"Unknown likelihood backend {backend}. Options: {list(LIKELIHOOD_BACKENDS)}")
+
+    return LIKELIHOOD_BACKENDS[backend]()
+
+
+
+def check_backends(pL, pR, t_cut, lam, backends=("scalar", "numpy"), rtol=1e-9, tL=None, tR=None):
+    """
+    Cross-implementation consistency check: score the same pairings with each backend and compare them with the first one.
+    The backends have to implement the same model. The allowed / not allowed (- np.inf) pairings have to agree exactly,
+    and the finite log likelihoods within rtol (relative to max(1, |logLH|)).
+    The invariant masses of nearly massless nodes come from the cancellation E^2 - |p|^2, and np.linalg.norm of a single vector and of the rows of an array
+    round differently, so the scalar and the batched kernels can differ by ~1e-11 for those pairings. For massless nodes (t = 0 up to rounding) the invariant
+    mass is only rounding noise, and the scalar and batched kernels can give different log likelihoods (~1e-7) and allowed pairings. Use a smaller rtol
+    for backends that compute the invariant masses in the same way (e.g. two batched backends, which agree on massless nodes too). For the same reason,
+    pairings that are exactly on the boundary of the allowed region (e.g. a node paired with itself, where sqrt(tL) + sqrt(tR) = sqrt(tp)) can be allowed
+    by one kernel and not by the other.
+
+    Args:
+        - pL, pR: arrays of shape (P, 4) with the left and right nodes momentum vectors.
+        - t_cut, lam: model parameters (see likelihoodBackend).
+        - backends: list of backend names or objects. The first one is the reference.
+        - rtol: tolerance.
+        - tL, tR: node deltas (only needed for the legacy model).
+
+    Returns:
+        - maxDiff: dictionary with the backend name as a key and the max difference with the reference as the value.
+          Raises a ValueError if a backend does not agree.
+    """
+    backends = [getBackend(backend) for backend in backends]
+    if len(set(backend.model for backend in backends)) > 1:
+        raise ValueError(f"The backends {backends} do not implement the same model")
+
+    pL = np.asarray(pL, dtype=float).reshape(-1, 4)
+    pR = np.asarray(pR, dtype=float).reshape(-1, 4)
+    if tL is None:
+        tL = np.zeros(len(pL))
+    if tR is None:
+        tR = np.zeros(len(pR))
+
+    reference = backends[0].split_logLH_batch(pL, tL, pR, tR, t_cut, lam)
+    finite = np.isfinite(reference)
+
+    maxDiff = {}
+    for backend in backends[1:]:
+        logLH = backend.split_logLH_batch(pL, tL, pR, tR, t_cut, lam)
+
+        if np.any(np.isfinite(logLH) != finite):
+            raise ValueError(f"{backend.name} backend: allowed pairings do not agree with the {backends[0].name} backend")
+
+        diff = np.abs(logLH[finite] - reference[finite]) / np.maximum(1., np.abs(reference[finite]))
+        maxDiff[backend.name] = float(np.max(diff)) if len(diff) > 0 else 0.
+
+        if maxDiff[backend.name] > rtol:
+            raise ValueError(f"{backend.name} backend: max difference {maxDiff[backend.name]} with the {backends[0].name} backend is above {rtol}")
+
+        logger.debug(f" {backend.name} backend max difference = {maxDiff[backend.name]}")
+
+    return maxDiff
+
+
+
+
+"""####################################"""
+""" Upper bounds of the splitting log likelihood (for the best-first search, see aStar_invM) """
+
+def split_logLH_child_bound(t, t_cut, lam, model="legacy"):
+    """
+    Upper bound of the contribution of a child node to the log likelihood of any splitting where it is a child, given only the child.
+    For any pairing of children L, R with any parent:
+        logLH(L, R) <= bound(L) + bound(R) + log(1 / (4 pi))
+    Every node of a tree except the root is a child exactly once, so summing the bounds of the nodes gives an upper bound of the log likelihood of the tree.
+
+    Args:
+        - t: array with the delta of each node (legacy model, 0 for the leaves) or its invariant mass squared (stop_nonstop model).
+        - t_cut: pT cut scale for the showering process to stop.
+        - lam: decaying rate value for the exponential distribution.
+        - model: "legacy" (split_logLH) or "stop_nonstop" (split_logLH_with_stop_nonstop_prob).
+
+    Returns:
+        - bound: array with the bound for each node.
+
+    Legacy model. Each child enters through get_p(tP, t), with tP the parent mass for tmax and the residual mass for tmin:
+        - t > 0: max over tP of log(lam / tP) - lam t / tP is -1 - log(t), so get_p <= -log1mexp(lam) - 1 - log(t).
+        - t = 0: get_p = -log1mexp(lam) + log1mexp(...) <= -log1mexp(lam).
+    Stop / non-stop model. Each child enters once in each ordering through get_logp(tP, t), with t / tP < 1 for the allowed pairings:
+        - t > t_cut: max over 0 < u = t / tP < 1 of log(lam u) - lam u is -1 (lam >= 1) or log(lam) - lam (lam < 1), minus log(t).
+        - t <= t_cut: log1mexp(lam min(tP, t_cut) / tP) <= log1mexp(lam).
+      logaddexp of the two orderings with weight 1/2 each is at most the largest one.
+    """
+    t = np.asarray(t, dtype=float)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+
+        if model == "legacy":
+            log_norm = -log1mexp(lam)
+            bound = np.where(t > 0, log_norm - 1 - np.log(t), log_norm)
+
+        elif model == "stop_nonstop":
+            log_norm = -log1mexp((1. - 1e-3) * lam)
+            g = -1. if lam >= 1 else np.log(lam) - lam
+            bound = np.where(t > t_cut, log_norm + g - np.log(t), log_norm + log1mexp(lam))
+
+        else:
+            raise ValueError(f"Unknown likelihood model {model}")
+
+    return bound
@@ -4,6 +4,7 @@ import logging
 import pickle
 import logging
 
+from . import treeKernels
 from .utils import get_logger
 
 logger = get_logger(level=logging.INFO)
@@ -164,12 +165,12 @@ def traverse_jet(
 		outers_node_id = None,
 ):
 	'''
-	Recursive function to traverse the tree and get a list of the leaves
+	Traverse the tree in preorder (see treeKernels.preorder) and get a list of the leaves
 	Args:
 		jet: jet dictionary
 		node_id: id of the current node
 		outers_list: list that stores the momentum of the leaves of the tree
-		ancestors: 1D array with all the ancestors from root to leaf for each leaf.
+		ancestors: 1D array with the ancestors of node_id. It is prepended to each entry of tree_ancestors.
 		tree_ancestors: List with one entry for each leaf of the tree, where each entry lists all the ancestor node ids when traversing the tree from the root to the leaf node. (Each entry is one "ancestors" array)
 		parent_child_dic: dictionary where each key is a parent node and the values a list of the children
 		outers_node_id: list that stores the node id of the outers in the order in which we traverse the tree.
@@ -178,45 +179,19 @@ def traverse_jet(
 		outers_list, tree_ancestors, parent_child_dic, outers_node_id
 	'''
 
-	new_ancestors = None
+	for node in treeKernels.preorder(jet["tree"], node_id):
+
+		# Build outers list
+		if jet["tree"][node, 0] == -1:
+			outers_list.append(jet["content"][node])
+			outers_node_id.append(node)
+
+		else:
+			# Add {parent:[children]} to dic
+			parent_child_dic[node] = jet["tree"][node]
+
 	if dendrogram:
-		new_ancestors = np.copy(ancestors)
-		new_ancestors = np.append(new_ancestors, node_id)  # Node idxs in the truth jet dictionary
-
-	# Build outers list
-	if jet["tree"][node_id, 0] == -1:
-		outers_list.append(jet["content"][node_id])
-		outers_node_id.append(node_id)
-
-		if dendrogram:
-			tree_ancestors.append(new_ancestors)
-
-	else:
-		# Add {parent:[children]} to dic
-		parent_child_dic[node_id] = jet["tree"][node_id]
-
-		traverse_jet(
-			jet,
-			node_id,
-			jet["tree"][node_id, 0],
-			outers_list,
-			ancestors=new_ancestors,
-			dendrogram=dendrogram,
-			tree_ancestors=tree_ancestors,
-			parent_child_dic=parent_child_dic,
-			outers_node_id=outers_node_id,
-		)
-
-		traverse_jet(
-			jet,
-			node_id,
-			jet["tree"][node_id, 1],
-			outers_list,
-			ancestors=new_ancestors,
-			dendrogram=dendrogram,
-			tree_ancestors=tree_ancestors,
-			parent_child_dic=parent_child_dic,
-			outers_node_id=outers_node_id,
-		)
+		for leaf_ancestors in treeKernels.treeAncestors(jet["tree"], node_id):
+			tree_ancestors.append(np.append(np.copy(ancestors), leaf_ancestors))  # Node idxs in the truth jet dictionary
 
 	return outers_list, tree_ancestors, parent_child_dic, outers_node_id
\ No newline at end of file
@@ -3,14 +3,16 @@ import numpy as np
 import logging
 import pickle
 import itertools
+import heapq
 
+from . import treeKernels
 from .utils import get_logger
 
 logger = get_logger(level=logging.INFO)
 
 
 
-def recluster(input_jet, alpha=None, save=True, out_dir = None):
+def recluster(input_jet, alpha=None, save=True, out_dir = None, tiling=False):
   """
   Uses helper functions to get the leaves of an  input jet, recluster them following some algorithm determined by the value of alpha,
    create the new tree for the chosen algorithm, make a jet dictionary and save it.
@@ -33,48 +35,17 @@ def recluster(input_jet, alpha=None, save=True, out_dir = None):
   - input_jet: any jet dictionary with the clustering history.
   - alpha: defines the clustering algorithm. alpha={-1,0,1} defines the {anti-kt, CA and kt} algorithms respectively.
   - save: if true, save the reclustered jet dictionary
+  - tiling: if true, search the nearest neighbors with a tiling of the constituents directions (tiledKtAntiktCA) instead of the d_ij matrix (ktAntiktCA).
+    It is O(N log N) in time and O(N) in memory, so it is faster for jets with more than ~2000 constituents (~1000 for anti-kt). The output is the same.
 
   Returns:
     jet dictionary
   """
 
 
-  def _rec(jet, parent, node_id, outers_list):
-    """
-    Recursive function to get a list of the tree leaves
-    """
-    if jet["tree"][node_id, 0] == -1:
-
-      outers_list.append(jet["content"][node_id])
-
-    else:
-      _rec(
-        jet,
-        node_id,
-        jet["tree"][node_id, 0],
-        outers_list,
-      )
-
-      _rec(
-        jet,
-        node_id,
-        jet["tree"][node_id, 1],
-        outers_list,
-      )
-
-    return outers_list
-
-
-  outers = []
-
   # Get constituents list (leaves)
   jet_const = np.asarray(
-    _rec(
-    input_jet,
-    -1,
-    input_jet["root_id"],
-    outers,
-  )
+    [input_jet["content"][leaf] for leaf in treeKernels.leaves(input_jet["tree"], input_jet["root_id"]).tolist()]
   )
 
   # Run the kt, CA or antikt clustering algorithms
@@ -84,7 +55,7 @@ def recluster(input_jet, alpha=None, save=True, out_dir = None):
   root_node, \
   Nconst, \
   N_leaves_list, \
-  linkage_list = ktAntiktCA(jet_const, alpha=alpha)
+  linkage_list = (tiledKtAntiktCA if tiling else ktAntiktCA)(jet_const, alpha=alpha)
 
 
   # Build the reclustered tree
@@ -141,20 +112,19 @@ def ktAntiktCA(const_list, alpha=None):
   Runs the dijMinPair function level by level starting from the list of constituents (leaves) until we reach the root of the tree.
   Note: - We refer to both leaves and inner nodes as pseudojets.
 
+  The d_ij of every pairing is stored in a preallocated (2N-1) x (2N-1) matrix (one row/column per node of the tree), together with a per-node cache of the
+  nearest neighbor (NN), i.e. the node that gives the min d_ij (FastJet-style NN bookkeeping). After each merge only the row/column of the new pseudojet is filled
+  and only the nodes whose NN was merged get their NN refreshed, so this is O(N) at each level x N levels => O(N^2), instead of O(N^3).
+
   Args:
       - const_list: jet constituents (i.e. the leaves of the tree)
       - alpha: defines the clustering algorithm. alpha={-1,0,1} defines the {anti-kt, CA and kt} algorithms respectively.
 
   Returns:
-      Note:
-         Const_list: nodes list after deleting the constituents that are merged and adding the new pseudojet in each level.
-          So this should only have the root of the tree at the end.
-
       - tree_dic: dictionary that has the node id of a parent as a key and a list with the id of the 2 children as the values
       - idx: array that stores the node id
        (the node id determines the location of the momentum vector of a pseudojet in the jet_content array)
-        of the pseudojets that are in the current const_list array. It has the same elements as the const_list (they get updated
-        level by level).
+        of the pseudojets that are in the last level. So this should only have the root of the tree.
       - jet_content: array with the momentum of all the nodes of the jet tree (both leaves and inners).
       - root_node: root node id
       - Nconst: Number of leaves of the jet
@@ -167,33 +137,38 @@ def ktAntiktCA(const_list, alpha=None):
   root_node = 2 * Nconst - 2
   logger.debug(f"Root node = (N constituents + N parent) = {root_node}")
 
-  idx = np.arange(Nconst)
+  Ninners = max(Nconst - 1, 0)
 
   # List that given a node idx, stores for that idx, the number of leaves for the branch below that node.
-  # It is initialized only with the tree leaves
-  N_leaves_list = np.ones((Nconst))
-
+  # The leaves are the first Nconst entries and the node clustered at level j is the entry Nconst + j
+  N_leaves_list = np.concatenate((np.ones(Nconst), np.zeros(Ninners)))
 
   linkage_list = []
-
-  dij_hist = []
   tree_dic = {}
   const_list = np.asarray(const_list)
-  jet_content = const_list
-
-  for j in range(len(const_list) - 1):
-    const_list, \
-    dij_hist, \
-    tree_dic, \
-    idx, \
-    jet_content, \
-    N_leaves_list, \
-    linkage_list = dijMinPair(
-      const_list,
-      dij_hist,
+  jet_content = np.concatenate((const_list, np.zeros((Ninners,) + const_list.shape[1:], dtype=const_list.dtype)), axis=0)
+
+  # Nodes in the current level
+  active = np.zeros(len(jet_content), dtype=bool)
+  active[0:Nconst] = True
+
+  # d_ij of all the pairings of the leaves and NN of each leaf
+  pairDij, \
+  NNidx, \
+  NNdij, \
+  nodeNorm, \
+  ktPow = dijNeighbors(jet_content, Nconst=Nconst, alpha=alpha)
+
+  for j in range(Nconst - 1):
+    dijMinPair(
+      pairDij,
+      NNidx,
+      NNdij,
+      nodeNorm,
+      ktPow,
+      active,
       tree_dic,
       jet_content,
-      idx,
       alpha=alpha,
       Nconst=Nconst,
       Nparent=j,
@@ -201,127 +176,625 @@ def ktAntiktCA(const_list, alpha=None):
       linkage_list=linkage_list,
     )
 
+  idx = np.flatnonzero(active)
+
   return tree_dic, idx, jet_content, root_node, Nconst, N_leaves_list, linkage_list
 
 
 
 
 
+# Tolerance (in units of min{pt_i^(2 alpha), pt_j^(2 alpha)}) on the batched d_ij values to consider 2 pairings a tie.
+# The batched d_ij can differ from the d_ij pairing by pairing formula in the last bits, so ties within this tolerance are broken by recomputing them one by one.
+DIJ_TIE_TOL = 1e-12
+
+
+def dijBatch(vecA, normA, ktPowA, vecB, normB, ktPowB):
+  """
+  Batched d_ij = min{pt_i^(2 alpha), pt_j^(2 alpha)} * Delta_ij^2 distance of the generalized kt jet clustering algorithms (broadcasting over the leading axes).
+
+  Args:
+      - vecA, vecB: arrays of shape (..., 3) with the 3-momentum of the pseudojets.
+      - normA, normB: norm of vecA and vecB.
+      - ktPowA, ktPowB: pt^(2 alpha) of the pseudojets.
+
+  Returns:
+      - array with the d_ij of each pairing
+  """
+  cos = np.sum(vecA * vecB, axis=-1) / (normA * normB)
+
+  phi = np.arccos(np.clip(cos, -1, 1))
+
+  return np.minimum(ktPowA, ktPowB) * phi ** 2
+
+
+
+
+def _dijPair(const_i, const_j, alpha):
+  """
+  d_ij of a single pairing computed pairing by pairing, with the operations of the original level by level algorithm. Used to break ties.
+  """
+  const_pt = np.absolute([np.linalg.norm(const_i[1:3]), np.linalg.norm(const_j[1:3])])
+
+  tempCos = np.dot(const_i[1::], const_j[1::]) / (np.linalg.norm(const_i[1::]) * np.linalg.norm(const_j[1::]))
+
+  tempPhi = np.arccos([tempCos if abs(tempCos) <= 1 else np.sign(tempCos)])[0]
+
+  return np.sort(const_pt ** (2 * alpha))[0] * tempPhi ** 2
+
+
+
+
+def _breakTies(minPair, tiedPairs, jet_content, alpha):
+  """
+  Get the pairing with the min d_ij among the pairings within the tie tolerance, with the d_ij recomputed pairing by pairing. If there is a tie, the pairing [i, j] (i < j) with the smallest node ids is chosen.
+  Returns the node ids of the pairing as an array.
+  """
+  if len(tiedPairs) > 1:
+    minPair = min(
+      tiedPairs,
+      key=lambda pair: (_dijPair(jet_content[pair[0]], jet_content[pair[1]], alpha), pair),
+    )
+
+  return np.asarray(minPair)
+
+
+
+
+def _mergeNodes(
+    children,
+    newNode,
+    jet_content,
+    tree_dic,
+    Nparent=None,
+    N_leaves_list=None,
+    linkage_list=None,
+):
+  """
+  Add the pseudojet from merging the children to jet_content, tree_dic, N_leaves_list and linkage_list.
+  """
+
+  # List that given a node idx, stores for that idx, the number of leaves for the branch below that node.
+  N_leaves_list[newNode] = N_leaves_list[children[0]] + N_leaves_list[children[1]]
+
+  linkage_list.append([children[0], children[1], Nparent, N_leaves_list[newNode]])
+
+  jet_content[newNode] = jet_content[children[0]] + jet_content[children[1]]
+
+  # Add a new key to the tree dictionary
+  tree_dic[newNode] = children
+
+
+
+
+def dijNeighbors(jet_content, Nconst=None, alpha=None):
+  """
+  -Calculate the d_ij between all possible pairings of the leaves and store them in a (2N-1) x (2N-1) matrix. This is O(N^2)
+  -For each leaf i of the tree, get its nearest neighbor (NN), i.e. the leaf j that gives the min d_ij. If there is a tie, keep the smallest j.
+
+  Args:
+      - jet_content: array of shape (2N-1, 4) with the momentum of all the nodes of the tree. Only the leaves are filled.
+      - Nconst: Number of leaves
+      - alpha: defines the clustering algorithm. alpha={-1,0,1} defines the {anti-kt, CA and kt} algorithms respectively.
+
+  Returns:
+      - pairDij: (2N-1) x (2N-1) matrix with the d_ij of each pairing (Infinity if not computed or one of the nodes was merged)
+      - NNidx: array with the node id of the NN of each node (-1 if none)
+      - NNdij: array with the d_ij of the pairing of each node with its NN (Infinity if none)
+      - nodeNorm: array with the norm of the 3-momentum of each node
+      - ktPow: array with pt^(2 alpha) of each node
+  """
+
+  Nnodes = len(jet_content)
+
+  nodeNorm = np.zeros(Nnodes)
+  nodeNorm[0:Nconst] = np.linalg.norm(jet_content[0:Nconst, 1::], axis=1)
+
+  ktPow = np.zeros(Nnodes)
+  ktPow[0:Nconst] = np.absolute(np.linalg.norm(jet_content[0:Nconst, 1:3], axis=1)) ** (2 * alpha)
+
+  pairDij = np.full((Nnodes, Nnodes), np.inf)
+  pairDij[0:Nconst, 0:Nconst] = dijBatch(
+    jet_content[0:Nconst, None, 1::],
+    nodeNorm[0:Nconst, None],
+    ktPow[0:Nconst, None],
+    jet_content[None, 0:Nconst, 1::],
+    nodeNorm[None, 0:Nconst],
+    ktPow[None, 0:Nconst],
+  )
+  np.fill_diagonal(pairDij, np.inf)
+
+  NNidx = np.full(Nnodes, -1, dtype=int)
+  NNdij = np.full(Nnodes, np.inf)
+
+  if Nconst > 1:
+    NNidx[0:Nconst] = np.argmin(pairDij[0:Nconst], axis=1)
+    NNdij[0:Nconst] = pairDij[np.arange(Nconst), NNidx[0:Nconst]]
+
+  return pairDij, NNidx, NNdij, nodeNorm, ktPow
+
+
+
+
+
 
 
 def dijMinPair(
-    const_list,
-    var_dij_history,
+    pairDij,
+    NNidx,
+    NNdij,
+    nodeNorm,
+    ktPow,
+    active,
     tree_dic,
     jet_content,
-    idx,
     alpha=None,
     Nconst=None,
     Nparent=None,
     N_leaves_list=None,
     linkage_list=None,
 ):
+  """
+  -Get the pairing with the min d_ij (from the generalized kt jet clustering algorithms) at a certain level from the NN of each pseudojet.
+   If there is a tie, the pairing [i, j] (i < j) with the smallest node ids is chosen.
+  -Update the pseudojets of the level by deleting the constituents that are merged and adding the new pseudojet, and update the d_ij matrix and NN of each pseudojet.
+  (We refer to both leaves and inner nodes as pseudojets.)
+
+  All the inputs arrays, tree_dic and linkage_list are updated in place.
+
+  Args:
+      - pairDij: (2N-1) x (2N-1) matrix with the d_ij of each pairing
+      - NNidx: array with the node id of the NN of each node
+      - NNdij: array with the d_ij of the pairing of each node with its NN
+      - nodeNorm: array with the norm of the 3-momentum of each node
+      - ktPow: array with pt^(2 alpha) of each node
+      - active: bool array with the nodes of the current level
+      - tree_dic: dictionary that has the node id of a parent as a key and a list with the id of the 2 children as the values
+      - jet_content: array with the momentum of all the nodes of the jet tree (both leaves and inners). The new pseudojet is added in the row Nconst + Nparent.
+      - alpha: defines the clustering algorithm. alpha={-1,0,1} defines the {anti-kt, CA and kt} algorithms respectively.
+      - Nconst: Number of leaves
+      - Nparent: index of each parent added to the tree_dic.
+      - N_leaves_list
+      - linkage_list: linkage list to build heat clustermap visualizations.
+        [SciPy linkage list website](https://docs.scipy.org/doc/scipy/reference/generated/scipy.cluster.hierarchy.linkage.html)
+        Linkage list format: A  (n - 1) by 4 matrix Z is returned. At the i-th iteration, clusters with indices Z[i, 0] and Z[i, 1] are combined to form cluster (n + 1) . A cluster with an index less than n  corresponds to one of the n original observations. The distance between clusters Z[i, 0] and Z[i, 1] is given by Z[i, 2]. The fourth value Z[i, 3] represents the number of original observations in the newly formed cluster.
+  """
+
+  # Min d_ij pairing
+  node = np.argmin(NNdij)
+  minPair = (min(node, NNidx[node]), max(node, NNidx[node]))
+
+  # Pairings within the tie tolerance of the min. Ties are broken with the d_ij recomputed pairing by pairing and then by the node ids
+  bound = NNdij[node] + DIJ_TIE_TOL * min(ktPow[node], ktPow[NNidx[node]])
+  tiedPairs = set()
+  for i in np.flatnonzero(NNdij - DIJ_TIE_TOL * ktPow <= bound):
+    for j in np.flatnonzero(pairDij[i] - DIJ_TIE_TOL * np.minimum(ktPow[i], ktPow) <= bound):
+      tiedPairs.add((min(i, j), max(i, j)))
+
+  children = _breakTies(minPair, tiedPairs, jet_content, alpha)
+
+  newNode = Nconst + Nparent
+
+  _mergeNodes(
+    children,
+    newNode,
+    jet_content,
+    tree_dic,
+    Nparent=Nparent,
+    N_leaves_list=N_leaves_list,
+    linkage_list=linkage_list,
+  )
+
+  # Delete the merged nodes
+  active[children] = False
+  pairDij[children, :] = np.inf
+  pairDij[:, children] = np.inf
+  NNidx[children] = -1
+  NNdij[children] = np.inf
+
+  levelNodes = np.flatnonzero(active)
+  if len(levelNodes) == 0:
+    active[newNode] = True
+    return
+
+  # Fill the d_ij of the new pseudojet
+  nodeNorm[newNode] = np.linalg.norm(jet_content[newNode, 1::])
+  ktPow[newNode] = np.absolute(np.linalg.norm(jet_content[newNode, 1:3])) ** (2 * alpha)
+
+  newDij = dijBatch(
+    jet_content[levelNodes, 1::],
+    nodeNorm[levelNodes],
+    ktPow[levelNodes],
+    jet_content[newNode, 1::],
+    nodeNorm[newNode],
+    ktPow[newNode],
+  )
+  pairDij[newNode, levelNodes] = newDij
+  pairDij[levelNodes, newNode] = newDij
+
+  # NN of the new pseudojet
+  best = np.argmin(newDij)
+  NNidx[newNode] = levelNodes[best]
+  NNdij[newNode] = newDij[best]
+
+  # The new pseudojet is the NN of the nodes where it has a smaller d_ij (it has the largest id, so ties keep the previous NN)
+  closer = newDij < NNdij[levelNodes]
+  NNidx[levelNodes[closer]] = newNode
+  NNdij[levelNodes[closer]] = newDij[closer]
+
+  # Refresh the NN of the nodes whose NN was merged
+  for i in levelNodes[(NNidx[levelNodes] == children[0]) | (NNidx[levelNodes] == children[1])]:
+    NNidx[i] = np.argmin(pairDij[i])
+    NNdij[i] = pairDij[i, NNidx[i]]
+
+  active[newNode] = True
+
+
+
+
+
+
+
+class directionTiling(object):
+  """
+  Tiling of the directions (unit 3-momentum vectors) of the pseudojets, to search for the nearest neighbors in angle looking only at the nearby tiles.
+  The chord distance |u_i - u_j| = 2 sin(Delta_ij / 2) between the unit vectors is monotonic with the angle Delta_ij, so the nearest neighbor in chord distance is
+  the nearest neighbor in angle. The unit vectors are projected on the plane orthogonal to the jet axis and the plane is split in square tiles.
+  The projection does not increase distances, so the nodes in tiles that are r tiles away are at a chord distance >= (r - 1) * tileSize.
+  The tiles are rebuilt each time the number of nodes is halved, to keep about one node per tile.
+
+    - directions: array with the unit vector of each node (the nodes must be filled before they are added).
+    - basis: (2, 3) array with the orthonormal basis of the plane orthogonal to the jet axis.
+    - coords: array with the coordinates of each node on the plane.
+    - tileSize: size of the tiles.
+    - tiles: dictionary that has the tile coordinates as a key and a list with the ids of the nodes in the tile as the values.
+    - nodeTile: array with the tile coordinates of each node.
+    - nodes: set with the ids of the nodes in the tiling.
+  """
+
+  def __init__(self, directions, axis=None):
+
+    self.directions = directions
+
+    axis = axis / np.linalg.norm(axis)
+    helper = np.eye(3)[np.argmin(np.absolute(axis))]
+    e1 = np.cross(axis, helper)
+    e1 /= np.linalg.norm(e1)
+    self.basis = np.array([e1, np.cross(axis, e1)])
+
+    self.coords = np.zeros((len(directions), 2))
+    self.nodeTile = np.zeros((len(directions), 2), dtype=int)
+    self.tileSize = 1.
+    self.tiles = {}
+    self.nodes = set()
+    self.Nretile = 0
+
+
+  def add(self, node):
+    """
+    Add node to its tile.
     """
-    -Calculate all d_ij distance (from the generalized kt jet clustering algorithms) between all possible pair of constituents at a certain level and get the minimum.
-    -Update the constituents list by deleting the constituents that are merged and adding the new pseudojet
-    (We refer to both leaves and inner nodes as pseudojets.)
-
-    Args:
-        - const_list: array with the constituents momentum list for the current level (i.e. deleting the constituents that are merged and
-          adding the new pseudojet from merging them)
-        - var_dij_history: list with all the previous min{d_ij}
-        - tree_dic: dictionary that has the node id of a parent as a key and a list with the id of the 2 children as the values
-        - jet_content: array with the momentum of all the nodes of the jet tree (both leaves and inners) after adding one
-          more level in the clustering.
-          We add a new node each time we cluster 2 pseudojets
-        - idx: array that stores the node id (the node id determines the location of the momentum of a pseudojet in the jet_content array)
-          of the pseudojets that are in the current const_list array. It has the same number of elements as the const_list (they get updated
-          level by level).
-        - alpha: defines the clustering algorithm. alpha={-1,0,1} defines the {anti-kt, CA and kt} algorithms respectively.
-        - Nconst: Number of leaves
-        - Nparent: index of each parent added to the tree_dic.
-        - N_leaves_list
-        - linkage_list: linkage list to build heat clustermap visualizations.
-          [SciPy linkage list website](https://docs.scipy.org/doc/scipy/reference/generated/scipy.cluster.hierarchy.linkage.html)
-          Linkage list format: A  (n - 1) by 4 matrix Z is returned. At the i-th iteration, clusters with indices Z[i, 0] and Z[i, 1] are combined to form cluster (n + 1) . A cluster with an index less than n  corresponds to one of the n original observations. The distance between clusters Z[i, 0] and Z[i, 1] is given by Z[i, 2]. The fourth value Z[i, 3] represents the number of original observations in the newly formed cluster.
+    self.coords[node] = self.basis @ self.directions[node]
+    self.nodes.add(node)
 
-    Returns:
-        - new_list: new const_list after deleting the constituents that are merged and adding the new pseudojet in the current level.
-        - var_dij_history
-        - tree_dic
-        - idx
-        - jet_content
-        -  N_leaves_list
-        - linkage_list
+    if len(self.nodes) > 2 * self.Nretile:
+      self.retile()
+    else:
+      self._addToTile(node)
+
+
+  def remove(self, node):
+    """
+    Remove node from its tile.
+    """
+    self.nodes.discard(node)
+
+    tile = tuple(self.nodeTile[node])
+    self.tiles[tile].remove(node)
+    if not self.tiles[tile]:
+      del self.tiles[tile]
+
+    if 0 < len(self.nodes) < self.Nretile // 2:
+      self.retile()
 
+
+  def retile(self):
+    """
+    Rebuild the tiles, with a tile size such that there is about one node per tile for nodes spread over the plane.
     """
+    nodes = np.fromiter(self.nodes, dtype=int)
+
+    extent = np.max(np.ptp(self.coords[nodes], axis=0))
+    self.tileSize = extent / np.sqrt(len(nodes)) if extent > 0 else 1.
+
+    self.tiles = {}
+    for node in nodes:
+      self._addToTile(node)
+
+    self.Nretile = len(nodes)
+
+
+  def _addToTile(self, node):
+
+    self.nodeTile[node] = np.floor(self.coords[node] / self.tileSize)
+    self.tiles.setdefault(tuple(self.nodeTile[node]), []).append(node)
+
+
+  def _ringNodes(self, tile, r):
+    """
+    List of the nodes in the tiles that are r tiles away from tile (Chebyshev distance).
+    """
+    if r == 0:
+      return list(self.tiles.get(tuple(tile), []))
+
+    x, y = tile
+    ring = [(x + k, y - r) for k in range(-r, r + 1)] + [(x + k, y + r) for k in range(-r, r + 1)] \
+         + [(x - r, y + k) for k in range(-r + 1, r)] + [(x + r, y + k) for k in range(-r + 1, r)]
+
+    nodes = []
+    for ringTile in ring:
+      nodes.extend(self.tiles.get(ringTile, []))
+
+    return nodes
+
+
+  def nodesInBall(self, center, radius):
+    """
+    Nodes in the tiles that overlap the ball of the given radius around center (this includes all the nodes in the ball).
+    """
+    point = self.basis @ center
+    low = np.floor((point - radius) / self.tileSize)
+    high = np.floor((point + radius) / self.tileSize)
+
+    if not np.all(np.isfinite(high - low)) or np.prod(high - low + 1) > len(self.tiles):
+      return list(self.nodes)
+
+    nodes = []
+    for tile in itertools.product(range(int(low[0]), int(high[0]) + 1), range(int(low[1]), int(high[1]) + 1)):
+      nodes.extend(self.tiles.get(tile, []))
+
+    return nodes
+
+
+  def nearest(self, node):
+    """
+    Nearest neighbor of node in chord distance. If there is a tie, the node with the smallest id is chosen.
+    Look at the tiles in rings (r = 0, 1, 2,... tiles away from the tile of node) until the nearest neighbor found is closer than any node in the next ring.
+    If the ring has more tiles than there are filled tiles, look at all the nodes left at once.
+
+    Returns:
+      - NN node id (-1 if there are no other nodes)
+      - chord distance to the NN (Infinity if there are no other nodes)
+    """
+    tile = self.nodeTile[node]
+
+    bestNode, bestDist = -1, np.inf
+
+    r = 0
+    while True:
+
+      lastRing = 8 * r > len(self.tiles)
+      if lastRing:
+        candidates = np.fromiter(self.nodes, dtype=int)
+        candidates = candidates[np.max(np.absolute(self.nodeTile[candidates] - tile), axis=1) >= r]
+      else:
+        candidates = np.asarray(self._ringNodes(tile, r), dtype=int)
+
+      candidates = candidates[candidates != node]
+
+      if len(candidates) > 0:
+        dist = np.linalg.norm(self.directions[candidates] - self.directions[node], axis=1)
+        best = np.lexsort((candidates, dist))[0]
+        if (dist[best], candidates[best]) < (bestDist, bestNode) or bestNode == -1:
+          bestNode, bestDist = candidates[best], dist[best]
+
+      # The nodes in the next rings are at a distance >= r * tileSize
+      if lastRing or bestDist < r * self.tileSize:
+        break
 
-    # Get all possible pairings
-    pairs = np.asarray(list(itertools.combinations(np.arange(len(const_list)), 2)))
+      r += 1
 
+    return bestNode, bestDist
 
-    const_list_pt = np.absolute([np.linalg.norm(element[1:3]) for element in const_list])
-    logger.debug(f"const_list_pt = {const_list_pt}")
 
-    tempCos = [np.dot(const_list[pairs][k][0][1::],const_list[pairs][k][1][1::])/
-                            (np.linalg.norm(const_list[pairs][k][0][1::]) * np.linalg.norm(const_list[pairs][k][1][1::]))
-               for k in range(len(const_list[pairs]))]
 
-    tempPhi = np.arccos([entry if abs(entry)<=1 else np.sign(entry) for entry in tempCos])
 
-    dij_list = [(np.sort((const_list_pt[pairs][k]) ** (2 * alpha))[0] * \
-                 (tempPhi[k]) ** 2, k)\
-                for k in range(len(const_list[pairs]))]
+def tiledKtAntiktCA(const_list, alpha=None):
+  """
+  Same as ktAntiktCA, but the nearest neighbors are searched with a directionTiling of the pseudojets directions, instead of a (2N-1) x (2N-1) d_ij matrix.
+
+  As d_ij = min{pt_i^(2 alpha), pt_j^(2 alpha)} * Delta_ij^2, for the min d_ij pairing [i, j] with pt_i^(2 alpha) <= pt_j^(2 alpha), j is the nearest neighbor in angle
+  (geometric NN) of i. So we only keep the geometric NN of each pseudojet and the d_ij of that pairing, and take the min one from a heap (with lazy deletion as in
+  N2Greedy_invM.greedyLH). After each merge, only the pseudojets whose geometric NN was merged and the ones that are closer to the new pseudojet than to their NN
+  are updated, and they are found with the tiling. This is O(N log N) for jets where the constituents are spread over the tiles, and O(N) in memory.
+  The output is the same as ktAntiktCA.
+
+  Args:
+      - const_list: jet constituents (i.e. the leaves of the tree)
+      - alpha: defines the clustering algorithm. alpha={-1,0,1} defines the {anti-kt, CA and kt} algorithms respectively.
+
+  Returns:
+      Same as ktAntiktCA
+  """
 
+  Nconst = len(const_list)
 
+  root_node = 2 * Nconst - 2
 
-    logger.debug(f"dij_list = {dij_list}")
+  Ninners = max(Nconst - 1, 0)
+  Nnodes = Nconst + Ninners
+
+  N_leaves_list = np.concatenate((np.ones(Nconst), np.zeros(Ninners)))
+
+  linkage_list = []
+  tree_dic = {}
+  const_list = np.asarray(const_list)
+  jet_content = np.concatenate((const_list, np.zeros((Ninners,) + const_list.shape[1:], dtype=const_list.dtype)), axis=0)
 
+  active = np.zeros(Nnodes, dtype=bool)
+  active[0:Nconst] = True
 
-    # Get pair index (in pairs list) with min dij
-    min_tuple = sorted(dij_list, key=lambda x: x[0])[0]
-    min_pair = min_tuple[1]
-    logger.debug(f"min_pair= {pairs[min_pair]}")
+  if Nconst < 2:
+    return tree_dic, np.flatnonzero(active), jet_content, root_node, Nconst, N_leaves_list, linkage_list
 
 
-    # List that given a node idx, stores for that idx, the number of leaves for the branch below that node.
-    N_leaves_list = np.concatenate(
-      (N_leaves_list, [N_leaves_list[idx[pairs[min_pair][0]]] + N_leaves_list[idx[pairs[min_pair][1]]]]))
+  # Norm, pt^(2 alpha) and direction of each node
+  nodeNorm = np.zeros(Nnodes)
+  ktPow = np.zeros(Nnodes)
+  directions = np.zeros((Nnodes, 3))
 
+  nodeNorm[0:Nconst] = np.linalg.norm(jet_content[0:Nconst, 1::], axis=1)
+  ktPow[0:Nconst] = np.absolute(np.linalg.norm(jet_content[0:Nconst, 1:3], axis=1)) ** (2 * alpha)
+  directions[0:Nconst] = jet_content[0:Nconst, 1::] / nodeNorm[0:Nconst, None]
 
-    # List with all the previous min{d_ij}
-    var_dij_history.append(dij_list[min_pair])
+  tiling = directionTiling(
+    directions,
+    axis = np.sum(jet_content[0:Nconst, 1::], axis=0),
+  )
+  for node in range(Nconst):
+    tiling.add(node)
 
-    linkage_list.append([idx[pairs[min_pair][0]], idx[pairs[min_pair][1]], Nparent, N_leaves_list[-1]])
-    # linkage_list.append([idx[pairs[min_pair][0]], idx[pairs[min_pair][1]], min_tuple[0], N_leaves_list[-1]])
+  # Nodes with a geometric NN further than farDist are also checked when a new pseudojet is added (farDist changes when the tiles are rebuilt)
+  farDist = 2 * tiling.tileSize
+  farNodes = set()
 
+  # Geometric NN of each node, chord distance and d_ij of the pairing, and for each node the set of nodes that have it as NN
+  NNidx = np.full(Nnodes, -1, dtype=int)
+  NNdist = np.full(Nnodes, np.inf)
+  NNdij = np.full(Nnodes, np.inf)
+  NNof = {}
 
-    logger.debug(f"------------------------------------------------------------")
-    logger.debug(f"const_list= {const_list}")
-    logger.debug(f"const_list[pairs[min_pair]]= {const_list[pairs[min_pair]]}")
-    logger.debug(f"np.sum(const_list[pairs[min_pair]],axis=0) = {np.sum(const_list[pairs[min_pair]],axis=0)}")
-    logger.debug(f"const_list[0] = {const_list[0]}")
+  # Min heap of (d_ij - tie tolerance, node, version stamp of the node when it was pushed)
+  NNversion = np.zeros(Nnodes, dtype=int)
+  NNheap = []
 
-    new_list = np.reshape(
-      np.append(np.delete(const_list, pairs[min_pair], 0), [np.sum(const_list[pairs[min_pair]], axis=0)]), (-1, 4))
-    logger.debug(f"New list =  {new_list}")
+  def _setNN(node, NN, dist):
+    """
+    Set the geometric NN of node and push the pairing to the heap.
+    """
+    NNof.get(NNidx[node], set()).discard(node)
+    NNidx[node] = NN
+    NNdist[node] = dist
+    NNof.setdefault(NN, set()).add(node)
+
+    NNdij[node] = dijBatch(
+      jet_content[node, 1::],
+      nodeNorm[node],
+      ktPow[node],
+      jet_content[NN, 1::],
+      nodeNorm[NN],
+      ktPow[NN],
+    )
 
-    # print("jet_content = ",jet_content)
-    # print("const_list[pairs[min_pair]] = ",const_list[pairs[min_pair]])
+    if dist > farDist:
+      farNodes.add(node)
+    else:
+      farNodes.discard(node)
+
+    NNversion[node] += 1
+    heapq.heappush(NNheap, (NNdij[node] - DIJ_TIE_TOL * ktPow[node], node, NNversion[node]))
+
+
+  for node in range(Nconst):
+    _setNN(node, *tiling.nearest(node))
+
+
+  for j in range(Nconst - 1):
+
+    # Pop the nodes that can be in a pairing within the tie tolerance of the min d_ij
+    popped = []
+    minNode = -1
+    while NNheap:
+      key, node, version = NNheap[0]
+      if version != NNversion[node] or not active[node]:
+        heapq.heappop(NNheap)
+        continue
+      if minNode != -1 and key > bound:
+        break
+      popped.append(heapq.heappop(NNheap))
+      if minNode == -1 or NNdij[node] < NNdij[minNode]:
+        minNode = node
+        bound = NNdij[node] + DIJ_TIE_TOL * min(ktPow[node], ktPow[NNidx[node]])
+
+    minPair = (min(minNode, NNidx[minNode]), max(minNode, NNidx[minNode]))
+
+    # Pairings within the tie tolerance of the min (searched in the angle range where d_ij can be within the tolerance)
+    tiedPairs = set()
+    for key, i, version in popped:
+      heapq.heappush(NNheap, (key, i, version))
+      if key > bound:
+        continue
+      with np.errstate(divide="ignore", invalid="ignore"):
+        maxAngle = np.sqrt(bound / ktPow[i] + DIJ_TIE_TOL)
+      candidates = np.asarray([k for k in tiling.nodesInBall(directions[i], maxAngle + 1e-12) if k != i], dtype=int)
+      if len(candidates) == 0:
+        continue
+      dij = dijBatch(
+        jet_content[candidates, 1::],
+        nodeNorm[candidates],
+        ktPow[candidates],
+        jet_content[i, 1::],
+        nodeNorm[i],
+        ktPow[i],
+      )
+      for k in candidates[dij - DIJ_TIE_TOL * np.minimum(ktPow[i], ktPow[candidates]) <= bound]:
+        tiedPairs.add((min(i, k), max(i, k)))
 
-    jet_content = np.concatenate((jet_content, [np.sum(const_list[pairs[min_pair]], axis=0)]), axis=0)
+    children = _breakTies(minPair, tiedPairs, jet_content, alpha)
 
+    newNode = Nconst + j
 
-    # Add a new key to the tree dictionary
-    tree_dic[Nconst + Nparent] = idx[pairs[min_pair]]
-    logger.debug(f"tree_dic = {tree_dic}")
-    logger.debug(f"------------------------------------------------------------")
+    _mergeNodes(
+      children,
+      newNode,
+      jet_content,
+      tree_dic,
+      Nparent=j,
+      N_leaves_list=N_leaves_list,
+      linkage_list=linkage_list,
+    )
 
     # Delete the merged nodes
-    idx = np.concatenate((np.delete(idx, pairs[min_pair]), [Nconst + Nparent]), axis=0)
-    logger.debug(f"idx = {idx}")
+    staleNodes = set()
+    for child in children:
+      active[child] = False
+      tiling.remove(child)
+      farNodes.discard(child)
+      NNof.get(NNidx[child], set()).discard(child)
+      staleNodes |= NNof.pop(child, set())
+    staleNodes -= set(children)
+
+    active[newNode] = True
+    if j == Nconst - 2:
+      break
+
+    # Add the new pseudojet
+    nodeNorm[newNode] = np.linalg.norm(jet_content[newNode, 1::])
+    ktPow[newNode] = np.absolute(np.linalg.norm(jet_content[newNode, 1:3])) ** (2 * alpha)
+    directions[newNode] = jet_content[newNode, 1::] / nodeNorm[newNode]
+    tiling.add(newNode)
+
+    if farDist != 2 * tiling.tileSize:
+      farDist = 2 * tiling.tileSize
+      farNodes = set(k for k in tiling.nodes if NNdist[k] > farDist)
+
+    _setNN(newNode, *tiling.nearest(newNode))
+
+    # The new pseudojet is the NN of the nodes that are closer to it than to their NN (it has the largest id, so ties keep the previous NN)
+    candidates = set(tiling.nodesInBall(directions[newNode], farDist)) | farNodes
+    candidates = np.asarray([k for k in candidates if k != newNode and k not in staleNodes], dtype=int)
+    if len(candidates) > 0:
+      dist = np.linalg.norm(directions[candidates] - directions[newNode], axis=1)
+      for k, kDist in zip(candidates[dist < NNdist[candidates]], dist[dist < NNdist[candidates]]):
+        _setNN(k, newNode, kDist)
+
+    # Refresh the NN of the nodes whose NN was merged
+    for k in staleNodes:
+      _setNN(k, *tiling.nearest(k))
+
+
+  return tree_dic, np.flatnonzero(active), jet_content, root_node, Nconst, N_leaves_list, linkage_list
 
-    return new_list, var_dij_history, tree_dic, idx, jet_content, N_leaves_list, linkage_list
 
 
 
@@ -336,7 +809,7 @@ def _traverse(
         dendrogram=True,
 ):
     """
-    This function call the recursive function _traverse_rec to make the trees starting from the root
+    This function builds the tree starting from the root, with the node ids relabeled in preorder (see treeKernels.relabelPreorder)
     :param root: root node id
     :param jet_nodes: array with the momentum of all the nodes of the jet tree (both leaves and inners).
     :param tree_dic: dictionary that has the node id of a parent as a key and a list with the id of the 2 children as the values
@@ -353,135 +826,15 @@ def _traverse(
 
     """
 
-    tree = []
-    content = []
-    node_id = []
-    tree_ancestors = []
-
-    _traverse_rec(
-    root,
-    -1,
-    False,
-    tree,
-    content,
-    jet_nodes,
-    tree_dic=tree_dic,
-    Nleaves=Nleaves,
-    node_id=node_id,
-    ancestors=[],
-    tree_ancestors=tree_ancestors,
-    dendrogram=dendrogram,
-    )
-
-    return tree, content, node_id, tree_ancestors
-
-
-
-
-
-
-def _traverse_rec(
+    return treeKernels.relabelPreorder(
         root,
-        parent_id,
-        is_left,
-        tree,
-        content,
         jet_nodes,
-        tree_dic=None,
-        Nleaves=None,
-        node_id=None,
-        ancestors=None,
-        tree_ancestors=[],
-        dendrogram=False,
-):
-    """
-    Recursive function to build the jet tree structure.
-    :param root: parent node momentum
-    :param parent_id: parent node idx
-    :param is_left: bool.
-    :param tree: List with the tree
-    :param content: List with the momentum vectors
-    :param jet_nodes: array with the momentum of all the nodes of the jet tree (both leaves and inners).
-    :param tree_dic: dictionary that has the node id of a parent as a key and a list with the id of the 2 children as the values
-    :param Nleaves: Number of constituents (leaves)
-    :param node_id: list where leaves idxs are added in the order they appear when we traverse the reclustered tree (each number indicates the node id
-    that we picked when we did the reclustering.). However, the idx value specifies the order in which the leaf nodes appear when traversing the truth level jet . The value here is an integer between 0 and Nleaves.
-    So if we went from truth to kt algorithm, then in the truth tree the leaves go as [0,1,2,3,4,,...,Nleaves-1]
-    :param ancestors: 1 entry of tree_ancestors (there is one for each leaf of the tree). It is appended to tree_ancestors.
-    :param tree_ancestors: List with one entry for each leaf of the tree, where each entry lists all the ancestor node ids when traversing the tree from the root to the leaf node.
-    :param dendrogram: bool. If True, append ancestors to tree_ancestors list.
-    """
+        tree_dic,
+        Nleaves,
+        dendrogram=dendrogram,
+    )
 
 
-    id = len(tree) // 2
-    if parent_id >= 0:
-        if is_left:
-            tree[2 * parent_id] = id  # We set the location of the lef child in the content array. So the left child momentum will be content[tree[2 * parent_id]]
-        else:
-            tree[2 * parent_id + 1] = id  # We set the location of the right child in the content array. So the right child will be content[tree[2 * parent_id+1]]
-    """"(With each 4-vector we increase the content array by one element and the tree array by 2 elements. But then we take id=tree.size()//2, so the id increases by 1. The left and right children are added one after the other.)"""
-
-
-    # Insert 2 new nodes to the vector that constitutes the tree.
-    # In the next iteration we will replace this 2 values with the location of the parent of the new nodes
-    tree.append(-1)
-    tree.append(-1)
-
-    # Fill the content vector with the values of the node
-    content.append(jet_nodes[root])
-
-    new_ancestors = None
-    if dendrogram:
-        new_ancestors = np.copy(ancestors)
-        logger.debug(f" ancestors before = {ancestors}")
-        new_ancestors = np.append(new_ancestors, root)  # Node ids in terms of the truth jet dictionary
-        logger.debug(f" ancestors after = {ancestors}")
-
-
-    # We move from the root down until we get to the leaves. We do this recursively
-    if root >= Nleaves:
-
-        children = tree_dic[root]
-        logger.debug(f"Children = {children}")
-
-
-        L_idx = children[0]
-        R_idx = children[1]
-
-
-        _traverse_rec(L_idx, id,
-                      True,
-                      tree,
-                      content,
-                      jet_nodes,
-                      tree_dic,
-                      Nleaves=Nleaves,
-                      node_id=node_id,
-                      ancestors=new_ancestors,
-                      dendrogram=dendrogram,
-                      tree_ancestors=tree_ancestors,
-                      )
-
-        _traverse_rec(R_idx,
-                      id,
-                      False,
-                      tree,
-                      content,
-                      jet_nodes,
-                      tree_dic,
-                      Nleaves=Nleaves,
-                      node_id=node_id,
-                      ancestors=new_ancestors,
-                      dendrogram=dendrogram,
-                      tree_ancestors=tree_ancestors,
-                      )
-
-    # If not then its a leaf
-    else:
-        node_id.append(root)
-        if dendrogram:
-            tree_ancestors.append(new_ancestors)
-            logger.debug(f"tree_ancestors= {tree_ancestors}")
 
 
 
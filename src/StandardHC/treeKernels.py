@@ -0,0 +1,232 @@
+import numpy as np
+import logging
+
+from .utils import get_logger
+
+logger = get_logger(level=logging.INFO)
+
+
+"""
+Non-recursive tree kernels.
+
+A jet tree is the array jet["tree"] of shape (Nnodes, 2) with the [left, right] children of each node ([-1, -1] for the leaves).
+The traversal orders are computed once with an explicit stack, and the per node quantities (leaves, depths, ancestors, subtree leaf counts)
+are then computed by sweeping over these orders, so deep (unbalanced) trees do not hit the python recursion limit and there is no frame overhead per node.
+
+The preorder (node, left subtree, right subtree) is the order in which the recursive functions of this package visit the nodes,
+so lists filled along the preorder keep the same order as before.
+"""
+
+
+
+
+def preorder(tree, root_id):
+    """
+    Node ids of the subtree of root_id in preorder (node, left subtree, right subtree).
+
+    Args:
+        - tree: array of shape (Nnodes, 2) (or list) with the [left, right] children of each node.
+        - root_id: id of the node where the traversal starts.
+
+    Returns:
+        - order: int array with the node ids.
+    """
+    tree = np.asarray(tree).reshape(-1, 2).tolist()
+
+    order = []
+    stack = [int(root_id)]
+    while stack:
+        node = stack.pop()
+        order.append(node)
+        left, right = tree[node]
+        if left != -1 and right != -1:
+            """ Push the right child first, so that the left subtree is visited first """
+            stack.append(right)
+            stack.append(left)
+
+    return np.asarray(order, dtype=np.int64)
+
+
+
+
+def postorder(tree, root_id):
+    """
+    Node ids of the subtree of root_id in postorder (left subtree, right subtree, node), i.e. every node comes after its children.
+    It is the reverse of the (node, right subtree, left subtree) preorder.
+    """
+    tree = np.asarray(tree).reshape(-1, 2).tolist()
+
+    order = []
+    stack = [int(root_id)]
+    while stack:
+        node = stack.pop()
+        order.append(node)
+        left, right = tree[node]
+        if left != -1 and right != -1:
+            stack.append(left)
+            stack.append(right)
+
+    return np.asarray(order[::-1], dtype=np.int64)
+
+
+
+
+def parents(tree, Nnodes=None):
+    """
+    Parent id of each node (-1 for the root and for the nodes that are not in the tree).
+    """
+    tree = np.asarray(tree).reshape(-1, 2)
+    if Nnodes is None:
+        Nnodes = len(tree)
+
+    parent = np.full(Nnodes, -1, dtype=np.int64)
+    inner = np.flatnonzero(tree[:, 0] != -1)
+    parent[tree[inner, 0]] = inner
+    parent[tree[inner, 1]] = inner
+
+    return parent
+
+
+
+
+def leaves(tree, root_id):
+    """
+    Leaf ids of the subtree of root_id, in the order they are visited (left to right).
+    """
+    order = preorder(tree, root_id)
+    tree = np.asarray(tree).reshape(-1, 2)
+
+    return order[tree[order, 0] == -1]
+
+
+
+
+def depths(tree, root_id, order=None):
+    """
+    Depth of each node of the subtree of root_id (0 for root_id), as an array over the node ids (-1 for the nodes that are not in the subtree).
+
+    Args:
+        - tree: array with the [left, right] children of each node.
+        - root_id: id of the root node.
+        - order: preorder of the subtree (computed if None).
+    """
+    tree = np.asarray(tree).reshape(-1, 2)
+    if order is None:
+        order = preorder(tree, root_id)
+
+    depth = np.full(len(tree), -1, dtype=np.int64)
+    depth[root_id] = 0
+
+    """ Parents come before their children in preorder """
+    inner = order[tree[order, 0] != -1]
+    for node in inner.tolist():
+        depth[tree[node]] = depth[node] + 1
+
+    return depth
+
+
+
+
+def subtreeLeafCounts(tree, root_id, order=None):
+    """
+    Number of leaves under each node of the subtree of root_id (1 for the leaves), as an array over the node ids (0 for the nodes that are not in the subtree).
+
+    Args:
+        - tree: array with the [left, right] children of each node.
+        - root_id: id of the root node.
+        - order: postorder of the subtree (computed if None).
+    """
+    tree = np.asarray(tree).reshape(-1, 2)
+    if order is None:
+        order = postorder(tree, root_id)
+
+    counts = np.zeros(len(tree), dtype=np.int64)
+    isLeaf = tree[order, 0] == -1
+    counts[order[isLeaf]] = 1
+
+    """ Children come before their parents in postorder """
+    for node in order[~isLeaf].tolist():
+        left, right = tree[node]
+        counts[node] = counts[left] + counts[right]
+
+    return counts
+
+
+
+
+def treeAncestors(tree, root_id):
+    """
+    List with one entry for each leaf of the subtree of root_id (in the order they are visited), where each entry is a float array with all the
+    ancestor node ids when traversing the tree from root_id to the leaf (both included).
+    """
+    treeList = np.asarray(tree).reshape(-1, 2).tolist()
+
+    tree_ancestors = []
+    stack = [(int(root_id), ())]
+    while stack:
+        node, path = stack.pop()
+        path = path + (node,)
+        left, right = treeList[node]
+        if left == -1 or right == -1:
+            tree_ancestors.append(np.asarray(path, dtype=float))
+        else:
+            stack.append((right, path))
+            stack.append((left, path))
+
+    return tree_ancestors
+
+
+
+
+def relabelPreorder(root, nodeContent, children, Nleaves, dendrogram=True):
+    """
+    Build the jet tree of a clustering history, with the node ids relabeled in preorder from the root (the root is node 0).
+
+    Args:
+        - root: root node id in the clustering history.
+        - nodeContent: array with the momentum of all the nodes of the clustering history (both leaves and inners).
+        - children: dictionary (or list) with the [left, right] children ids of each inner node of the clustering history.
+        - Nleaves: Number of constituents (leaves). The node ids of the leaves are 0, ..., Nleaves - 1.
+        - dendrogram: bool. If True, then return the tree_ancestors list.
+
+    Returns:
+        - tree: flat list with the [left, right] children of each relabeled node ([-1, -1] for the leaves).
+        - content: list with the momentum of each relabeled node.
+        - node_id: list with the clustering history ids of the leaves, in the order they are visited.
+        - tree_ancestors: List with one entry for each leaf of the tree, where each entry is a float array with all the ancestor node ids
+          (clustering history ids) when traversing the tree from the root to the leaf node (both included).
+    """
+
+    tree = []
+    content = []
+    node_id = []
+    tree_ancestors = []
+
+    """ Stack of (node id in the clustering history, relabeled parent id, is left child, ancestors) """
+    stack = [(root, -1, False, ())]
+    while stack:
+        node, parent_id, is_left, ancestors = stack.pop()
+
+        """ With each node we increase the tree list by 2 elements, so the relabeled id increases by 1 """
+        id = len(tree) // 2
+        if parent_id >= 0:
+            tree[2 * parent_id + (0 if is_left else 1)] = id
+
+        tree.append(-1)
+        tree.append(-1)
+        content.append(nodeContent[node])
+
+        if dendrogram:
+            ancestors = ancestors + (node,)
+
+        if node >= Nleaves:
+            """ Push the right child first, so that the left subtree is visited first """
+            stack.append((children[node][1], id, False, ancestors))
+            stack.append((children[node][0], id, True, ancestors))
+
+        else:
+            node_id.append(node)
+            if dendrogram:
+                tree_ancestors.append(np.asarray(ancestors, dtype=float))
+
+    return tree, content, node_id, tree_ancestors
@@ -0,0 +1,298 @@
+import numpy as np
+import logging
+import pickle
+import time
+from scipy.special import logsumexp
+
+from . import likelihood_invM as likelihood
+from . import N2Greedy_invM as N2Greedy
+from . import auxFunctions_invM as auxFunctions
+
+from .utils import get_logger
+
+logger = get_logger(level=logging.INFO)
+
+
+"""
+Exact cluster trellis (subset dynamic programming) for small jets:
+Each set of leaves S (a bitmask over the N leaves) is a node of the trellis. The best tree over S is the best split S = A + B (A contains the lowest leaf of S,
+so each split is only counted once) of
+	best[S] = max_A ( logLH(A, B) + best[A] + best[B] ),   best[leaf] = 0
+and the partition function over all the trees is the same recursion with logsumexp instead of max.
+The subsets are processed by number of leaves, and all the splits of the subsets with the same number of leaves are scored with one call to the batched likelihood kernel.
+
+There are ~3^N / 2 splits (2.6e5 for N = 12, 7e6 for N = 15), so this is only for small jets. It gives the exact maximum likelihood tree to benchmark the greedy and beam search algorithms.
+"""
+
+MAX_LEAVES = 15
+
+
+def recluster(
+		input_jet,
+		save = False,
+		delta_min = None,
+		lam = None,
+		partition = False,
+		visualize = False,
+		backend = None,
+		maxLeaves = MAX_LEAVES,
+):
+	"""
+	Get the leaves of an input jet, find the maximum likelihood tree with the cluster trellis and create the jet dictionary for it.
+	The output is a list with one jet dictionary, with the same layout as beamSearchOptimal_invM.recluster (so it can be used with BSTrellis=True in logLHCut and jetsLogLH).
+
+	New features added to the tree (besides the ones of beamSearchOptimal_invM.recluster):
+		- jet["maxLogLH"]: log likelihood of the maximum likelihood tree, in the model of the backend.
+		- jet["logZ"]: log of the partition function, i.e. of the sum of the likelihood of all the trees over the leaves (if partition=True).
+		- jet["NTrees"]: number of trees over the leaves, (2N-3)!! (if partition=True).
+
+	Args:
+		- input_jet: any jet dictionary with the clustering history.
+		- delta_min: pT cut scale for the showering process to stop.
+		- lam: decaying rate value for the exponential distribution.
+		- partition: if True, also calculate the partition function.
+		- visualize: if true, calculate extra features needed for the visualizations and add them to the tree dictionary.
+		- backend: likelihood backend used to score the pairings (see likelihood_invM.getBackend). Default: stop / non-stop model (fast backend).
+		- maxLeaves: raise a ValueError for jets with more leaves than this.
+		- save: if true, save the reclustered jet dictionary list
+
+	Returns:
+		- jetsList: List with the jet dictionary of the maximum likelihood tree
+	"""
+	startTime = time.time()
+
+	""" Get jet constituents list (tree leaves) """
+	jet_const = N2Greedy.getConstituents(
+		input_jet,
+		input_jet["root_id"],
+		[],
+	)
+
+	Nconst = len(jet_const)
+	if Nconst > maxLeaves:
+		raise ValueError(f"The trellis is for jets with up to {maxLeaves} leaves, this jet has {Nconst}")
+
+	jetTree, \
+	jetContent, \
+	root_node, \
+	logLH, \
+	maxLogLH, \
+	logZ = trellis(
+		jet_const,
+		delta_min = delta_min,
+		lam = lam,
+		lamRoot = float(input_jet["LambdaRoot"]),
+		partition = partition,
+		backend = backend,
+	)
+
+	tree, \
+	content, \
+	node_id, \
+	tree_ancestors = N2Greedy._traverse(
+		root_node,
+		jetContent,
+		jetTree=jetTree,
+		Nleaves=Nconst,
+	)
+
+	jet = {}
+	jet["root_id"] = 0
+	jet["node_id"] = node_id
+	jet["tree"] = np.asarray(tree).reshape(-1, 2)
+	jet["content"] = np.asarray(content).reshape(-1, 4)
+	jet["Nconst"] = Nconst
+	jet["algorithm"] = "trellis"
+	jet["M_Hard"] = float(input_jet["M_Hard"])
+	jet["pt_cut"] = delta_min
+	jet["Lambda"] = lam
+	jet["LambdaRoot"] = float(input_jet["LambdaRoot"])
+	jet["logLH"] = np.asarray(logLH)
+	jet["maxLogLH"] = maxLogLH
+	if partition:
+		jet["logZ"] = logZ
+		jet["NTrees"] = numberOfTrees(Nconst)
+
+	""" Extra features needed for visualizations """
+	if visualize:
+		jet["tree_ancestors"] = tree_ancestors
+
+	""" Fill deltas list (needed to fill the jet log LH)"""
+	jet = likelihood.fill_jet_info(jet, parent_id=None)
+
+	"""Fill jet dictionaries with log likelihood of truth jet"""
+	jet = likelihood.enrich_jet_logLH(jet, dij=True)
+
+	""" Angular quantities"""
+	ConstPhi, PhiDelta, PhiDeltaListRel = auxFunctions.traversePhi(jet, jet["root_id"], [], [], [])
+	jet["ConstPhi"] = ConstPhi
+	jet["PhiDelta"] = PhiDelta
+	jet["PhiDeltaRel"] = PhiDeltaListRel
+
+	logger.debug(f" Trellis total time = {time.time() - startTime}")
+
+	jetsList = [jet]
+
+	""" Save reclustered tree """
+	if save:
+		out_dir = "data/"
+		out_filename = out_dir + str(input_jet["name"]) + '_trellis.pkl'
+		logger.info(f"Output jet filename = {out_filename}")
+		with open(out_filename, "wb") as f:
+			pickle.dump(jetsList, f, protocol=2)
+
+	return jetsList
+
+
+
+
+def numberOfTrees(Nleaves):
+	"""
+	Number of binary trees over Nleaves labeled leaves, (2N-3)!! = 1 x 3 x 5 x ... x (2N-3)
+	"""
+	return int(np.prod(np.arange(1, 2 * Nleaves - 2, 2, dtype=object))) if Nleaves > 1 else 1
+
+
+
+
+def subsetSplits(subsets, Nleaves):
+	"""
+	All the splits S = A + B of each subset S of leaves with the same number of leaves k, where A contains the lowest leaf of S.
+
+	Args:
+		- subsets: int array of shape (Nsubsets,) with the bitmasks of the subsets. All of them with k >= 2 leaves.
+		- Nleaves: number of leaves.
+
+	Returns:
+		- A: int array of shape (Nsubsets, 2^(k-1) - 1) with the bitmasks of A (B = S - A).
+	"""
+	subsets = np.asarray(subsets, dtype=np.int64)
+	bits = (subsets[:, None] >> np.arange(Nleaves)) & 1
+
+	""" Leaves of each subset, in increasing order: positions[i] = [lowest leaf, ...] """
+	k = int(bits[0].sum())
+	positions = np.nonzero(bits)[1].reshape(len(subsets), k)
+
+	""" A = lowest leaf + any subset of the other k-1 leaves, except all of them (then B would be empty) """
+	choose = (np.arange(2 ** (k - 1) - 1)[:, None] >> np.arange(k - 1)) & 1
+	A = (1 << positions[:, 0])[:, None] + ((1 << positions[:, 1:]) @ choose.T)
+
+	return A
+
+
+
+
+def trellis(
+		levelContent,
+		delta_min = None,
+		lam = None,
+		lamRoot = None,
+		partition = False,
+		backend = None,
+		maxElements = 2 ** 20,
+):
+	"""
+	Runs the cluster trellis over the jet constituents.
+
+	Args:
+		- levelContent: jet constituents (i.e. the leaves of the tree)
+		- delta_min: pT cut scale for the showering process to stop.
+		- lam: decaying rate value for the exponential distribution.
+		- lamRoot: decaying rate value for the root splitting.
+		- partition: if True, also calculate the log of the partition function.
+		- backend: likelihood backend used to score the pairings (name or likelihood_invM.likelihoodBackend object). Default: stop / non-stop model (fast backend).
+		- maxElements: max number of splits scored in one call to the backend.
+
+	Returns:
+		- jetTree: list with the [left, right] children of each node of the clustering history (leaves 0, ..., N-1, then the inner nodes).
+		- jetContent: list with the momentum of all the nodes of the clustering history.
+		- root_node: root node id
+		- logLH: list with the log likelihood of each splitting of the best tree, in the order of the inner nodes.
+		- maxLogLH: log likelihood of the best tree.
+		- logZ: log of the partition function (None if partition=False).
+	"""
+
+	backend = likelihood.getBackend(backend)
+
+	Nconst = len(levelContent)
+	Nsubsets = 2 ** Nconst
+	full = Nsubsets - 1
+
+	""" Momentum and delta (0 for the leaves) of every subset of leaves """
+	leaves = np.asarray(levelContent, dtype=float).reshape(-1, 4)
+	masks = np.arange(Nsubsets)
+	bits = (masks[:, None] >> np.arange(Nconst)) & 1
+	subsetContent = bits @ leaves
+	Nleaves = bits.sum(axis=1)
+	subsetDeltas = np.where(Nleaves >= 2, likelihood.get_invM_batch(subsetContent), 0.)
+
+	""" best[S], best split A of S and log likelihood of that split. Leaves have best = 0 (and logZ = 0) """
+	best = np.full(Nsubsets, - np.inf)
+	best[Nleaves == 1] = 0.
+	bestSplit = np.zeros(Nsubsets, dtype=np.int64)
+	bestSplitLogLH = np.full(Nsubsets, - np.inf)
+	logZ = best.copy() if partition else None
+
+	for k in range(2, Nconst + 1):
+
+		levelSubsets = np.flatnonzero(Nleaves == k)
+		Nsplits = 2 ** (k - 1) - 1
+		chunk = max(1, maxElements // Nsplits)
+
+		for start in range(0, len(levelSubsets), chunk):
+			S = levelSubsets[start:start + chunk]
+			A = subsetSplits(S, Nconst)
+			B = S[:, None] - A
+
+			"""Heavy resonance is modeled by a different decaying rate"""
+			lamSplit = np.where(S == full, lamRoot if lamRoot is not None else lam, lam)
+			lamSplit = np.broadcast_to(lamSplit[:, None], A.shape).reshape(-1)
+
+			splitLogLH = backend.split_logLH_batch(
+				subsetContent[A.reshape(-1)],
+				subsetDeltas[A.reshape(-1)],
+				subsetContent[B.reshape(-1)],
+				subsetDeltas[B.reshape(-1)],
+				delta_min,
+				lamSplit,
+			).reshape(A.shape)
+
+			""" If there is a tie, keep the 1st split """
+			total = splitLogLH + best[A] + best[B]
+			idx = np.argmax(total, axis=1)
+			rows = np.arange(len(S))
+			best[S] = total[rows, idx]
+			bestSplit[S] = A[rows, idx]
+			bestSplitLogLH[S] = splitLogLH[rows, idx]
+
+			if partition:
+				logZ[S] = logsumexp(splitLogLH + logZ[A] + logZ[B], axis=1)
+
+		logger.debug(f" Subsets with {k} leaves = {len(levelSubsets)}, splits = {len(levelSubsets) * Nsplits}")
+
+	""" Build the best tree from the root (children before parents, so the root is the last node) """
+	jetTree = [[-1, -1] for _ in range(Nconst)]
+	jetContent = [leaves[i] for i in range(Nconst)]
+	logLH = []
+
+	nodeId = {1 << i: i for i in range(Nconst)}
+	stack = [(full, False)]
+	while stack:
+		S, expanded = stack.pop()
+		if S in nodeId:
+			continue
+		A = int(bestSplit[S])
+		B = S - A
+		if not expanded:
+			stack.append((S, True))
+			stack.append((B, False))
+			stack.append((A, False))
+		else:
+			nodeId[S] = len(jetContent)
+			jetTree.append([nodeId[A], nodeId[B]])
+			jetContent.append(subsetContent[S])
+			logLH.append(bestSplitLogLH[S])
+
+	root_node = nodeId[full]
+
+	return jetTree, jetContent, root_node, logLH, best[full], (logZ[full] if partition else None)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+""" Run the tests against the package in src/ (setup.py uses package_dir={"": "src"}) without installing it """
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
@@ -0,0 +1,181 @@
+import os
+import pickle
+
+import numpy as np
+import pytest
+
+from StandardHC import likelihood_invM as likelihood
+
+""" Truth jets from the Ginkgo simulator (9 leaves each) """
+TRUTH_JETS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "truth", "tree_100_truth_3.pkl")
+
+
+"""####################################"""
+""" Test pairings """
+
+@pytest.fixture(scope="module")
+def jets():
+    with open(TRUTH_JETS, "rb") as fd:
+        return pickle.load(fd, encoding="latin-1")[:20]
+
+
+def model_params(jet):
+    return float(jet["pt_cut"]), float(jet["Lambda"])
+
+
+def all_pairs(jet):
+    """ Every pair of nodes (leaves and inner nodes) of the jet, most of them not allowed """
+    content = np.asarray(jet["content"], dtype=float)
+    i, j = np.triu_indices(len(content), 1)
+    return content[i], content[j]
+
+
+def truth_pairs(jet):
+    """ Children of the inner nodes of the truth tree """
+    content = np.asarray(jet["content"], dtype=float)
+    tree = np.asarray(jet["tree"])
+    inner = tree[:, 0] >= 0
+    return content[tree[inner, 0]], content[tree[inner, 1]]
+
+
+def self_pairs(jet):
+    """ Each node paired with itself: sqrt(tL) + sqrt(tR) = sqrt(tp), on the boundary of the allowed region """
+    content = np.asarray(jet["content"], dtype=float)
+    return content, content
+
+
+def massless_nodes(rng, P):
+    """ Massless nodes in random directions, so the invariant mass E^2 - |p|^2 is only rounding noise """
+    p = rng.normal(scale=rng.choice([0.1, 1., 10., 100.], size=(P, 1)), size=(P, 3))
+    return np.concatenate((np.linalg.norm(p, axis=1)[:, None], p), axis=1)
+
+
+def scalar_invM(p):
+    return np.array([node[0] ** 2 - np.linalg.norm(node[1::]) ** 2 for node in p])
+
+
+def backend_names(*names):
+    for name in names:
+        if name == "numba":
+            pytest.importorskip("numba")
+        elif name == "tf":
+            pytest.importorskip("tensorflow")
+    return names
+
+
+""" Backend pairs (the first one is the reference) and tolerance """
+BACKEND_PAIRS = [
+    (("scalar", "numpy"), 1e-12),
+    (("numpy", "numba"), 1e-12),
+    (("scalar", "numba"), 1e-12),
+    (("numpy", "tf"), 1e-11),
+]
+
+
+"""####################################"""
+
+@pytest.mark.parametrize("backends, rtol", BACKEND_PAIRS)
+@pytest.mark.parametrize("pairs", [all_pairs, truth_pairs, self_pairs])
+def test_jet_pairings(jets, pairs, backends, rtol):
+    backends = backend_names(*backends)
+    for jet in jets:
+        t_cut, lam = model_params(jet)
+        pL, pR = pairs(jet)
+
+        maxDiff = likelihood.check_backends(pL, pR, t_cut, lam, backends=backends, rtol=rtol)
+
+        assert set(maxDiff) == {backends[1]}
+
+
+def test_truth_pairings_allowed(jets):
+    """ The truth splittings are allowed by the stop / non-stop model, so the consistency tests compare finite values """
+    for jet in jets:
+        t_cut, lam = model_params(jet)
+        pL, pR = truth_pairs(jet)
+
+        assert np.all(np.isfinite(likelihood.getBackend("numpy").split_logLH_batch(pL, None, pR, None, t_cut, lam)))
+
+
+@pytest.mark.parametrize("backends, rtol", [(("numpy", "numba"), 1e-12), (("numpy", "tf"), 1e-9)])
+def test_massless_batched(backends, rtol):
+    """ The batched kernels compute the invariant masses in the same way, so they agree on massless nodes """
+    backends = backend_names(*backends)
+    rng = np.random.default_rng(0)
+    pL, pR = massless_nodes(rng, 2000), massless_nodes(rng, 2000)
+
+    likelihood.check_backends(pL, pR, 1., 1.5, backends=backends, rtol=rtol)
+
+
+def test_massless_scalar():
+    """
+    The scalar and batched kernels can disagree on massless nodes (see check_backends), only because their invariant masses round differently:
+    they agree on the pairings where the invariant masses of the two children and of the parent are the same.
+    """
+    rng = np.random.default_rng(0)
+    pL, pR = massless_nodes(rng, 2000), massless_nodes(rng, 2000)
+
+    sameInvM = (scalar_invM(pL) == likelihood.get_invM_batch(pL)) \
+               & (scalar_invM(pR) == likelihood.get_invM_batch(pR)) \
+               & (scalar_invM(pL + pR) == likelihood.get_invM_batch(pL + pR))
+    assert np.sum(sameInvM) > 1000
+
+    likelihood.check_backends(pL[sameInvM], pR[sameInvM], 1., 1.5, backends=("scalar", "numpy"), rtol=1e-12)
+
+
+def test_massless_exact():
+    """ Massless nodes along the z axis, where the invariant mass is exactly 0 in floating point """
+    rng = np.random.default_rng(1)
+    a = rng.uniform(1., 100., 500)
+    b = rng.uniform(1., 100., 500)
+    zeros = np.zeros(500)
+    pL = np.stack((a, zeros, zeros, a), axis=1)
+    pR = np.stack((b, zeros, zeros, -b), axis=1)
+
+    likelihood.check_backends(pL, pR, 1., 1.5, backends=("scalar", "numpy"), rtol=1e-12)
+
+
+def test_self_check_pairs():
+    """ Sample of pairings used by fastBackend, with allowed and not allowed pairings """
+    backends = backend_names("numpy", "numba")
+    pL, pR, lam = likelihood._selfCheckPairs()
+    logLH = likelihood.getBackend("numpy").split_logLH_batch(pL, None, pR, None, 1., lam)
+    assert 0 < np.sum(np.isfinite(logLH)) < len(logLH)
+
+    likelihood.check_backends(pL, pR, 1., lam, backends=backends, rtol=1e-12)
+
+
+"""####################################"""
+""" check_backends errors """
+
+class offsetBackend(likelihood.numpyBackend):
+    name = "offset"
+
+    def split_logLH_batch(self, pL, tL, pR, tR, t_cut, lam):
+        return super().split_logLH_batch(pL, tL, pR, tR, t_cut, lam) + 1e-6
+
+
+class maskBackend(likelihood.numpyBackend):
+    name = "mask"
+
+    def split_logLH_batch(self, pL, tL, pR, tR, t_cut, lam):
+        logLH = super().split_logLH_batch(pL, tL, pR, tR, t_cut, lam)
+        logLH[np.argmax(np.isfinite(logLH))] = - np.inf
+        return logLH
+
+
+def test_check_backends_model_mismatch(jets):
+    pL, pR = all_pairs(jets[0])
+    with pytest.raises(ValueError, match="same model"):
+        likelihood.check_backends(pL, pR, 16., 1.5, backends=("legacy", "numpy"))
+
+
+def test_check_backends_value_mismatch(jets):
+    pL, pR = truth_pairs(jets[0])
+    with pytest.raises(ValueError, match="max difference"):
+        likelihood.check_backends(pL, pR, 16., 1.5, backends=("numpy", offsetBackend()), rtol=1e-9)
+
+
+def test_check_backends_mask_mismatch(jets):
+    pL, pR = truth_pairs(jets[0])
+    with pytest.raises(ValueError, match="allowed pairings"):
+        likelihood.check_backends(pL, pR, 16., 1.5, backends=("numpy", maskBackend()))
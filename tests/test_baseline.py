@@ -0,0 +1,96 @@
+import os
+import pickle
+
+import numpy as np
+import pytest
+
+from StandardHC import N2Greedy_invM as N2Greedy
+from StandardHC import beamSearchOptimal_invM as BSO
+from StandardHC import likelihood_invM as likelihood
+from StandardHC import reclusterTree_invM as reclusterTree
+
+"""
+The rewritten engines have to give the same trees as the original ones. tests/data/baseline_*_truth_3.npz have the outputs of the engines of the first commit
+of the repository for the truth jets of data/truth/tree_100_truth_3.pkl (all of them have 9 leaves, so the arrays of the jets are stacked).
+"""
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+TRUTH_JETS = os.path.join(os.path.dirname(TESTS_DIR), "data", "truth", "tree_100_truth_3.pkl")
+
+
+def baseline(name):
+    with np.load(os.path.join(TESTS_DIR, "data", "baseline_" + name + "_truth_3.npz")) as npz:
+        return dict(npz)
+
+
+def legacyLogLH(jet, delta_min, lam):
+    """ Log likelihood of a tree with the model optimized by the legacy backend (split_logLH with the node deltas) """
+    tree, content, deltas = np.asarray(jet["tree"]), np.asarray(jet["content"]), np.asarray(jet["deltas"])
+    return sum(
+        likelihood.split_logLH(content[left], deltas[left], content[right], deltas[right], delta_min, lam)
+        for left, right in tree if left >= 0
+    )
+
+
+@pytest.fixture(scope="module")
+def jets():
+    with open(TRUTH_JETS, "rb") as fd:
+        return pickle.load(fd, encoding="latin-1")
+
+
+"""####################################"""
+
+def test_greedy_legacy(jets):
+    """ N2Greedy_invM.greedyLH (pairings matrix, NN cache and heap) with the legacy model, as the original level by level greedy algorithm """
+    expected = baseline("greedy")
+
+    for k, jet in enumerate(jets):
+        greedyJet = N2Greedy.recluster(
+            dict(jet),
+            delta_min=jet["pt_cut"],
+            lam=float(jet["Lambda"]),
+            visualize=True,
+            backend="legacy",
+        )
+
+        np.testing.assert_array_equal(greedyJet["tree"], expected["tree"][k])
+        np.testing.assert_array_equal(greedyJet["content"], expected["content"][k])
+        np.testing.assert_allclose(greedyJet["logLH"], expected["logLH"][k], rtol=1e-12, atol=1e-12)
+
+
+def test_beam_search_legacy(jets):
+    """
+    Beam search with the legacy model. The latent paths that are permutations of the same forest are kept only once (canonical hashing),
+    so the beam can keep other paths. The trees of a few of these jets are not the same as the original ones, but none of them has a lower log likelihood.
+    """
+    expected = baseline("beamSearch")["legacyLogLH"]
+
+    logLH = []
+    for jet in jets:
+        N = len(jet["leaves"])
+        BSJet = BSO.recluster(
+            dict(jet),
+            beamSize=min(3 * N, N * (N - 1) // 2),
+            delta_min=jet["pt_cut"],
+            lam=float(jet["Lambda"]),
+            N_best=1,
+            visualize=True,
+            backend="legacy",
+        )[0]
+        logLH.append(legacyLogLH(BSJet, jet["pt_cut"], float(jet["Lambda"])))
+
+    assert np.all(np.asarray(logLH) >= expected - 1e-10)
+    assert np.sum(np.isclose(logLH, expected, rtol=0, atol=1e-10)) >= 90
+
+
+@pytest.mark.parametrize("tiling", [False, True])
+@pytest.mark.parametrize("alpha, name", [(1, "Kt"), (-1, "Antikt"), (0, "CA")])
+def test_kt_antikt_CA(jets, alpha, name, tiling):
+    """ Generalized kt algorithms with the NN table (ktAntiktCA) and the direction tiling (tiledKtAntiktCA), as the original O(N^3) dijMinPair loop """
+    expected = baseline("kt")
+
+    for k, jet in enumerate(jets):
+        ktJet = reclusterTree.recluster(dict(jet), alpha=alpha, save=False, tiling=tiling)
+
+        np.testing.assert_array_equal(ktJet["tree"], expected[name + "_tree"][k])
+        np.testing.assert_array_equal(ktJet["content"], expected[name + "_content"][k])
+        np.testing.assert_array_equal(np.asarray(ktJet["linkage_list"], dtype=float), expected[name + "_linkage_list"][k])
@@ -0,0 +1,138 @@
+import os
+import pickle
+
+import numpy as np
+import pytest
+
+from StandardHC import jetClustering_invM as jetClustering
+from StandardHC import trellis_invM as trellis
+
+
+def failOdd(jet, scale=1):
+    """ Fails for the odd jets. Defined at module level, so that it can be sent to the worker processes """
+    if jet % 2:
+        raise ValueError(f"odd jet {jet}")
+    return scale * jet
+
+
+"""####################################"""
+""" runBatch error handling """
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_runBatch_failed_jets(workers):
+    """ A failing jet gives None, for any number of workers, and the rest of the batch is kept """
+    results = jetClustering.runBatch(failOdd, list(range(7)), workers=workers, chunksize=2, scale=10)
+
+    assert results == [0, None, 20, None, 40, None, 60]
+
+
+def test_runBatch_raiseErrors_serial():
+    with pytest.raises(ValueError, match="odd jet 1"):
+        jetClustering.runBatch(failOdd, list(range(4)), workers=1, raiseErrors=True)
+
+
+def test_runBatch_raiseErrors_workers():
+    with pytest.raises(RuntimeError, match="odd jet 1"):
+        jetClustering.runBatch(failOdd, list(range(4)), workers=2, raiseErrors=True)
+
+
+"""####################################"""
+""" Cluster trellis scan """
+
+@pytest.fixture(scope="module")
+def jets():
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "truth", "tree_100_truth_3.pkl")
+    with open(path, "rb") as fd:
+        return pickle.load(fd, encoding="latin-1")[:3]
+
+
+def joinJets(jetA, jetB):
+    """ Jet with the trees of jetA and jetB as the children of a new root (with the leaves of both jets) """
+    treeA, treeB = np.asarray(jetA["tree"]), np.asarray(jetB["tree"])
+    shiftA, shiftB = 1, 1 + len(treeA)
+
+    jet = dict(jetA)
+    jet["root_id"] = 0
+    jet["tree"] = np.concatenate((
+        [[jetA["root_id"] + shiftA, jetB["root_id"] + shiftB]],
+        np.where(treeA >= 0, treeA + shiftA, -1),
+        np.where(treeB >= 0, treeB + shiftB, -1),
+    ))
+    jet["content"] = np.concatenate((
+        [np.asarray(jetA["content"][jetA["root_id"]]) + np.asarray(jetB["content"][jetB["root_id"]])],
+        jetA["content"],
+        jetB["content"],
+    ))
+    jet["leaves"] = np.concatenate((jetA["leaves"], jetB["leaves"]))
+    return jet
+
+
+def test_trellis_over_limit_jet(jets):
+    """ A jet with more than trellis.MAX_LEAVES leaves is skipped (None), and the rest of the batch is kept, also with one worker """
+    bigJet = joinJets(jets[0], jets[1])
+    assert len(bigJet["leaves"]) > trellis.MAX_LEAVES
+
+    with pytest.raises(ValueError, match="up to"):
+        trellis.recluster(bigJet, delta_min=bigJet["pt_cut"], lam=float(bigJet["Lambda"]))
+
+    results = jetClustering.runBatch(jetClustering._trellisJet, [jets[0], bigJet, jets[2]], workers=1, raiseErrors=True)
+
+    assert results[1] is None
+    assert results[0]["tree"].shape == jets[0]["tree"].shape
+    assert results[2]["tree"].shape == jets[2]["tree"].shape
+
+
+def test_trellis_stream_pickle_layout(jets, tmp_path):
+    """ The streamed trellis pickle output has the same [jet] layout as the output of the scan without streaming """
+    in_filename = str(tmp_path / "truth.pkl")
+    with open(in_filename, "wb") as f:
+        pickle.dump(list(jets), f)
+
+    filenames = jetClustering.runStream(
+        jetClustering._trellisJet,
+        in_filename,
+        str(tmp_path / "Trellis"),
+        chunkSize=2,
+        pickleOutput=jetClustering._trellisJetsList,
+    )
+    assert [os.path.basename(filename) for filename in filenames] == ["Trellis_0_2.pkl", "Trellis_2_3.pkl"]
+
+    trellisJets = jetClustering.runBatch(jetClustering._trellisJet, jets)
+    expected = jetClustering._trellisJetsList(trellisJets)
+
+    jetsList, jetsListLogLH = [], []
+    for filename in filenames:
+        with open(filename, "rb") as fd:
+            chunkJets, chunkLogLH = pickle.load(fd)
+        jetsList += chunkJets
+        jetsListLogLH += chunkLogLH
+
+    assert all(isinstance(jet, list) and len(jet) == 1 for jet in jetsList)
+    for jet, expectedJet in zip(jetsList, expected[0]):
+        np.testing.assert_array_equal(jet[0]["tree"], expectedJet[0]["tree"])
+    np.testing.assert_allclose(jetsListLogLH, expected[1])
+
+
+def test_kt_stream_pickle_layout(jets, tmp_path):
+    """ The streamed kt pickle output is the plain jets list, as the output of the kt scans without streaming """
+    in_filename = str(tmp_path / "truth.pkl")
+    with open(in_filename, "wb") as f:
+        pickle.dump(list(jets), f)
+
+    filenames = jetClustering.runStream(
+        jetClustering._ktJet,
+        in_filename,
+        str(tmp_path / "Kt"),
+        chunkSize=2,
+        pickleOutput=jetClustering._ktJetsList,
+        alpha=1,
+    )
+
+    jetsList = []
+    for filename in filenames:
+        with open(filename, "rb") as fd:
+            jetsList += pickle.load(fd)
+
+    assert len(jetsList) == len(jets)
+    for jet, truthJet in zip(jetsList, jets):
+        np.testing.assert_array_equal(jet["tree"], jetClustering._ktJet(dict(truthJet), alpha=1)["tree"])
@@ -0,0 +1,200 @@
+import numpy as np
+import pytest
+
+from StandardHC import likelihood_invM as likelihood
+
+mpmath = pytest.importorskip("mpmath")
+
+""" mpmath working precision (decimal digits) for the reference values """
+DPS = 60
+
+
+"""####################################"""
+""" mpmath reference implementations. The float inputs are converted exactly, so the only error left is the one of the float kernels """
+
+def mp_log1mexp(x):
+    """ log(1 - exp(-x)). For large x, 1 - exp(-x) rounds to 1 even with DPS digits, so use log1p (which is accurate for small arguments) """
+    x = mpmath.mpf(x)
+    if x == 0:
+        return -mpmath.inf
+    if x > 1:
+        return mpmath.log1p(-mpmath.exp(-x))
+    return mpmath.log(-mpmath.expm1(-x))
+
+
+def mp_invM(p):
+    p = [mpmath.mpf(float(c)) for c in p]
+    return p[0] ** 2 - (p[1] ** 2 + p[2] ** 2 + p[3] ** 2)
+
+
+def mp_invM_sum(pL, pR):
+    """ Invariant mass squared of pL + pR, with the sum done exactly """
+    p = [mpmath.mpf(float(a)) + mpmath.mpf(float(b)) for a, b in zip(pL, pR)]
+    return p[0] ** 2 - (p[1] ** 2 + p[2] ** 2 + p[3] ** 2)
+
+
+def mp_split_logLH(pL, tL, pR, tR, t_cut, lam):
+    """ Same model as likelihood_invM.split_logLH """
+    tp1 = mp_invM_sum(pL, pR)
+    if tp1 < t_cut:
+        return -mpmath.inf
+
+    tL, tR, t_cut, lam = (mpmath.mpf(float(v)) for v in (tL, tR, t_cut, lam))
+    tmax, tmin = max(tL, tR), min(tL, tR)
+    tp2 = (mpmath.sqrt(tp1) - mpmath.sqrt(tmax)) ** 2
+
+    def get_p(tP, t):
+        if t > 0:
+            return -mp_log1mexp(lam) + mpmath.log(lam) - mpmath.log(tP) - lam * t / tP
+        return -mp_log1mexp(lam) + mp_log1mexp(lam * t_cut / tP)
+
+    return get_p(tp1, tmax) + get_p(tp2, tmin) + mpmath.log(1 / (4 * mpmath.pi))
+
+
+def mp_split_logLH_with_stop_nonstop_prob(pL, pR, t_cut, lam):
+    """ Same model as likelihood_invM.split_logLH_with_stop_nonstop_prob """
+    tL = mp_invM(pL)
+    tR = mp_invM(pR)
+    tp = mp_invM_sum(pL, pR)
+    t_cut, lam = mpmath.mpf(float(t_cut)), mpmath.mpf(float(lam))
+
+    if tp <= 0 or tL < 0 or tR < 0 or tp <= t_cut:
+        return -mpmath.inf
+    if tL >= (1 - mpmath.mpf("1e-3")) * tp or tR >= (1 - mpmath.mpf("1e-3")) * tp:
+        return -mpmath.inf
+    if mpmath.sqrt(tL) + mpmath.sqrt(tR) > mpmath.sqrt(tp):
+        return -mpmath.inf
+
+    def get_logp(tP, t):
+        log_norm = -mp_log1mexp((1 - mpmath.mpf(1e-3)) * lam)
+        if t > t_cut:
+            return log_norm + mpmath.log(lam) - mpmath.log(tP) - lam * t / tP
+        return log_norm + mp_log1mexp(lam * min(tP, t_cut) / tP)
+
+    tpLR = (mpmath.sqrt(tp) - mpmath.sqrt(tL)) ** 2
+    tpRL = (mpmath.sqrt(tp) - mpmath.sqrt(tR)) ** 2
+
+    logpLR = mpmath.log(mpmath.mpf(1) / 2) + get_logp(tp, tL) + get_logp(tpLR, tR)
+    logpRL = mpmath.log(mpmath.mpf(1) / 2) + get_logp(tp, tR) + get_logp(tpRL, tL)
+
+    return mpmath.log(mpmath.exp(logpLR) + mpmath.exp(logpRL)) + mpmath.log(1 / (4 * mpmath.pi))
+
+
+def reference(f, *args):
+    with mpmath.workdps(DPS):
+        return np.array([float(f(*entry)) for entry in zip(*args)])
+
+
+"""####################################"""
+""" Test pairings """
+
+def massless_pairs(rng, P):
+    """
+    Back-to-back massless leaves along the z axis, so tL = tR = 0 exactly in floating point and tp = 4 a b is well conditioned.
+    The splitting likelihood of these pairings is log1mexp(lam * t_cut / tp), which gave -inf for lam * t_cut / tp below ~4e-17.
+    """
+    a = rng.uniform(1., 100., P)
+    b = rng.uniform(1., 100., P)
+    zeros = np.zeros(P)
+    pL = np.stack((a, zeros, zeros, a), axis=1)
+    pR = np.stack((b, zeros, zeros, -b), axis=1)
+    return pL, pR
+
+
+def massive_pairs(rng, P, M=30.):
+    """
+    Pairings from the two body decay of a parent of mass M in its rest frame (plus a small boost), with child masses well inside the allowed region.
+    """
+    mL = M * rng.uniform(0.02, 0.45, P)
+    mR = M * rng.uniform(0.02, 0.45, P)
+    q = np.sqrt((M ** 2 - (mL + mR) ** 2) * (M ** 2 - (mL - mR) ** 2)) / (2 * M)
+    u = rng.normal(size=(P, 3))
+    u /= np.linalg.norm(u, axis=1)[:, None]
+    boost = rng.uniform(-0.3, 0.3, (P, 3)) * M
+    pL = np.concatenate((np.sqrt(q ** 2 + mL ** 2)[:, None], q[:, None] * u), axis=1)
+    pR = np.concatenate((np.sqrt(q ** 2 + mR ** 2)[:, None], - q[:, None] * u + boost), axis=1)
+    return pL, pR, mL ** 2, mR ** 2
+
+
+"""####################################"""
+
+def test_log1mexp_accuracy_envelope():
+    """ Relative error below 2.5e-16 on 6400 points in 1e-300 <= x <= 700, as stated in the log1mexp docstring """
+    x = np.logspace(-300, np.log10(700), 6400)
+    expected = reference(mp_log1mexp, x)
+
+    relErr = np.abs(likelihood.log1mexp(x) - expected) / np.abs(expected)
+
+    assert np.max(relErr) < 2.5e-16
+
+
+@pytest.mark.parametrize("x", [1e-300, 1e-30, 4e-17, 1e-17, 1e-8, np.log(2) * (1 - 1e-15), np.log(2), np.log(2) * (1 + 1e-15), 1., 37., 700.])
+def test_log1mexp_points(x):
+    """ Points around the branch switch at log(2) and in the small x region where log(1 - exp(-x)) gives -inf """
+    expected = reference(mp_log1mexp, [x])[0]
+
+    assert np.isfinite(likelihood.log1mexp(x))
+    assert likelihood.log1mexp(x) == pytest.approx(expected, rel=2.5e-16, abs=0)
+
+
+def test_log1mexp_limits():
+    assert likelihood.log1mexp(0.) == - np.inf
+    assert likelihood.log1mexp(800.) == 0.
+    assert np.shape(likelihood.log1mexp(np.ones((2, 3)))) == (2, 3)
+    assert np.ndim(likelihood.log1mexp(1.)) == 0
+
+
+@pytest.mark.parametrize("t_cut", [1e-300, 1e-200, 1e-100, 1e-30, 1e-16, 1e-5, 1.])
+@pytest.mark.parametrize("lam", [0.01, 1., 8., 100., 700.])
+def test_split_logLH_batch_small_x(t_cut, lam):
+    """ Leaf pairings, where the log likelihood is log1mexp(lam * t_cut / tp) with lam * t_cut / tp down to ~1e-307 """
+    rng = np.random.default_rng(0)
+    pL, pR = massless_pairs(rng, 50)
+    tL = tR = np.zeros(50)
+
+    logLH = likelihood.split_logLH_batch(pL, tL, pR, tR, t_cut, lam)
+    expected = reference(lambda l, r: mp_split_logLH(l, 0., r, 0., t_cut, lam), pL, pR)
+
+    assert np.all(np.isfinite(logLH))
+    np.testing.assert_allclose(logLH, expected, rtol=1e-13, atol=1e-13)
+
+
+@pytest.mark.parametrize("lam", [0.01, 1., 8., 100., 700.])
+def test_split_logLH_batch_massive(lam):
+    """ Pairings of inner nodes (t > 0) and of an inner node with a leaf, for the two branches of get_p """
+    rng = np.random.default_rng(1)
+    pL, pR, tL, tR = massive_pairs(rng, 100)
+    tR[::2] = 0.
+    t_cut = 0.5
+
+    logLH = likelihood.split_logLH_batch(pL, tL, pR, tR, t_cut, lam)
+    expected = reference(lambda l, a, r, b: mp_split_logLH(l, a, r, b, t_cut, lam), pL, tL, pR, tR)
+
+    np.testing.assert_allclose(logLH, expected, rtol=1e-12, atol=1e-12)
+
+
+@pytest.mark.parametrize("t_cut", [1e-300, 1e-200, 1e-100, 1e-30, 1e-16, 1e-5, 1.])
+@pytest.mark.parametrize("lam", [0.01, 1., 8., 100., 700.])
+def test_split_logLH_with_stop_nonstop_prob_batch_small_x(t_cut, lam):
+    rng = np.random.default_rng(2)
+    pL, pR = massless_pairs(rng, 50)
+
+    logLH = likelihood.split_logLH_with_stop_nonstop_prob_batch(pL, pR, t_cut, lam)
+    expected = reference(lambda l, r: mp_split_logLH_with_stop_nonstop_prob(l, r, t_cut, lam), pL, pR)
+
+    assert np.all(np.isfinite(logLH))
+    np.testing.assert_allclose(logLH, expected, rtol=1e-13, atol=1e-13)
+
+
+@pytest.mark.parametrize("t_cut", [1e-30, 1., 20.])
+@pytest.mark.parametrize("lam", [0.01, 1., 8., 100., 700.])
+def test_split_logLH_with_stop_nonstop_prob_batch_massive(t_cut, lam):
+    """ Massive children, above and below t_cut, for the two branches of get_logp """
+    rng = np.random.default_rng(3)
+    pL, pR, tL, tR = massive_pairs(rng, 100)
+
+    logLH = likelihood.split_logLH_with_stop_nonstop_prob_batch(pL, pR, t_cut, lam)
+    expected = reference(lambda l, r: mp_split_logLH_with_stop_nonstop_prob(l, r, t_cut, lam), pL, pR)
+
+    np.testing.assert_array_equal(np.isfinite(logLH), np.isfinite(expected))
+    np.testing.assert_allclose(logLH, expected, rtol=1e-12, atol=1e-12)
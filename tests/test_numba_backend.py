@@ -0,0 +1,134 @@
+import os
+import pickle
+import sys
+import types
+
+import numpy as np
+import pytest
+
+from StandardHC import likelihood_invM as likelihood
+
+
+@pytest.fixture
+def fresh(monkeypatch):
+    """ Run fastBackend (and compile the numba kernel) again, and restore the cached choice after the test """
+    monkeypatch.setattr(likelihood, "_numbaKernel", None)
+    monkeypatch.setattr(likelihood, "_fastBackendName", None)
+
+    warnings = []
+    monkeypatch.setattr(likelihood.logger, "warning", warnings.append)
+    return warnings
+
+
+def fake_numba(monkeypatch, njit):
+    numba = types.ModuleType("numba")
+    numba.njit = njit
+    monkeypatch.setitem(sys.modules, "numba", numba)
+
+
+class TypingError(Exception):
+    """ numba.core.errors.TypingError is not a ValueError """
+
+
+"""####################################"""
+""" fastBackend falls back to the NumPy kernel """
+
+def test_fast_backend_lazy_compile_error(monkeypatch, fresh):
+    """ numba.njit only compiles the kernel when it is first called, inside the self check """
+    def njit(f):
+        def kernel(*args):
+            raise TypingError("Cannot determine Numba type")
+        return kernel
+
+    fake_numba(monkeypatch, njit)
+
+    assert likelihood.fastBackend().name == "numpy"
+    assert likelihood.getBackend("fast").name == "numpy"
+    assert len(fresh) == 1 and "TypingError" in fresh[0]
+
+
+def test_fast_backend_construction_error(monkeypatch, fresh):
+    def njit(f):
+        raise RuntimeError("broken numba install")
+
+    fake_numba(monkeypatch, njit)
+
+    assert likelihood.fastBackend().name == "numpy"
+    assert len(fresh) == 1 and "RuntimeError" in fresh[0]
+
+
+def test_fast_backend_self_check_mismatch(monkeypatch, fresh):
+    def njit(f):
+        def kernel(pL, pR, t_cut, lam, logLH):
+            f(pL, pR, t_cut, lam, logLH)
+            logLH += 1e-6
+        return kernel
+
+    fake_numba(monkeypatch, njit)
+
+    assert likelihood.fastBackend().name == "numpy"
+    assert len(fresh) == 1 and "max difference" in fresh[0]
+
+
+def test_fast_backend_no_numba(monkeypatch, fresh):
+    monkeypatch.setitem(sys.modules, "numba", None)
+
+    assert likelihood.fastBackend().name == "numpy"
+    assert fresh == []
+
+
+"""####################################"""
+""" numba wiring, with numba.njit replaced by the identity so the kernel runs as plain Python (also where numba is not installed) """
+
+@pytest.fixture
+def identity_njit(monkeypatch, fresh):
+    try:
+        import numba
+    except ImportError:
+        fake_numba(monkeypatch, lambda f: f)
+    else:
+        monkeypatch.setattr(numba, "njit", lambda f: f)
+    return fresh
+
+
+@pytest.fixture(scope="module")
+def jets():
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "truth", "tree_100_truth_3.pkl")
+    with open(path, "rb") as fd:
+        return pickle.load(fd, encoding="latin-1")[:5]
+
+
+def test_numba_backend_kernel(identity_njit):
+    backend = likelihood.numbaBackend()
+    assert backend.kernel is likelihood._split_logLH_with_stop_nonstop_prob_loop
+
+    pL, pR, lam = likelihood._selfCheckPairs(P=200)
+    np.testing.assert_allclose(
+        backend.split_logLH_batch(pL, None, pR, None, 1., lam),
+        likelihood.getBackend("numpy").split_logLH_batch(pL, None, pR, None, 1., lam),
+        rtol=1e-12,
+    )
+
+
+def test_fast_backend_self_check(identity_njit):
+    """ The self check passes, so fastBackend (and the default backend of the search engines) is the numba one """
+    assert likelihood.fastBackend().name == "numba"
+    assert likelihood._fastBackendName == "numba"
+    assert likelihood.getBackend().name == "numba"
+    assert identity_njit == []
+
+
+@pytest.mark.parametrize("engine", ["_greedyJet", "_BSJet"])
+def test_search_default_backend(identity_njit, jets, engine):
+    """ Greedy and beam search use the numba kernel by default, with the same trees as the NumPy kernel """
+    from StandardHC import jetClustering_invM as jetClustering
+    run = getattr(jetClustering, engine)
+
+    for jet in jets:
+        default = run(dict(jet))
+        numpyJet = run(dict(jet), backend="numpy")
+
+        np.testing.assert_array_equal(default["tree"], numpyJet["tree"])
+        np.testing.assert_allclose(default["logLH"], numpyJet["logLH"], rtol=1e-12)
+
+    assert likelihood._fastBackendName == "numba"
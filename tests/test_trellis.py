@@ -0,0 +1,103 @@
+import itertools
+import os
+import pickle
+
+import numpy as np
+import pytest
+
+from StandardHC import aStar_invM as aStar
+from StandardHC import trellis_invM as trellis
+
+""" Truth jets from the Ginkgo simulator (9 leaves each) """
+TRUTH_JETS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "truth", "tree_100_truth_3.pkl")
+
+""" Jets where the A* search proves that its tree is optimal within the default node budget, for the legacy and fast backends (the search takes a few seconds per jet) """
+A_STAR_JETS = [0, 2, 4, 7, 8]
+
+
+@pytest.fixture(scope="module")
+def jets():
+    with open(TRUTH_JETS, "rb") as fd:
+        return pickle.load(fd, encoding="latin-1")[:20]
+
+
+def countTrees(leaves):
+    """ Number of binary trees over a set of leaves, enumerating the splits {A, B} with A containing the first leaf """
+    if len(leaves) == 1:
+        return 1
+    first, rest = leaves[0], leaves[1:]
+    return sum(
+        countTrees((first,) + A) * countTrees(tuple(leaf for leaf in rest if leaf not in A))
+        for k in range(len(rest))
+        for A in itertools.combinations(rest, k)
+    )
+
+
+def recluster(module, jet, backend, **kwargs):
+    return module.recluster(dict(jet), delta_min=jet["pt_cut"], lam=float(jet["Lambda"]), backend=backend, **kwargs)
+
+
+"""####################################"""
+""" Trellis splits """
+
+@pytest.mark.parametrize("Nleaves", range(1, 8))
+def test_numberOfTrees(Nleaves):
+    assert trellis.numberOfTrees(Nleaves) == countTrees(tuple(range(Nleaves)))
+
+
+def test_numberOfTrees_large():
+    """ (2N-3)!! is an exact python int (21!! for N = 12, 27!! for N = 15) """
+    assert trellis.numberOfTrees(12) == 13749310575
+    assert trellis.numberOfTrees(15) == 213458046676875
+
+
+@pytest.mark.parametrize("k", range(2, 7))
+def test_subsetSplits(k):
+    """ Each split S = A + B of every subset S with k of 6 leaves once, with the lowest leaf of S in A and B not empty """
+    Nleaves = 6
+    subsets = [S for S in range(2 ** Nleaves) if bin(S).count("1") == k]
+
+    A = trellis.subsetSplits(subsets, Nleaves)
+    assert A.shape == (len(subsets), 2 ** (k - 1) - 1)
+
+    for S, splits in zip(subsets, A):
+        lowest = S & -S
+        expected = {a for a in range(1, S) if a & S == a and a & lowest}
+        assert sorted(splits.tolist()) == sorted(expected)
+
+
+"""####################################"""
+""" Exact maximum likelihood trees """
+
+@pytest.mark.parametrize("backend", ["legacy", "fast"])
+def test_trellis_partition(jets, backend):
+    """ The partition function is the sum of the likelihood of all the trees, so maxLogLH <= logZ <= maxLogLH + log(number of trees) """
+    for jet in jets:
+        trellisJet = recluster(trellis, jet, backend, partition=True)[0]
+
+        assert trellisJet["NTrees"] == trellis.numberOfTrees(len(jet["leaves"]))
+        assert trellisJet["maxLogLH"] <= trellisJet["logZ"] <= trellisJet["maxLogLH"] + np.log(trellisJet["NTrees"])
+
+
+@pytest.mark.parametrize("backend", ["legacy", "fast"])
+def test_aStar_trellis(jets, backend):
+    """ The A* search and the trellis find a tree with the same (maximum) log likelihood """
+    for k in A_STAR_JETS:
+        aStarJet = recluster(aStar, jets[k], backend)
+        trellisJet = recluster(trellis, jets[k], backend, partition=True)[0]
+
+        assert aStarJet["optimal"]
+        np.testing.assert_allclose(aStarJet["maxLogLH"], trellisJet["maxLogLH"], rtol=1e-12, atol=1e-10)
+        np.testing.assert_allclose(aStarJet["logLHUpperBound"], aStarJet["maxLogLH"], rtol=1e-12, atol=1e-10)
+        assert trellisJet["logZ"] >= aStarJet["maxLogLH"]
+
+
+def test_aStar_node_budget(jets):
+    """ When the node budget is reached, the A* tree is not proven optimal, and the trellis maximum is between its log likelihood and the upper bound """
+    aStarJet = recluster(aStar, jets[1], "fast", nodeBudget=500)
+    trellisJet = recluster(trellis, jets[1], "fast")[0]
+
+    assert not aStarJet["optimal"]
+    assert aStarJet["Nexpanded"] == 500
+    assert aStarJet["maxLogLH"] <= trellisJet["maxLogLH"] + 1e-10
+    assert trellisJet["maxLogLH"] <= aStarJet["logLHUpperBound"] + 1e-10